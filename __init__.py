@@ -1,5 +1,5 @@
 """Locally defined gitWebhook module."""
 
-from .gitWebhook import webhookBlueprint, gitWebhookBlueprintABC, pullerWebhookBlueprint, functionWebhookBlueprint
+from .gitWebhook import webhookBlueprint, gitWebhookBlueprintABC, pullerWebhookBlueprint, functionWebhookBlueprint, deliveryCache, sqliteDeliveryCache, ipRangeIndex, providerMetaWhitelist, asyncGitWebhookBlueprintABC, asyncWebhookBlueprint, asyncFunctionWebhookBlueprint, webhookMetrics, multiPullerWebhookBlueprint, repositoryCheckout, worktreeDeployer, deliveryJournal, secretProvider, webhookSecret, admissionController, batchConsumer, workerCoordinator, eventView, webhookEvent, pushEvent, pullRequestEvent, pipelineEvent, deliveryCapture, readCapture, captureReplay, lazyPayload, jsonFormatter, queueLogging
 
-__all__ = ["webhookBlueprint", "gitWebhookBlueprintABC", "pullerWebhookBlueprint", "functionWebhookBlueprint"]
\ No newline at end of file
+__all__ = ["webhookBlueprint", "gitWebhookBlueprintABC", "pullerWebhookBlueprint", "functionWebhookBlueprint", "deliveryCache", "sqliteDeliveryCache", "ipRangeIndex", "providerMetaWhitelist", "asyncGitWebhookBlueprintABC", "asyncWebhookBlueprint", "asyncFunctionWebhookBlueprint", "webhookMetrics", "multiPullerWebhookBlueprint", "repositoryCheckout", "worktreeDeployer", "deliveryJournal", "secretProvider", "webhookSecret", "admissionController", "batchConsumer", "workerCoordinator", "eventView", "webhookEvent", "pushEvent", "pullRequestEvent", "pipelineEvent", "deliveryCapture", "readCapture", "captureReplay", "lazyPayload", "jsonFormatter", "queueLogging"]
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""Benchmarks of the webhook intake path.
+
+Drives realistically sized and correctly signed GitHub, GitLab and Gitea payloads through the blueprints, both using the Flask test client and a real local WSGI server at several concurrency levels.
+Reports throughput, p50/p99 latency and peak memory, of whole requests and of each stage, and compares the results with a stored baseline so that regressions show up.
+Memory is always measured through the test client once any server is stopped, as tracemalloc would also count the allocations of the server and client threads.
+
+Usage:
+    python benchmark.py [--quick] [--save-baseline] [--baseline benchmark_baseline.json] [--tolerance 0.25]
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from hmac import new as hmacNew
+from http.client import HTTPConnection
+from threading import Thread
+from time import perf_counter
+from typing import Any, Callable
+from flask import Flask
+from werkzeug.serving import make_server, WSGIRequestHandler
+from gitWebhook import webhookBlueprint, functionWebhookBlueprint, webhookMetrics
+import tracemalloc
+import random
+import json
+import sys
+import os
+
+TOKEN = "Bearer benchmark" # Gitea sends the configured Authorization header verbatim, so the token includes the scheme
+
+STAGE_BUCKETS = tuple(0.00001 * 1.25 ** i for i in range(80))
+
+DEFAULT_BASELINE = "benchmark_baseline.json"
+
+SIZES = {"ping": 0, "small": 1, "large": 1000, "huge": 5000}
+
+def randomSha() -> str:
+    return "%040x" % random.getrandbits(160)
+
+def commit(repository: str) -> dict[str, Any]:
+    """Generate a commit entry like the ones found in push payloads."""
+    sha = randomSha()
+    return {
+        "id": sha,
+        "tree_id": randomSha(),
+        "distinct": True,
+        "message": "Update " + " ".join(random.choice(("parser", "tests", "docs", "build", "webhook")) for _ in range(8)),
+        "timestamp": "2024-01-01T00:00:00+00:00",
+        "url": f"https://github.com/{repository}/commit/{sha}",
+        "author": {"name": "Developer", "email": "dev@example.com", "username": "dev"},
+        "committer": {"name": "Developer", "email": "dev@example.com", "username": "dev"},
+        "added": [f"src/module{random.randint(0, 999)}.py" for _ in range(random.randint(0, 3))],
+        "removed": [],
+        "modified": [f"src/module{random.randint(0, 999)}.py" for _ in range(random.randint(1, 5))],
+    }
+
+def repositoryObject(repository: str) -> dict[str, Any]:
+    """Generate a repository object with the fields GitHub includes."""
+    owner, name = repository.split("/")
+    fields = {f"{key}_url": f"https://api.github.com/repos/{repository}/{key}" for key in ("keys", "branches", "tags", "issues", "pulls", "commits", "contents", "hooks", "events", "labels", "releases", "deployments")}
+    fields.update({"id": random.randint(1, 10 ** 9), "name": name, "full_name": repository, "private": False, "owner": {"login": owner, "id": 1}, "html_url": f"https://github.com/{repository}", "default_branch": "main", "size": 12345, "stargazers_count": 42})
+    return fields
+
+def payload(provider: str, size: str, repository: str = "org/repo") -> dict[str, Any]:
+    """Generate a webhook payload.
+
+    Args:
+        provider (str): github, gitlab or gitea.
+        size (str): One of SIZES. ping generates a ping event, the others a push with that many commits.
+        repository (str, optional): The repository name. Defaults to "org/repo".
+
+    Returns:
+        dict[str, Any]: The payload.
+    """
+    if size == "ping":
+        return {"zen": "Keep it logically awesome.", "hook_id": 1, "hook": {"type": "Repository", "events": ["push"], "active": True}, "repository": repositoryObject(repository)}
+    commits = [commit(repository) for _ in range(SIZES[size])]
+    data = {"ref": "refs/heads/main", "before": randomSha(), "after": commits[-1]["id"], "commits": commits, "head_commit": commits[-1]}
+    if provider == "gitlab":
+        data.update({"object_kind": "push", "project": {"path_with_namespace": repository, "name": repository.split("/")[1]}, "total_commits_count": len(commits)})
+    else:
+        data.update({"repository": repositoryObject(repository), "pusher": {"name": "dev"}, "sender": {"login": "dev"}})
+    return data
+
+def signedRequest(provider: str, data: dict[str, Any], event: str) -> tuple[dict[str, str], bytes]:
+    """Serialize a payload and build the headers the git app would send with it.
+
+    Args:
+        provider (str): github, gitlab or gitea.
+        data (dict[str, Any]): The payload.
+        event (str): The event type.
+
+    Returns:
+        tuple[dict[str, str], bytes]: The headers and the body.
+    """
+    body = json.dumps(data).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if provider == "github":
+        headers["X-Hub-Signature-256"] = "sha256=" + hmacNew(TOKEN.encode("utf-8"), msg=body, digestmod=sha256).hexdigest()
+        headers["X-GitHub-Event"] = event
+    elif provider == "gitlab":
+        headers["X-Gitlab-Token"] = TOKEN
+        headers["X-Gitlab-Event"] = "Push Hook" if event == "push" else "System Hook"
+    else:
+        headers["Authorization"] = TOKEN
+        headers["X-Gitea-Event"] = event
+    return headers, body
+
+def percentile(values: list[float], q: float) -> float:
+    """Get a percentile of the values."""
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def makeApp(target: str, metrics: webhookMetrics) -> tuple[Flask, webhookBlueprint]:
+    """Create a Flask app with the benchmarked blueprint registered at /.
+
+    Args:
+        target (str): webhook for webhookBlueprint, function for functionWebhookBlueprint with a few trivial functions.
+        metrics (webhookMetrics): Collector of the per stage latencies.
+
+    Returns:
+        tuple[Flask, webhookBlueprint]: The app and the blueprint.
+    """
+    if target == "webhook":
+        blueprint = webhookBlueprint(TOKEN, metrics=metrics, metricsRoute=None)
+    else:
+        def readRef(data):
+            return data.get("ref") is not None or "zen" in data
+        def countCommits(data):
+            return str(len(data.get("commits", ())))
+        def touchRepository(data):
+            return True
+        blueprint = functionWebhookBlueprint(TOKEN, [readRef, countCommits, touchRepository], metrics=metrics, metricsRoute=None)
+    app = Flask(__name__)
+    app.register_blueprint(blueprint, url_prefix="/")
+    return app, blueprint
+
+def runTestClient(app: Flask, headers: dict[str, str], body: bytes, requests: int) -> list[float]:
+    """Send requests one after another through the Flask test client and return their latencies."""
+    client = app.test_client()
+    latencies = []
+    for _ in range(requests):
+        started = perf_counter()
+        response = client.post("/", headers=headers, data=body)
+        latencies.append(perf_counter() - started)
+        if response.status_code != 200:
+            raise RuntimeError(f"Unexpected status code {response.status_code}: {response.data[:200]!r}")
+    return latencies
+
+class quietRequestHandler(WSGIRequestHandler):
+    """Request handler that doesn't log every request."""
+
+    def log_request(self, *args, **kwargs) -> None:
+        pass
+
+def runServer(port: int, headers: dict[str, str], body: bytes, requests: int, concurrency: int) -> list[float]:
+    """Send requests to a local server from several client threads and return their latencies."""
+    def send(_: int) -> float:
+        connection = HTTPConnection("127.0.0.1", port, timeout=60)
+        started = perf_counter()
+        connection.request("POST", "/", body=body, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        latency = perf_counter() - started
+        connection.close()
+        if response.status != 200:
+            raise RuntimeError(f"Unexpected status code {response.status}")
+        return latency
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(send, range(requests)))
+
+def peakMemory(run: Callable[[], Any]) -> int:
+    """Run a function under tracemalloc and return the peak traced memory in bytes.
+    tracemalloc traces every thread of the process, so the function should send its requests in process, with no server running."""
+    tracemalloc.start()
+    try:
+        run()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def stageMemory(app: Flask, blueprint: webhookBlueprint, headers: dict[str, str], body: bytes, requests: int) -> dict[str, int]:
+    """Send requests one after another through the Flask test client under tracemalloc and measure the memory each stage allocates.
+    The peak is reset whenever the blueprint finishes a stage, so each value is the peak during that stage above the memory in use when it started.
+
+    Returns:
+        dict[str, int]: The largest peak seen for each stage in bytes, keyed by stage name.
+    """
+    peaks: dict[str, int] = {}
+    stageDone = blueprint.stageDone
+    inUse = 0
+    def measure(stage: str, started: float) -> float:
+        nonlocal inUse
+        current, peak = tracemalloc.get_traced_memory()
+        peaks[stage] = max(peaks.get(stage, 0), peak - inUse)
+        tracemalloc.reset_peak()
+        inUse = current
+        return stageDone(stage, started)
+    blueprint.stageDone = measure
+    client = app.test_client()
+    tracemalloc.start()
+    try:
+        for _ in range(requests):
+            tracemalloc.reset_peak()
+            inUse = tracemalloc.get_traced_memory()[0]
+            client.post("/", headers=headers, data=body)
+    finally:
+        tracemalloc.stop()
+        del blueprint.stageDone
+    return peaks
+
+def scenario(target: str, provider: str, size: str, transport: str, concurrency: int, requests: int) -> dict[str, Any]:
+    """Run a single benchmark scenario.
+
+    Returns:
+        dict[str, Any]: The scenario parameters and measurements.
+    """
+    metrics = webhookMetrics(buckets=STAGE_BUCKETS)
+    app, blueprint = makeApp(target, metrics)
+    headers, body = signedRequest(provider, payload(provider, size), "ping" if size == "ping" else "push")
+    server = None
+    if transport == "client":
+        run = lambda count: runTestClient(app, headers, body, count)
+    else:
+        server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=quietRequestHandler)
+        thread = Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        run = lambda count: runServer(server.server_port, headers, body, count, concurrency)
+    try:
+        blueprint.metrics = webhookMetrics() # the warm up and memory runs stay out of the measured latencies
+        run(min(3, requests)) # warm up
+        blueprint.metrics = metrics
+        started = perf_counter()
+        latencies = run(requests)
+        elapsed = perf_counter() - started
+        blueprint.metrics = webhookMetrics()
+    finally:
+        if server is not None:
+            server.shutdown()
+            thread.join()
+    runTestClient(app, headers, body, 1) # warm up the test client, which the server transport didn't use
+    memory = peakMemory(lambda: runTestClient(app, headers, body, min(3, requests)))
+    stagePeaks = stageMemory(app, blueprint, headers, body, min(3, requests))
+    stages = {}
+    for series in metrics.snapshot()["histograms"].get("stage_seconds", ()):
+        stage = series["labels"]["stage"]
+        stages[stage] = {"p50": series["p50"], "p99": series["p99"], "peakMemory": stagePeaks.get(stage, 0)}
+    return {
+        "name": f"{target}/{provider}/{size}/{transport}/c{concurrency}",
+        "bodySize": len(body),
+        "requests": requests,
+        "throughput": requests / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p99": percentile(latencies, 0.99),
+        "peakMemory": memory,
+        "stages": stages,
+    }
+
+def scenarios(quick: bool) -> list[tuple[str, str, str, str, int, int]]:
+    """List the scenarios to run, as (target, provider, size, transport, concurrency, requests)."""
+    sizes = ("ping", "small", "large") if quick else tuple(SIZES)
+    concurrencies = (1, 8) if quick else (1, 4, 16, 64)
+    result = []
+    for target in ("webhook", "function"):
+        for provider in ("github", "gitlab", "gitea"):
+            for size in sizes:
+                requests = 20 if size in ("large", "huge") else 200
+                if quick:
+                    requests //= 4
+                result.append((target, provider, size, "client", 1, requests))
+        for size in sizes:
+            for concurrency in concurrencies:
+                requests = 20 if size in ("large", "huge") else 200
+                if quick:
+                    requests //= 4
+                result.append((target, "github", size, "server", concurrency, max(requests, concurrency)))
+    return result
+
+def compare(results: list[dict[str, Any]], baseline: dict[str, dict[str, Any]], tolerance: float) -> list[str]:
+    """Find scenarios that got slower, or use more memory, than in the baseline by more than the tolerance.
+
+    Args:
+        results (list[dict[str, Any]]): Current results.
+        baseline (dict[str, dict[str, Any]]): Baseline results keyed by scenario name.
+        tolerance (float): Allowed relative regression, for example 0.25 for 25%.
+
+    Returns:
+        list[str]: Descriptions of the regressions.
+    """
+    regressions = []
+    for result in results:
+        base = baseline.get(result["name"])
+        if base is None:
+            continue
+        for key in ("p50", "p99", "peakMemory"):
+            if base[key] and result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{result['name']}: {key} {base[key]:.6g} -> {result[key]:.6g}")
+        for stage, values in result.get("stages", {}).items():
+            previous = base.get("stages", {}).get(stage, {}).get("peakMemory")
+            if previous and values["peakMemory"] > previous * (1 + tolerance):
+                regressions.append(f"{result['name']}: {stage} peakMemory {previous:.6g} -> {values['peakMemory']:.6g}")
+        if base["throughput"] and result["throughput"] < base["throughput"] / (1 + tolerance):
+            regressions.append(f"{result['name']}: throughput {base['throughput']:.6g} -> {result['throughput']:.6g}")
+    return regressions
+
+def report(result: dict[str, Any]) -> str:
+    """Format a result as a single line."""
+    stages = " ".join(f"{stage}={values['p50'] * 1000:.2f}ms/{values['peakMemory'] / 1024:.1f}KiB" for stage, values in result["stages"].items() if values["p50"] is not None)
+    return f"{result['name']:<40} {result['bodySize']:>9}B {result['throughput']:>9.1f}/s p50={result['p50'] * 1000:8.2f}ms p99={result['p99'] * 1000:8.2f}ms mem={result['peakMemory'] / 1024:9.1f}KiB {stages}"
+
+def main(argv: list[str] | None = None) -> int:
+    parser = ArgumentParser(description="Benchmark the gitWebhook intake path.")
+    parser.add_argument("--quick", action="store_true", help="run fewer and smaller scenarios")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="baseline results file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression against the baseline")
+    parser.add_argument("--output", help="also write the results as JSON to this file")
+    parser.add_argument("--filter", default="", help="only run scenarios whose name contains this string")
+    args = parser.parse_args(argv)
+    random.seed(0)
+    results = []
+    for parameters in scenarios(args.quick):
+        target, provider, size, transport, concurrency, _ = parameters
+        if args.filter not in f"{target}/{provider}/{size}/{transport}/c{concurrency}":
+            continue
+        result = scenario(*parameters)
+        print(report(result), flush=True)
+        results.append(result)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({result["name"]: result for result in results}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,28 @@
 """Python module providing Flask blueprints for handling various git app wehbooks."""
 
 from .webhook import webhookBlueprint
-from .abstractWebhook import gitWebhookBlueprintABC
+from .abstractWebhook import gitWebhookBlueprintABC, asyncGitWebhookBlueprintABC
 from .pullerWebhook import pullerWebhookBlueprint
 from .functionWebhook import functionWebhookBlueprint
+from .deliveryCache import deliveryCache, sqliteDeliveryCache
+from .ipWhitelist import ipRangeIndex, providerMetaWhitelist
+from .asyncWebhook import asyncWebhookBlueprint, asyncFunctionWebhookBlueprint
+from .metrics import webhookMetrics
+from .multiPullerWebhook import multiPullerWebhookBlueprint, repositoryCheckout
+from .worktreeDeploy import worktreeDeployer
+from .deliveryJournal import deliveryJournal
+from .secretProvider import secretProvider, webhookSecret
+from .admission import admissionController
+from .batching import batchConsumer
+from .coordination import workerCoordinator
+from .events import eventView, webhookEvent, pushEvent, pullRequestEvent, pipelineEvent
+from .capture import deliveryCapture, readCapture
+from .replay import captureReplay
+from .structuredLog import lazyPayload, jsonFormatter, queueLogging
 
-__exports__ = [webhookBlueprint, gitWebhookBlueprintABC, pullerWebhookBlueprint, functionWebhookBlueprint]
+__exports__ = [webhookBlueprint, gitWebhookBlueprintABC, pullerWebhookBlueprint, functionWebhookBlueprint, deliveryCache, sqliteDeliveryCache, ipRangeIndex, providerMetaWhitelist, asyncGitWebhookBlueprintABC, asyncWebhookBlueprint, asyncFunctionWebhookBlueprint, webhookMetrics, multiPullerWebhookBlueprint, repositoryCheckout, worktreeDeployer, deliveryJournal, secretProvider, webhookSecret, admissionController, batchConsumer, workerCoordinator, eventView, webhookEvent, pushEvent, pullRequestEvent, pipelineEvent, deliveryCapture, readCapture, captureReplay, lazyPayload, jsonFormatter, queueLogging]
 
 for e in __exports__:
     e.__module__ = __name__
 
-__all__ = ["webhookBlueprint", "gitWebhookBlueprintABC", "pullerWebhookBlueprint", "functionWebhookBlueprint"]
\ No newline at end of file
+__all__ = ["webhookBlueprint", "gitWebhookBlueprintABC", "pullerWebhookBlueprint", "functionWebhookBlueprint", "deliveryCache", "sqliteDeliveryCache", "ipRangeIndex", "providerMetaWhitelist", "asyncGitWebhookBlueprintABC", "asyncWebhookBlueprint", "asyncFunctionWebhookBlueprint", "webhookMetrics", "multiPullerWebhookBlueprint", "repositoryCheckout", "worktreeDeployer", "deliveryJournal", "secretProvider", "webhookSecret", "admissionController", "batchConsumer", "workerCoordinator", "eventView", "webhookEvent", "pushEvent", "pullRequestEvent", "pipelineEvent", "deliveryCapture", "readCapture", "captureReplay", "lazyPayload", "jsonFormatter", "queueLogging"]
\ No newline at end of file
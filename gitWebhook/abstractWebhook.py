@@ -1,6 +1,6 @@
 from abc import ABC, abstractmethod
 from flask import Response
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 class gitWebhookBlueprintABC(ABC):
     """An abstract class for a webhook blueprint that processes git webhooks."""
@@ -36,4 +36,43 @@ class gitWebhookBlueprintABC(ABC):
         Returns:
             tuple[int, str]: The status code and message.
         """
-        ...
\ No newline at end of file
+        ...
+
+class asyncGitWebhookBlueprintABC(ABC):
+    """An abstract class for an ASGI application that processes git webhooks asynchronously."""
+    
+    @abstractmethod
+    def __init__(self, webhookToken:str | None, *args, **kwargs):
+        """Initialize the webhook application.
+
+        Args:
+            webhookToken (str | None): The token used to verify the webhook. If None, no verification is done.
+            args: Additional arguments.
+            kwargs: Additional keyword arguments.
+        """
+        ...
+    
+    @abstractmethod
+    async def receiveWebhook(self, scope: dict[str, Any], receive: Callable[[], Awaitable[dict[str, Any]]]) -> tuple[int, str]:
+        """Coroutine that handles a POST request to the webhook endpoint.
+
+        Args:
+            scope (dict[str, Any]): The ASGI connection scope.
+            receive (Callable[[], Awaitable[dict[str, Any]]]): The ASGI receive callable.
+
+        Returns:
+            tuple[int, str]: The status code and message of the response.
+        """
+        ...
+    
+    @abstractmethod
+    async def processWebhook(self, data: dict[str, Any]) -> tuple[int, str]:
+        """Process the webhook data and return a status code and message.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        ...
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from threading import Lock, Semaphore
+from time import monotonic
+from typing import Mapping
+from .secretProvider import KEY_HEADERS
+
+def repositoryKey(headers: Mapping[str, str]) -> str | None:
+    """Get a key identifying the repository, organization or hook a delivery belongs to from its headers, without reading the body.
+
+    Args:
+        headers (Mapping[str, str]): The request headers.
+
+    Returns:
+        str | None: The key or None if the headers don't identify the source.
+    """
+    for header in KEY_HEADERS:
+        key = headers.get(header)
+        if key is not None:
+            return f"{header}:{key}"
+    return None
+
+class tokenBucket:
+    """A token bucket refilled at a constant rate, up to a burst size."""
+
+    def __init__(self, rate: float, burst: float, now: float):
+        if rate <= 0:
+            raise ValueError("The rate of a token bucket must be positive")
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token.
+
+        Args:
+            now (float): The current monotonic time.
+
+        Returns:
+            float: 0 if a token was taken, otherwise the seconds until one will be available.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class bucketMap:
+    """Token buckets keyed by source, forgetting the least recently used sources over a size limit."""
+
+    def __init__(self, rate: float, burst: float | None, maxSize: int):
+        if rate <= 0:
+            raise ValueError("The rate of a token bucket must be positive")
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        self.maxSize = maxSize
+        self.buckets: OrderedDict[str, tokenBucket] = OrderedDict()
+
+    def take(self, key: str, now: float) -> float:
+        """Take a token from the bucket of a source. Must be called holding the lock of the controller."""
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = tokenBucket(self.rate, self.burst, now)
+            if len(self.buckets) > self.maxSize:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(now)
+
+class admissionController:
+    """Limits the deliveries a blueprint accepts: the number processed at once, and the rate of deliveries per source IP address and per repository.
+    Deliveries over the in flight or IP limits are shed before their body is read, and counted by reason in shed.
+    The headers identifying repositories aren't signed, so anybody could send deliveries naming another repository. Blueprints therefore only take from the bucket of a repository using admitRepository once a delivery is verified, which needs its body to be read."""
+
+    def __init__(self, maxInFlight: int | None = None, ipRate: float | None = None, ipBurst: float | None = None, repositoryRate: float | None = None, repositoryBurst: float | None = None, retryAfter: float = 1.0, maxSources: int = 10000):
+        """Initialize the controller. Limits that are None aren't enforced.
+
+        Args:
+            maxInFlight (int | None, optional): Maximum number of deliveries processed at once. Defaults to None.
+            ipRate (float | None, optional): Deliveries per second allowed from a single IP address. Defaults to None.
+            ipBurst (float | None, optional): Deliveries a single IP address may send at once after being idle. Defaults to None, which is ipRate or at least 1.
+            repositoryRate (float | None, optional): Verified deliveries per second allowed for a single repository, organization or hook, identified by headers like X-GitHub-Hook-Installation-Target-ID. Defaults to None.
+            repositoryBurst (float | None, optional): Deliveries a single repository may send at once after being idle. Defaults to None, which is repositoryRate or at least 1.
+            retryAfter (float, optional): Seconds git apps are asked to wait when the in flight limit is reached. Defaults to 1.0.
+            maxSources (int, optional): Maximum number of IP addresses and repositories whose buckets are remembered. Defaults to 10000.
+
+        Raises:
+            ValueError: If a rate isn't positive or maxInFlight is less than 1.
+        """
+        if maxInFlight is not None and maxInFlight < 1:
+            raise ValueError("maxInFlight must be at least 1")
+        self.maxInFlight = maxInFlight
+        self.slots = Semaphore(maxInFlight) if maxInFlight is not None else None
+        self.ipBuckets = bucketMap(ipRate, ipBurst, maxSources) if ipRate is not None else None
+        self.repositoryBuckets = bucketMap(repositoryRate, repositoryBurst, maxSources) if repositoryRate is not None else None
+        self.retryAfter = retryAfter
+        self.lock = Lock()
+        self.inFlight = 0
+        self.admitted = 0
+        self.shed = {"inFlight": 0, "ip": 0, "repository": 0}
+
+    def admit(self, address: str | None, repository: str | None = None) -> tuple[str, float] | None:
+        """Try to admit a delivery. Admitted deliveries must be released once processed.
+
+        Args:
+            address (str | None): The client address.
+            repository (str | None, optional): Key of the repository, as returned by repositoryKey. Only pass it if the key can be trusted, otherwise use admitRepository once the delivery is verified. Defaults to None.
+
+        Returns:
+            tuple[str, float] | None: None if the delivery was admitted, otherwise the reason it was shed (inFlight, ip or repository) and the seconds after which it may be retried.
+        """
+        now = monotonic()
+        with self.lock:
+            if self.ipBuckets is not None and address is not None:
+                wait = self.ipBuckets.take(address, now)
+                if wait > 0:
+                    self.shed["ip"] += 1
+                    return "ip", wait
+            if self.repositoryBuckets is not None and repository is not None:
+                wait = self.repositoryBuckets.take(repository, now)
+                if wait > 0:
+                    self.shed["repository"] += 1
+                    return "repository", wait
+        if self.slots is not None and not self.slots.acquire(blocking=False):
+            with self.lock:
+                self.shed["inFlight"] += 1
+            return "inFlight", self.retryAfter
+        with self.lock:
+            self.inFlight += 1
+            self.admitted += 1
+        return None
+
+    def admitRepository(self, repository: str | None) -> tuple[str, float] | None:
+        """Take a token from the bucket of the repository of a verified delivery.
+
+        Args:
+            repository (str | None): Key of the repository, as returned by repositoryKey.
+
+        Returns:
+            tuple[str, float] | None: None if the delivery was admitted, otherwise repository and the seconds after which it may be retried.
+        """
+        if self.repositoryBuckets is None or repository is None:
+            return None
+        with self.lock:
+            wait = self.repositoryBuckets.take(repository, monotonic())
+            if wait > 0:
+                self.shed["repository"] += 1
+                return "repository", wait
+        return None
+
+    def release(self) -> None:
+        """Release an admitted delivery."""
+        with self.lock:
+            self.inFlight -= 1
+        if self.slots is not None:
+            self.slots.release()
@@ -0,0 +1,410 @@
+from typing import Any, Awaitable, Callable, Mapping
+from logging import Logger, INFO
+from hmac import HMAC
+from inspect import iscoroutinefunction
+from werkzeug.datastructures import Headers
+import asyncio
+from .abstractWebhook import asyncGitWebhookBlueprintABC
+from .webhook import GITHUB_HEADER, GITHUB_SIGNATURE_PREFIX, GITLAB_HEADER, FORWARDED_HEADER, getDeliveryId, getEvent, getProvider, deliveryFields
+from .functionWebhook import summarizeResults, routedFunctions
+from .deliveryCache import deliveryCache as deliveryCacheType
+from .router import eventRouter
+from .intake import jsonLoads, payloadTooLarge, MAX_BODY_SIZE
+from .ipWhitelist import ipRangeIndex, providerMetaWhitelist, compileWhitelist, forwardedClient
+from .metrics import webhookMetrics, eventLabel
+from .secretProvider import secretProvider, digestGroup
+from .structuredLog import lazyPayload
+from .events import eventView
+from .payload import getRepositoryName
+from time import perf_counter
+
+ASGIApp = Callable[[dict[str, Any], Callable[[], Awaitable[dict[str, Any]]], Callable[[dict[str, Any]], Awaitable[None]]], Awaitable[None]]
+
+class webhookError(Exception):
+    """Raised to end the handling of a webhook request with an HTTP error."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+async def readAsgiBody(receive: Callable[[], Awaitable[dict[str, Any]]], maxSize: int | None = MAX_BODY_SIZE, digest: HMAC | digestGroup | None = None) -> bytearray:
+    """Read an ASGI request body into a single buffer, feeding each chunk to an HMAC and enforcing a size limit as it goes.
+
+    Args:
+        receive (Callable[[], Awaitable[dict[str, Any]]]): The ASGI receive callable.
+        maxSize (int | None, optional): Maximum allowed body size in bytes. Defaults to MAX_BODY_SIZE.
+        digest (HMAC | digestGroup | None, optional): Optional HMAC, or group of HMACs, updated with the body. Defaults to None.
+
+    Raises:
+        payloadTooLarge: If the body is larger than maxSize.
+
+    Returns:
+        bytearray: The body.
+    """
+    body = bytearray()
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise webhookError(400, "Client disconnected")
+        chunk = message.get("body", b"")
+        if maxSize is not None and len(body) + len(chunk) > maxSize:
+            raise payloadTooLarge(f"Body exceeds {maxSize} bytes")
+        if digest is not None:
+            digest.update(chunk)
+        body += chunk
+        if not message.get("more_body", False):
+            return body
+
+class asyncWebhookBlueprint(asyncGitWebhookBlueprintABC):
+    """ASGI application that receives git webhooks, performing the same verification as webhookBlueprint without tying up a thread per delivery.
+    Overwrite the processWebhook coroutine to process the webhook data. Use wrap to mount it in front of another ASGI application, like a Quart app."""
+
+    def __init__(self, webhookToken:str | secretProvider | None, log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | ipRangeIndex | providerMetaWhitelist | None = None, *, path:str="/", trustedProxies:list[str] | None = None, deliveryCache:deliveryCacheType | None = None, maxBodySize:int | None = MAX_BODY_SIZE, jsonDecoder:Callable[[bytes | bytearray], Any] = jsonLoads, metrics:webhookMetrics | None = None, typedEvents:bool = False):
+        """Initialize the webhook application.
+
+        Args:
+            webhookToken (str | secretProvider | None): The token used to verify the webhook, or a secretProvider resolving separate secrets per hook, repository or organization. If None, no verification is done.
+            log (Logger | None, optional): Optional logger that will be used by this application. Defaults to None.
+            name (str, optional): Name of the application, used in logs. Defaults to "webhook".
+            github (bool, optional): Whether the application should process webhook requests from GitHub. Defaults to True.
+            gitlab (bool, optional): Whether the application should process webhook requests from GitLab. Defaults to True.
+            gitea (bool, optional): Whether the application should process webhook requests from Gitea or other requests using basic auth. Defaults to True.
+            ipWhitelist (list[str] | ipRangeIndex | providerMetaWhitelist | None, optional): Optional whitelist that all incoming requests will be checked against. Defaults to None.
+            path (str, optional): Path of the webhook endpoint. Defaults to "/".
+            trustedProxies (list[str] | None, optional): Addresses and networks of reverse proxies whose X-Forwarded-For header is trusted. Defaults to None.
+            deliveryCache (deliveryCache | None, optional): Optional cache of seen delivery ids. Defaults to None.
+            maxBodySize (int | None, optional): Maximum request body size in bytes. Defaults to 25 MB.
+            jsonDecoder (Callable[[bytes | bytearray], Any], optional): Function used to decode the request body. Defaults to orjson.loads if orjson is installed and json.loads otherwise.
+            metrics (webhookMetrics | None, optional): Optional collector of latencies and delivery counters. Defaults to None.
+            typedEvents (bool, optional): Whether handlers receive typed event views that decode the payload lazily instead of dicts. Defaults to False.
+        """
+        self.log = log
+        if webhookToken is None:
+            if self.log is not None:
+                self.log.warning("No webhook token provided. THIS IS VERY UNSAFE")
+        self.webhookToken = webhookToken
+        self.secrets: secretProvider | None = None
+        if isinstance(webhookToken, secretProvider):
+            self.secrets = webhookToken
+        elif webhookToken is not None:
+            self.secrets = secretProvider(default=webhookToken)
+        self.name = name
+        self.github = github
+        self.gitlab = gitlab
+        self.gitea = gitea
+        self.ipWhitelist = compileWhitelist(ipWhitelist)
+        self.path = path.rstrip("/") or "/"
+        self.trustedProxies = compileWhitelist(trustedProxies)
+        self.deliveryCache = deliveryCache
+        self.maxBodySize = maxBodySize
+        self.jsonDecoder = jsonDecoder
+        self.typedEvents = typedEvents
+        self.metrics = metrics
+        self.router = eventRouter()
+
+    async def __call__(self, scope: dict[str, Any], receive: Callable[[], Awaitable[dict[str, Any]]], send: Callable[[dict[str, Any]], Awaitable[None]]) -> None:
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+        if not self.matches(scope):
+            code, message = 404, "Not Found"
+        elif scope["method"] != "POST":
+            code, message = 405, "Method Not Allowed"
+        else:
+            started = perf_counter()
+            try:
+                code, message = await self.receiveWebhook(scope, receive)
+            except webhookError as e:
+                code, message = e.code, e.message
+            except Exception as e:
+                if self.log is not None:
+                    self.log.error(f"Error while processing webhook: {e}")
+                code, message = 500, "Internal Server Error"
+            if self.metrics is not None:
+                headers = Headers([(key.decode("latin-1"), value.decode("latin-1")) for key, value in scope["headers"]])
+                event = eventLabel(scope["webhookEvent"]) if "webhookEvent" in scope else "unverified" # set once the request is verified
+                self.metrics.increment("deliveries_total", provider=getProvider(headers), event=event, status=code)
+                self.metrics.observe("request_seconds", perf_counter() - started)
+        await send({"type": "http.response.start", "status": code, "headers": [(b"content-type", b"text/plain; charset=utf-8")]})
+        await send({"type": "http.response.body", "body": message.encode("utf-8")})
+
+    def matches(self, scope: dict[str, Any]) -> bool:
+        """Check whether a request targets the webhook endpoint."""
+        return (scope["path"].rstrip("/") or "/") == self.path
+
+    def wrap(self, app: ASGIApp) -> ASGIApp:
+        """Mount the webhook endpoint in front of another ASGI application, for example a Quart app.
+
+        Args:
+            app (ASGIApp): The application receiving all requests not aimed at the webhook endpoint.
+
+        Returns:
+            ASGIApp: The combined application.
+        """
+        async def dispatcher(scope: dict[str, Any], receive: Callable[[], Awaitable[dict[str, Any]]], send: Callable[[dict[str, Any]], Awaitable[None]]) -> None:
+            if scope["type"] == "http" and self.matches(scope):
+                await self(scope, receive, send)
+            else:
+                await app(scope, receive, send)
+        return dispatcher
+
+    async def receiveWebhook(self, scope: dict[str, Any], receive: Callable[[], Awaitable[dict[str, Any]]]) -> tuple[int, str]:
+        received = perf_counter()
+        headers = Headers([(key.decode("latin-1"), value.decode("latin-1")) for key, value in scope["headers"]])
+        if self.ipWhitelist is not None:
+            client = scope.get("client")
+            address = forwardedClient(client[0] if client else None, headers.get(FORWARDED_HEADER), self.trustedProxies)
+            if address is None:
+                if self.log is not None:
+                    self.log.warning("Received a request with no IP address")
+                raise webhookError(403, "Forbidden")
+            if address not in self.ipWhitelist:
+                if self.log is not None:
+                    self.log.warning(f"Received a request from an unauthorized IP address: {address}")
+                raise webhookError(403, "Forbidden")
+        if self.log is not None:
+            self.log.debug("Received a POST request to the webhook endpoint")
+        if headers.get("Content-Type") != "application/json":
+            if self.log is not None:
+                self.log.warning(f"A request with an invalid content type: {headers.get('Content-Type')}")
+            raise webhookError(415, "Unsupported Media Type")
+        contentLength = headers.get("Content-Length", type=int)
+        if self.maxBodySize is not None and contentLength is not None and contentLength > self.maxBodySize:
+            if self.log is not None:
+                self.log.warning(f"A request with a body too large: {contentLength}")
+            raise webhookError(413, "Payload Too Large")
+        digest = None
+        signature = None
+        secret = None
+        if self.secrets is not None:
+            secret = self.secrets.resolve(headers)
+            if secret is None:
+                if self.log is not None:
+                    self.log.warning("A request with no known secret")
+                raise webhookError(401, "Unauthorized")
+            if GITHUB_HEADER in headers and self.github:
+                signature = headers[GITHUB_HEADER]
+                if not signature.startswith(GITHUB_SIGNATURE_PREFIX):
+                    if self.log is not None:
+                        self.log.warning("A request with an invalid GitHub signature")
+                    raise webhookError(401, "Unauthorized")
+                digest = secret.digest()
+            elif GITLAB_HEADER in headers and self.gitlab:
+                if not secret.verifyToken(headers[GITLAB_HEADER]):
+                    if self.log is not None:
+                        self.log.warning("A request with an invalid GitLab token")
+                    raise webhookError(401, "Unauthorized")
+            elif "Authorization" in headers and self.gitea:
+                if not secret.verifyToken(headers["Authorization"]):
+                    if self.log is not None:
+                        self.log.warning("A request with an invalid basic authorization")
+                    raise webhookError(401, "Unauthorized")
+            else:
+                if self.log is not None:
+                    self.log.warning("A request with no signature found")
+                raise webhookError(401, "Unauthorized")
+        try:
+            body = await readAsgiBody(receive, self.maxBodySize, digest)
+        except payloadTooLarge:
+            if self.log is not None:
+                self.log.warning("A request with a body too large")
+            raise webhookError(413, "Payload Too Large")
+        if digest is not None and not digest.matches(signature, GITHUB_SIGNATURE_PREFIX):
+            if self.log is not None:
+                self.log.warning("A request with an invalid GitHub signature")
+            raise webhookError(401, "Unauthorized")
+        event = scope["webhookEvent"] = getEvent(headers)
+        deliveryId = None
+        if self.deliveryCache is not None: # the cache may write to disk, so it's used off the event loop
+            deliveryId = getDeliveryId(headers)
+            if deliveryId is not None and not await asyncio.to_thread(self.deliveryCache.add, deliveryId):
+                if self.log is not None:
+                    self.log.info(f"Ignoring duplicate delivery {deliveryId}")
+                return 200, "Duplicate delivery"
+        if not self.acceptsEvent(event):
+            if self.log is not None:
+                self.log.debug(f"Ignoring unhandled event {event}")
+            return 200, "Event ignored"
+        try: # decoding big payloads takes long enough to stall other deliveries
+            data = await asyncio.to_thread(self.decodePayload, event, body)
+        except ValueError:
+            data = None
+        if data is None or not isinstance(data, Mapping):
+            if self.log is not None:
+                self.log.error("A request with invalid JSON")
+            await self.forgetDelivery(deliveryId) # a corrected redelivery must be processed
+            raise webhookError(400, "Invalid JSON")
+        if secret is not None and not self.secrets.authorize(secret, getRepositoryName(data)):
+            if self.log is not None:
+                self.log.warning("A request signed with a secret not valid for repository %s", getRepositoryName(data))
+            await self.forgetDelivery(deliveryId)
+            raise webhookError(403, "Forbidden")
+        started = perf_counter()
+        try:
+            ret = await self.dispatchWebhook(event, data)
+        except Exception:
+            await self.forgetDelivery(deliveryId)
+            raise
+        if ret[0] >= 500:
+            await self.forgetDelivery(deliveryId)
+        if self.metrics is not None:
+            self.metrics.observe("stage_seconds", perf_counter() - started, stage="process")
+        if self.log is not None and self.log.isEnabledFor(INFO):
+            self.log.info("Webhook processed with status code %d and message: %s", ret[0], lazyPayload(ret[1]), extra=deliveryFields(headers, data, status=ret[0], duration=perf_counter() - received))
+        return ret
+
+    async def forgetDelivery(self, deliveryId: str | None) -> None:
+        """Remove a delivery that wasn't processed from the delivery cache, so that a redelivery is processed."""
+        if deliveryId is not None and self.deliveryCache is not None:
+            await asyncio.to_thread(self.deliveryCache.discard, deliveryId)
+
+    def decodePayload(self, event: str | None, body: bytes | bytearray) -> dict[str, Any] | Mapping[str, Any]:
+        """Decode a request body, into a typed event view if typedEvents is enabled. Called in a worker thread.
+
+        Args:
+            event (str | None): The event type.
+            body (bytes | bytearray): The raw request body.
+
+        Raises:
+            ValueError: If the body isn't valid JSON.
+
+        Returns:
+            dict[str, Any] | Mapping[str, Any]: The webhook data.
+        """
+        if self.typedEvents:
+            return eventView(event, body)
+        return self.jsonDecoder(body)
+
+    async def processWebhook(self, data: dict[str, Any]) -> tuple[int, str]:
+        """Process the webhook. Return a tuple of (status code, message)
+
+        Args:
+            data (dict[str, Any]): The webhook data
+
+        Returns:
+            tuple[int, str]: HTTP return code with a message
+        """
+        return (200, "OK")
+
+    def acceptsEvent(self, event: str | None) -> bool:
+        """Check whether a delivery of the given event type should be processed, see webhookBlueprint.acceptsEvent."""
+        return not self.router or self.router.handles(event)
+
+    async def dispatchWebhook(self, event: str | None, data: dict[str, Any]) -> tuple[int, str]:
+        """Call the handlers registered using on that match the delivery, and then process the webhook.
+        Handlers that aren't coroutine functions are ran in a worker thread.
+
+        Args:
+            event (str | None): The event type, or None if the request didn't specify one.
+            data (dict[str, Any]): The webhook data
+
+        Returns:
+            tuple[int, str]: HTTP return code with a message
+        """
+        for handler in self.router.match(event, data):
+            await callHandler(handler, data)
+        return await self.processWebhook(data)
+
+    def on(self, event: str, ref: str | None = None, repo: str | None = None) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+        """Decorator registering a function that will be called with the webhook data, only for deliveries of the given event type. See webhookBlueprint.on."""
+        def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+            self.router.add(event, func, ref, repo)
+            return func
+        return decorator
+
+async def callHandler(handler: Callable[[dict[str, Any]], Any], data: dict[str, Any]) -> Any:
+    """Await a coroutine function, or run a regular function in a worker thread so that it doesn't block the event loop."""
+    if iscoroutinefunction(handler):
+        return await handler(data)
+    return await asyncio.to_thread(handler, data)
+
+class asyncFunctionWebhookBlueprint(asyncWebhookBlueprint):
+    """A subclass of asyncWebhookBlueprint that processes the webhook data using a list of functions, like functionWebhookBlueprint.
+    All functions run concurrently, coroutine functions on the event loop and regular functions in worker threads."""
+
+    def __init__(self, webhookToken:str | secretProvider | None, functions:list[Callable[[dict[str, Any]], bool | Any]], log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | ipRangeIndex | providerMetaWhitelist | None = None, *, timeout:float | None = None, timeouts:dict[str, float] | None = None, **kwargs):
+        """Initialize the webhook application with a list of functions to process the webhook data.
+
+        Args:
+            webhookToken (str | secretProvider | None): The token used to verify the webhook, or a secretProvider resolving separate secrets per hook, repository or organization. If None, no verification is done.
+            functions (list[Callable[[dict[str, Any]], bool | Any]]): List of functions that will process the webhook data.
+            log (Logger | None, optional): Optional logger that will be used by this application. Defaults to None.
+            name (str, optional): Name of the application, used in logs. Defaults to "webhook".
+            github (bool, optional): Whether the application should process webhook requests from GitHub. Defaults to True.
+            gitlab (bool, optional): Whether the application should process webhook requests from GitLab. Defaults to True.
+            gitea (bool, optional): Whether the application should process webhook requests from Gitea or other requests using basic auth. Defaults to True.
+            ipWhitelist (list[str] | ipRangeIndex | providerMetaWhitelist | None, optional): Optional whitelist that all incoming requests will be checked against. Defaults to None.
+            timeout (float | None, optional): Default number of seconds each function may run for. Defaults to None.
+            timeouts (dict[str, float] | None, optional): Per function timeouts, keyed by function name, overriding the default timeout. Defaults to None.
+            kwargs: Additional keyword arguments to pass to the asyncWebhookBlueprint constructor.
+        """
+        super().__init__(webhookToken, log, name, github, gitlab, gitea, ipWhitelist, **kwargs)
+        self.functions = functions
+        self.timeout = timeout
+        if timeouts is None:
+            timeouts = {}
+        self.timeouts = timeouts
+
+    async def processWebhook(self, data: dict[str, Any]) -> tuple[int, str]:
+        """Process the webhook data using the list of functions and the matching functions registered using on, with the same status codes and output as functionWebhookBlueprint.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        return await self.applyFunctions([*self.functions, *routedFunctions.get()], data)
+
+    def acceptsEvent(self, event: str | None) -> bool:
+        return bool(self.functions) or super().acceptsEvent(event)
+
+    async def dispatchWebhook(self, event: str | None, data: dict[str, Any]) -> tuple[int, str]:
+        if not self.router:
+            return await self.processWebhook(data)
+        token = routedFunctions.set(tuple(self.router.match(event, data)))
+        try:
+            return await self.processWebhook(data)
+        finally:
+            routedFunctions.reset(token)
+
+    async def applyFunctions(self, functions: list[Callable[[dict[str, Any]], bool | Any]], data: dict[str, Any]) -> tuple[int, str]:
+        """Run the given functions concurrently and summarize their results.
+
+        Args:
+            functions (list[Callable[[dict[str, Any]], bool | Any]]): The functions to call.
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        if self.log is not None:
+            self.log.debug("Processing webhook: %s", lazyPayload(data))
+        outcomes = await asyncio.gather(*(self.callFunction(function, data) for function in functions))
+        return summarizeResults([(function, res, e) for function, (res, e) in zip(functions, outcomes)], self.log)
+
+    async def callFunction(self, function: Callable[[dict[str, Any]], bool | Any], data: dict[str, Any]) -> tuple[Any, Exception | None]:
+        """Call a single function within its timeout.
+
+        Returns:
+            tuple[Any, Exception | None]: The return value of the function and the exception it raised.
+        """
+        timeout = self.timeouts.get(function.__name__, self.timeout)
+        started = perf_counter()
+        try:
+            return await asyncio.wait_for(callHandler(function, data), timeout), None
+        except asyncio.TimeoutError:
+            return None, TimeoutError(f"Timed out after {timeout} seconds")
+        except Exception as e:
+            return None, e
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe("function_seconds", perf_counter() - started, function=function.__name__)
@@ -0,0 +1,104 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock, Timer
+from logging import Logger
+from typing import Any, Callable
+from .metrics import webhookMetrics
+
+class batchConsumer:
+    """Collects webhook payloads for a function that processes many of them at once, for example with a single call to a downstream API.
+    A batch is handed to the function once it holds maxSize payloads or maxDelay seconds after its first payload arrived, whichever comes first.
+    Batches of a consumer are processed one at a time, in the order they were collected, on a thread of their own."""
+
+    def __init__(self, function: Callable[[list[dict[str, Any]]], bool | Any], call: Callable[[Callable[..., Any], Any, float | None], Any] | None = None, maxSize: int = 100, maxDelay: float = 1.0, timeout: float | None = None, log: Logger | None = None, metrics: webhookMetrics | None = None):
+        """Initialize the consumer.
+
+        Args:
+            function (Callable[[list[dict[str, Any]]], bool | Any]): The function called with a list of payloads. Returning False or raising an exception marks the batch as failed.
+            call (Callable[[Callable[..., Any], Any, float | None], Any] | None, optional): Function calling the consumer with a batch and a timeout, like functionWebhookBlueprint.callFunction. Defaults to None, which calls it directly.
+            maxSize (int, optional): Maximum number of payloads in a batch. Defaults to 100.
+            maxDelay (float, optional): Maximum number of seconds a payload waits for its batch to fill up. Defaults to 1.0.
+            timeout (float | None, optional): Seconds a coroutine consumer may run for, when called through call. Defaults to None.
+            log (Logger | None, optional): Optional logger. Defaults to None.
+            metrics (webhookMetrics | None, optional): Optional metrics collector. Defaults to None.
+        """
+        self.function = function
+        self.call = call
+        self.maxSize = maxSize
+        self.maxDelay = maxDelay
+        self.timeout = timeout
+        self.log = log
+        self.metrics = metrics
+        self.name = function.__name__
+        self.pending: list[dict[str, Any]] = []
+        self.timer: Timer | None = None
+        self.lock = Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"batch-{self.name}")
+        self.last: Future | None = None
+
+    def add(self, data: dict[str, Any]) -> None:
+        """Add a payload to the current batch, handing the batch over if it is full.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+        """
+        with self.lock:
+            self.pending.append(data)
+            if len(self.pending) >= self.maxSize:
+                self.submit()
+            elif self.timer is None:
+                self.timer = Timer(self.maxDelay, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self) -> Future | None:
+        """Hand the current batch over, even if it isn't full.
+
+        Returns:
+            Future | None: Future of the processing of the batch, or of the last batch if the current one is empty.
+        """
+        with self.lock:
+            if self.pending:
+                self.submit()
+            return self.last
+
+    def submit(self) -> None:
+        """Hand the pending payloads over to the processing thread. Must be called holding the lock."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch = self.pending
+        self.pending = []
+        self.last = self.executor.submit(self.process, batch)
+
+    def process(self, batch: list[dict[str, Any]]) -> bool:
+        """Call the function with a batch, reporting failures through the log and metrics.
+
+        Args:
+            batch (list[dict[str, Any]]): The payloads.
+
+        Returns:
+            bool: True if the batch was processed successfully.
+        """
+        try:
+            if self.call is not None:
+                res = self.call(self.function, batch, self.timeout)
+            else:
+                res = self.function(batch)
+            success = res is not False
+            if not success and self.log is not None:
+                self.log.error("Batch function %s returned false for %d deliveries", self.name, len(batch))
+        except Exception as e:
+            success = False
+            if self.log is not None:
+                self.log.error("Batch function %s raised an exception for %d deliveries: %s", self.name, len(batch), e)
+        if success and self.log is not None:
+            self.log.debug("Batch function %s processed %d deliveries", self.name, len(batch))
+        if self.metrics is not None:
+            self.metrics.increment("batches_total", function=self.name, status="passed" if success else "failed")
+            self.metrics.increment("batched_deliveries_total", len(batch), function=self.name, status="passed" if success else "failed")
+        return success
+
+    def close(self) -> None:
+        """Process the current batch and wait for all batches to be processed."""
+        self.flush()
+        self.executor.shutdown(wait=True)
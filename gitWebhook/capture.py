@@ -0,0 +1,165 @@
+from base64 import b64encode, b64decode
+from queue import Queue, Full
+from random import random
+from threading import Thread, Lock, Event
+from time import time, strftime, localtime
+from typing import Any, Iterable, Iterator, Mapping
+import gzip
+import json
+import os
+import zlib
+
+REDACTED_HEADERS = frozenset(("authorization", "x-gitlab-token", "cookie"))
+"""Lowercase names of headers that hold secrets verbatim, and are never captured."""
+
+class capturedDelivery:
+    """A delivery read from a capture."""
+
+    def __init__(self, time: float, event: str | None, headers: dict[str, str], body: bytes):
+        self.time = time
+        self.event = event
+        self.headers = headers
+        self.body = body
+
+class deliveryCapture:
+    """Records verified deliveries, their headers and raw body, into gzip compressed JSON lines files, to be replayed offline with captureReplay.
+    Files are rotated once they hold maxFileSize bytes of uncompressed records, and only the newest maxFiles are kept.
+    Records are compressed and written by a background thread, so capturing adds little more than a queue put to a request.
+    If the writer falls behind and the queue is full, records are dropped and counted in dropped rather than held in memory."""
+
+    def __init__(self, directory: str, sampleRate: float = 1.0, maxFileSize: int = 64 * 1024 * 1024, maxFiles: int = 10, maxBodySize: int | None = None, events: Iterable[str] | None = None, maxQueued: int = 1000):
+        """Initialize the capture, creating the directory if necessary.
+
+        Args:
+            directory (str): Directory the capture files are written to.
+            sampleRate (float, optional): Fraction of deliveries captured, chosen at random. Defaults to 1.0.
+            maxFileSize (int, optional): Uncompressed size in bytes after which a file is rotated. Defaults to 64 MB.
+            maxFiles (int, optional): Number of files kept, the oldest are removed. Defaults to 10.
+            maxBodySize (int | None, optional): Deliveries with larger bodies aren't captured. Defaults to None.
+            events (Iterable[str] | None, optional): Event types captured. Defaults to None, which captures all events.
+            maxQueued (int, optional): Maximum number of records waiting for the writer. Defaults to 1000.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.sampleRate = sampleRate
+        self.maxFileSize = maxFileSize
+        self.maxFiles = maxFiles
+        self.maxBodySize = maxBodySize
+        self.events = frozenset(events) if events is not None else None
+        self.file: gzip.GzipFile | None = None
+        self.written = 0
+        self.sequence = 0
+        self.captured = 0
+        self.dropped = 0
+        self.lock = Lock()
+        self.queue: Queue[bytes | Event | None] = Queue(maxQueued)
+        self.writer = Thread(target=self.run, name="deliveryCapture", daemon=True)
+        self.writer.start()
+
+    def record(self, headers: Mapping[str, str], body: bytes | bytearray, event: str | None) -> bool:
+        """Capture a delivery, unless it is sampled out or over a cap.
+
+        Args:
+            headers (Mapping[str, str]): The request headers.
+            body (bytes | bytearray): The raw request body.
+            event (str | None): The event type.
+
+        Returns:
+            bool: True if the delivery was captured, False if it was skipped or dropped because the queue is full.
+        """
+        if self.events is not None and event not in self.events:
+            return False
+        if self.maxBodySize is not None and len(body) > self.maxBodySize:
+            return False
+        if self.sampleRate < 1.0 and random() >= self.sampleRate:
+            return False
+        entry = {"time": time(), "event": event, "headers": {key: value for key, value in headers.items() if key.lower() not in REDACTED_HEADERS}, "body": b64encode(body).decode("ascii")}
+        try:
+            self.queue.put_nowait(json.dumps(entry).encode("utf-8") + b"\n")
+        except Full:
+            with self.lock:
+                self.dropped += 1
+            return False
+        with self.lock:
+            self.captured += 1
+        return True
+
+    def run(self) -> None:
+        """Write queued records until the capture is closed, flushing whenever the queue runs empty so that a crash loses next to nothing."""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if isinstance(item, Event):
+                if self.file is not None:
+                    self.file.flush(zlib.Z_SYNC_FLUSH)
+                item.set()
+                continue
+            self.write(item)
+            if self.queue.empty() and self.file is not None:
+                self.file.flush(zlib.Z_SYNC_FLUSH)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, line: bytes) -> None:
+        """Write a record to the current file, rotating it if it's full."""
+        if self.file is not None and self.written + len(line) > self.maxFileSize:
+            self.file.close()
+            self.file = None
+        if self.file is None:
+            self.sequence += 1
+            path = os.path.join(self.directory, f"capture-{strftime('%Y%m%d-%H%M%S', localtime())}-{os.getpid()}-{self.sequence:06d}.jsonl.gz")
+            self.file = gzip.open(path, "wb")
+            self.written = 0
+            self.prune()
+        self.file.write(line)
+        self.written += len(line)
+
+    def prune(self) -> None:
+        """Remove the oldest files over maxFiles."""
+        files = self.files()
+        for path in files[:max(0, len(files) - self.maxFiles)]:
+            os.remove(path)
+
+    def files(self) -> list[str]:
+        """Get the paths of the capture files, oldest first."""
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory)) if name.startswith("capture-") and name.endswith(".jsonl.gz")]
+
+    def flush(self) -> None:
+        """Wait until all queued records are written and readable."""
+        done = Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self) -> None:
+        """Write the queued records and close the current file."""
+        self.queue.put(None)
+        self.writer.join()
+
+def readCapture(paths: str | Iterable[str]) -> Iterator[capturedDelivery]:
+    """Read the deliveries recorded in capture files, in the order of the files.
+    Files left incomplete by a crash are read up to their last complete record.
+
+    Args:
+        paths (str | Iterable[str]): Capture files, or a directory holding them.
+
+    Returns:
+        Iterator[capturedDelivery]: The deliveries.
+    """
+    if isinstance(paths, str):
+        if os.path.isdir(paths):
+            paths = [os.path.join(paths, name) for name in sorted(os.listdir(paths)) if name.endswith(".jsonl.gz")]
+        else:
+            paths = [paths]
+    for path in paths:
+        with gzip.open(path, "rb") as f:
+            try:
+                for line in f:
+                    try:
+                        entry: dict[str, Any] = json.loads(line)
+                    except ValueError: # a record cut short
+                        break
+                    yield capturedDelivery(entry["time"], entry["event"], entry["headers"], b64decode(entry["body"]))
+            except (EOFError, gzip.BadGzipFile):
+                pass
@@ -0,0 +1,186 @@
+from hashlib import sha256
+from threading import get_ident
+from time import monotonic, sleep, time
+from typing import Any, Callable
+import json
+import os
+try:
+    import fcntl
+except ImportError: # file locks are only available on POSIX systems
+    fcntl = None
+
+class fileLock:
+    """An exclusive advisory lock on a file, shared by all processes and threads of a host that open the same path.
+    The lock is released by the kernel if its holder dies, so a crashed worker never leaves a stale lock behind."""
+
+    def __init__(self, path: str):
+        """Initialize the lock. The file is created when the lock is first acquired.
+
+        Args:
+            path (str): Path to the lock file.
+
+        Raises:
+            OSError: If file locks aren't supported on this system.
+        """
+        if fcntl is None:
+            raise OSError("File locks require a POSIX system")
+        self.path = path
+        self.fd: int | None = None
+
+    def acquire(self, blocking: bool = True, timeout: float | None = None) -> bool:
+        """Acquire the lock.
+
+        Args:
+            blocking (bool, optional): Whether to wait for the lock. Defaults to True.
+            timeout (float | None, optional): Maximum number of seconds to wait for the lock. Defaults to None, which waits forever.
+
+        Returns:
+            bool: True if the lock was acquired.
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if blocking and timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                deadline = monotonic() + (timeout or 0.0)
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if not blocking or monotonic() >= deadline:
+                            os.close(fd)
+                            return False
+                        sleep(0.01)
+        except BaseException:
+            os.close(fd)
+            raise
+        self.fd = fd
+        return True
+
+    def release(self) -> None:
+        """Release the lock."""
+        fd = self.fd
+        self.fd = None
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def __enter__(self) -> "fileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.release()
+
+def writeAtomically(path: str, content: dict[str, Any]) -> None:
+    """Replace a JSON file in a single step, so that readers never see it half written."""
+    temporary = f"{path}.{os.getpid()}.{get_ident()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(content, f, default=dict) # event views are mappings
+    os.replace(temporary, path)
+
+def readJson(path: str) -> dict[str, Any] | None:
+    """Read a JSON file, returning None if it doesn't exist or is damaged."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+class workerCoordinator:
+    """Makes sure work on a repository is done by exactly one worker at a time across all the processes of a host, for example gunicorn workers or replicas sharing a volume.
+    Workers synchronize through lock and state files in a shared directory, so no external service is needed.
+    The worker holding the lock of a repository is its leader. Other workers either wait for the lock and reuse the result of the leader if it already handled the same commit, or hand their delivery over to the leader and return right away."""
+
+    def __init__(self, directory: str, wait: bool = True, timeout: float | None = None):
+        """Initialize the coordinator.
+
+        Args:
+            directory (str): Directory holding the lock and state files, created if necessary. Must be shared by all the workers.
+            wait (bool, optional): Whether workers wait for the leader to finish. If False a delivery arriving while another worker holds the lock is left for that worker to process next, and 202 is returned. Defaults to True.
+            timeout (float | None, optional): Maximum number of seconds a worker waits for the lock, after which 503 is returned. Defaults to None, which waits forever.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.wait = wait
+        self.timeout = timeout
+
+    def paths(self, key: Any) -> tuple[str, str, str]:
+        """Get the paths of the lock, result and pending delivery files of a key."""
+        name = sha256(str(key).encode("utf-8")).hexdigest()[:32]
+        base = os.path.join(self.directory, name)
+        return f"{base}.lock", f"{base}.result", f"{base}.pending"
+
+    def run(self, key: Any, target: str | None, data: dict[str, Any], function: Callable[[dict[str, Any]], tuple[int, str]]) -> tuple[int, str]:
+        """Process a delivery while holding the lock of a key.
+
+        Args:
+            key (Any): Key identifying what the delivery works on, like a checkout. Its string representation must be the same in all workers.
+            target (str | None): The commit the delivery points to. If the last result for the key was for the same commit, that result is returned instead of processing the delivery again.
+            data (dict[str, Any]): The webhook data.
+            function (Callable[[dict[str, Any]], tuple[int, str]]): Processes the webhook data, returning a status code and message.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        lockPath, resultPath, pendingPath = self.paths(key)
+        lock = fileLock(lockPath)
+        if self.wait:
+            if not lock.acquire(timeout=self.timeout):
+                return 503, "Timed out waiting for another worker"
+            try:
+                return self.lead(target, data, function, resultPath)
+            finally:
+                lock.release()
+                self.drain(lock, function, resultPath, pendingPath)
+        writeAtomically(pendingPath, {"target": target, "data": data})
+        if not lock.acquire(blocking=False):
+            return 202, "Handed over to another worker"
+        try:
+            pending = self.takePending(pendingPath)
+            ret = self.lead(pending["target"], pending["data"], function, resultPath) if pending is not None else (200, "Handled by another worker")
+        finally:
+            lock.release()
+        self.drain(lock, function, resultPath, pendingPath)
+        return ret
+
+    def lead(self, target: str | None, data: dict[str, Any], function: Callable[[dict[str, Any]], tuple[int, str]], resultPath: str) -> tuple[int, str]:
+        """Process a delivery as the leader, unless the last result already covers it. Must be called holding the lock."""
+        last = readJson(resultPath)
+        if target is not None and last is not None and last["target"] == target and last["code"] < 500:
+            return last["code"], last["message"]
+        code, message = function(data)
+        writeAtomically(resultPath, {"target": target, "code": code, "message": message, "finished": time(), "pid": os.getpid()})
+        return code, message
+
+    def drain(self, lock: fileLock, function: Callable[[dict[str, Any]], tuple[int, str]], resultPath: str, pendingPath: str) -> None:
+        """Process deliveries handed over while the lock was held, unless another worker took the lock in the meantime."""
+        while os.path.exists(pendingPath) and lock.acquire(blocking=False):
+            try:
+                pending = self.takePending(pendingPath)
+                if pending is not None:
+                    self.lead(pending["target"], pending["data"], function, resultPath)
+            finally:
+                lock.release()
+
+    def takePending(self, pendingPath: str) -> dict[str, Any] | None:
+        """Read and remove the delivery handed over to the leader. Must be called holding the lock."""
+        claimed = f"{pendingPath}.{os.getpid()}.{get_ident()}"
+        try:
+            os.replace(pendingPath, claimed) # deliveries handed over from now on create a new file
+        except FileNotFoundError:
+            return None
+        pending = readJson(claimed)
+        os.remove(claimed)
+        return pending
+
+    def result(self, key: Any) -> dict[str, Any] | None:
+        """Get the last result recorded for a key.
+
+        Args:
+            key (Any): The key.
+
+        Returns:
+            dict[str, Any] | None: The commit, status code, message, finish time and process id of the worker, or None if nothing was recorded.
+        """
+        return readJson(self.paths(key)[1])
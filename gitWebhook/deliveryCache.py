@@ -0,0 +1,106 @@
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import sqlite3
+
+class deliveryCache:
+    """A bounded in memory set of recently seen webhook delivery ids, with entries expiring after a time to live.
+    Ids are forgotten in the order they were added (first in, first out) once they expire or the cache is full. Seeing a duplicate doesn't refresh its id."""
+
+    def __init__(self, maxSize: int = 10000, ttl: float = 3600.0):
+        """Initialize the cache.
+
+        Args:
+            maxSize (int, optional): Maximum number of remembered delivery ids. The oldest ids are forgotten first. Defaults to 10000.
+            ttl (float, optional): Seconds after which a delivery id is forgotten. Defaults to 3600.0.
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.entries: OrderedDict[str, float] = OrderedDict()
+        self.lock = Lock()
+
+    def add(self, deliveryId: str) -> bool:
+        """Remember a delivery id.
+
+        Args:
+            deliveryId (str): The delivery id.
+
+        Returns:
+            bool: True if the id wasn't seen within the time to live, False if the delivery is a duplicate.
+        """
+        now = time()
+        with self.lock:
+            while self.entries:
+                oldest, expires = next(iter(self.entries.items()))
+                if expires > now:
+                    break
+                del self.entries[oldest]
+            if deliveryId in self.entries:
+                return False
+            self.entries[deliveryId] = now + self.ttl
+            while len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+            return True
+
+    def discard(self, deliveryId: str) -> None:
+        """Forget a delivery id, so that a redelivery will be processed again.
+
+        Args:
+            deliveryId (str): The delivery id.
+        """
+        with self.lock:
+            self.entries.pop(deliveryId, None)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+class sqliteDeliveryCache(deliveryCache):
+    """A deliveryCache stored in an SQLite database, so that it can be shared between processes, for example gunicorn workers."""
+
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path: str, maxSize: int = 10000, ttl: float = 3600.0):
+        """Initialize the cache, creating the database if necessary.
+
+        Args:
+            path (str): Path to the SQLite database file. Every process should use the same path.
+            maxSize (int, optional): Maximum number of remembered delivery ids. Enforced periodically. Defaults to 10000.
+            ttl (float, optional): Seconds after which a delivery id is forgotten. Defaults to 3600.0.
+        """
+        super().__init__(maxSize, ttl)
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.additions = 0
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS deliveries (id TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS deliveriesExpires ON deliveries (expires)")
+
+    def add(self, deliveryId: str) -> bool:
+        now = time()
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM deliveries WHERE id = ? AND expires <= ?", (deliveryId, now))
+            cursor = self.connection.execute("INSERT OR IGNORE INTO deliveries (id, expires) VALUES (?, ?)", (deliveryId, now + self.ttl))
+            added = cursor.rowcount == 1
+            self.additions += 1
+            if self.additions % self.PRUNE_INTERVAL == 0:
+                self.prune(now)
+        return added
+
+    def prune(self, now: float) -> None:
+        """Remove expired entries and the oldest entries over the size limit. Must be called inside a transaction."""
+        self.connection.execute("DELETE FROM deliveries WHERE expires <= ?", (now,))
+        self.connection.execute("DELETE FROM deliveries WHERE id IN (SELECT id FROM deliveries ORDER BY expires DESC LIMIT -1 OFFSET ?)", (self.maxSize,))
+
+    def discard(self, deliveryId: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM deliveries WHERE id = ?", (deliveryId,))
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM deliveries WHERE expires > ?", (time(),)).fetchone()[0]
+
+    def close(self) -> None:
+        """Close the database connection."""
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,233 @@
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+from time import time
+from typing import Any, Iterator
+from uuid import uuid4
+from .coordination import fileLock
+import os
+import sqlite3
+
+class journalEntry:
+    """A delivery stored in a deliveryJournal."""
+
+    def __init__(self, seq: int, deliveryId: str | None, event: str | None, body: bytes, received: float):
+        self.seq = seq
+        self.deliveryId = deliveryId
+        self.event = event
+        self.body = body
+        self.received = received
+
+class journalWrite:
+    """A statement waiting for the journal writer thread to commit it."""
+
+    def __init__(self, sql: str, parameters: tuple[Any, ...]):
+        self.sql = sql
+        self.parameters = parameters
+        self.done = Event()
+        self.result: int | None = None
+        self.error: Exception | None = None
+
+class deliveryJournal:
+    """An append-only journal of verified deliveries stored in an SQLite database in WAL mode.
+    Writes are committed by a single writer thread in groups, so that a single fsync makes all deliveries arriving in the meantime durable.
+    Deliveries without a recorded completion are those that were interrupted, for example by a restart, and can be replayed.
+    Several worker processes of a host may share a journal. Every journal instance owns the deliveries it appends, and holds a file lock for as long as it is open, so that unfinished deliveries are only claimed by another worker once their owner is gone."""
+
+    def __init__(self, path: str, maxBatch: int = 256):
+        """Open the journal, creating the database if necessary.
+
+        Args:
+            path (str): Path to the SQLite database file.
+            maxBatch (int, optional): Maximum number of writes committed at once. Defaults to 256.
+        """
+        self.path = path
+        self.maxBatch = maxBatch
+        self.owner = uuid4().hex
+        try:
+            self.ownerLock: fileLock | None = fileLock(self.lockPath(self.owner))
+            self.ownerLock.acquire()
+        except OSError: # without file locks a journal can't tell whether other owners are alive, and must not be shared
+            self.ownerLock = None
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.lock = Lock()
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=FULL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS deliveries (seq INTEGER PRIMARY KEY AUTOINCREMENT, deliveryId TEXT, event TEXT, body BLOB NOT NULL, received REAL NOT NULL, owner TEXT)")
+            if "owner" not in {row[1] for row in self.connection.execute("PRAGMA table_info(deliveries)")}:
+                self.connection.execute("ALTER TABLE deliveries ADD COLUMN owner TEXT")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS deliveriesReceived ON deliveries (received)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS completions (seq INTEGER NOT NULL, code INTEGER NOT NULL, message TEXT, finished REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS completionsSeq ON completions (seq)")
+        self.queue: Queue[journalWrite | None] = Queue()
+        self.writer = Thread(target=self.run, name="deliveryJournal", daemon=True)
+        self.writer.start()
+
+    def lockPath(self, owner: str) -> str:
+        """Get the path of the lock file an owner holds while it is alive."""
+        return f"{self.path}.{owner}.lock"
+
+    def ownerGone(self, owner: str | None) -> bool:
+        """Check whether the owner of deliveries closed its journal or died, removing its stale lock file if so."""
+        if owner is None or self.ownerLock is None:
+            return True
+        try:
+            lock = fileLock(self.lockPath(owner))
+        except OSError:
+            return True
+        if not os.path.exists(lock.path):
+            return True
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            os.remove(lock.path)
+        except FileNotFoundError:
+            pass
+        lock.release()
+        return True
+
+    def run(self) -> None:
+        """Commit queued writes in groups until the journal is closed."""
+        stopping = False
+        while not stopping:
+            write = self.queue.get()
+            if write is None:
+                break
+            batch = [write]
+            while len(batch) < self.maxBatch:
+                try:
+                    write = self.queue.get_nowait()
+                except Empty:
+                    break
+                if write is None:
+                    stopping = True
+                    break
+                batch.append(write)
+            self.commit(batch)
+
+    def commit(self, batch: list[journalWrite]) -> None:
+        """Execute writes in a single transaction and wake up the threads waiting for them."""
+        try:
+            with self.lock, self.connection:
+                for write in batch:
+                    write.result = self.connection.execute(write.sql, write.parameters).lastrowid
+        except sqlite3.Error as e:
+            for write in batch:
+                write.error = e
+        for write in batch:
+            write.done.set()
+
+    def write(self, sql: str, parameters: tuple[Any, ...], wait: bool = True) -> int | None:
+        """Queue a write for the writer thread.
+
+        Args:
+            sql (str): The statement.
+            parameters (tuple[Any, ...]): Its parameters.
+            wait (bool, optional): Whether to wait until the write is durable. Defaults to True.
+
+        Raises:
+            sqlite3.Error: If the write failed and wait is True.
+
+        Returns:
+            int | None: The id of the inserted row if wait is True.
+        """
+        write = journalWrite(sql, parameters)
+        self.queue.put(write)
+        if not wait:
+            return None
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def append(self, deliveryId: str | None, event: str | None, body: bytes | bytearray) -> int:
+        """Durably store a delivery, waiting for it to be committed.
+
+        Args:
+            deliveryId (str | None): The delivery id, if the git app sent one.
+            event (str | None): The event type.
+            body (bytes | bytearray): The raw request body.
+
+        Returns:
+            int: The sequence number of the entry.
+        """
+        return self.write("INSERT INTO deliveries (deliveryId, event, body, received, owner) VALUES (?, ?, ?, ?, ?)", (deliveryId, event, bytes(body), time(), self.owner))
+
+    def complete(self, seq: int, code: int, message: str, wait: bool = False) -> None:
+        """Record that a delivery was processed.
+        By default this doesn't wait for the record to be durable, so a delivery may be replayed after a crash even though it was processed.
+
+        Args:
+            seq (int): The sequence number of the entry.
+            code (int): The status code processing resulted in.
+            message (str): The message processing resulted in.
+            wait (bool, optional): Whether to wait until the record is durable. Defaults to False.
+        """
+        self.write("INSERT INTO completions (seq, code, message, finished) VALUES (?, ?, ?, ?)", (seq, code, message, time()), wait)
+
+    def flush(self) -> None:
+        """Wait until all queued writes are committed."""
+        self.write("SELECT 1", ())
+
+    def query(self, sql: str, parameters: tuple[Any, ...] = ()) -> Iterator[journalEntry]:
+        """Run a query selecting entries."""
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        for row in rows:
+            yield journalEntry(*row)
+
+    def unfinished(self) -> list[journalEntry]:
+        """Get the entries that have no recorded completion, oldest first."""
+        return list(self.query("SELECT seq, deliveryId, event, body, received FROM deliveries d WHERE NOT EXISTS (SELECT 1 FROM completions c WHERE c.seq = d.seq) ORDER BY seq"))
+
+    def claimUnfinished(self) -> list[journalEntry]:
+        """Take over the unfinished entries of owners that are gone, and get them, oldest first.
+        Entries still owned by another open journal, for example one being processed by another worker, are left alone.
+
+        Returns:
+            list[journalEntry]: The claimed entries.
+        """
+        with self.lock:
+            owners = [row[0] for row in self.connection.execute("SELECT DISTINCT owner FROM deliveries d WHERE NOT EXISTS (SELECT 1 FROM completions c WHERE c.seq = d.seq) AND (owner IS NULL OR owner != ?)", (self.owner,))]
+        claimed = []
+        for owner in owners:
+            if not self.ownerGone(owner):
+                continue
+            with self.lock, self.connection:
+                self.connection.execute("BEGIN IMMEDIATE") # other workers can't claim the same entries in between
+                rows = self.connection.execute("SELECT seq, deliveryId, event, body, received FROM deliveries WHERE owner IS ? AND NOT EXISTS (SELECT 1 FROM completions c WHERE c.seq = deliveries.seq)", (owner,)).fetchall()
+                self.connection.execute("UPDATE deliveries SET owner = ? WHERE owner IS ? AND NOT EXISTS (SELECT 1 FROM completions c WHERE c.seq = deliveries.seq)", (self.owner, owner))
+            claimed.extend(journalEntry(*row) for row in rows)
+        return sorted(claimed, key=lambda entry: entry.seq)
+
+    def entries(self, since: float | None = None, until: float | None = None, event: str | None = None) -> list[journalEntry]:
+        """Get stored entries, oldest first.
+
+        Args:
+            since (float | None, optional): Only entries received at or after this UNIX timestamp. Defaults to None.
+            until (float | None, optional): Only entries received before this UNIX timestamp. Defaults to None.
+            event (str | None, optional): Only entries of this event type. Defaults to None.
+
+        Returns:
+            list[journalEntry]: The entries.
+        """
+        return list(self.query("SELECT seq, deliveryId, event, body, received FROM deliveries WHERE received >= ? AND received < ? AND (? IS NULL OR event = ?) ORDER BY seq", (since if since is not None else float("-inf"), until if until is not None else float("inf"), event, event)))
+
+    def get(self, seq: int) -> journalEntry | None:
+        """Get a single entry by its sequence number."""
+        return next(self.query("SELECT seq, deliveryId, event, body, received FROM deliveries WHERE seq = ?", (seq,)), None)
+
+    def prune(self, before: float) -> None:
+        """Remove completed entries received before a UNIX timestamp."""
+        self.write("DELETE FROM deliveries WHERE received < ? AND EXISTS (SELECT 1 FROM completions c WHERE c.seq = deliveries.seq)", (before,))
+        self.write("DELETE FROM completions WHERE seq NOT IN (SELECT seq FROM deliveries)", ())
+
+    def close(self) -> None:
+        """Commit the queued writes and close the database."""
+        self.queue.put(None)
+        self.writer.join()
+        with self.lock:
+            self.connection.close()
+        if self.ownerLock is not None:
+            os.remove(self.ownerLock.path)
+            self.ownerLock.release()
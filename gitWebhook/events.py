@@ -0,0 +1,336 @@
+from collections.abc import Mapping
+from json import JSONDecoder
+from json.decoder import WHITESPACE, scanstring
+from typing import Any, Iterator
+from .payload import getRepositoryName, getRef, getAfter
+
+decodeValue = JSONDecoder().scan_once
+"""Decodes the JSON value starting at an offset of a string, returning it together with the offset of its end."""
+
+skipValue = JSONDecoder(object_pairs_hook=lambda pairs: None).scan_once
+"""Finds the end of the JSON value starting at an offset of a string, discarding objects as soon as they are parsed so that skipping a value takes next to no memory."""
+
+class lazyObject(Mapping):
+    """A read only view of a JSON object within a request body, decoding each member only when it is first accessed.
+    Nested objects are views themselves, so members nobody reads are never turned into Python objects."""
+
+    __slots__ = ("text", "start", "members", "values")
+
+    def __init__(self, text: str, start: int = 0):
+        """Create a view of a JSON object.
+
+        Args:
+            text (str): The JSON text.
+            start (int, optional): Offset of the object within the text. Defaults to 0.
+        """
+        self.text = text
+        self.start = start
+        self.members: dict[str, int] | None = None
+        self.values: dict[str, Any] = {}
+
+    def index(self) -> dict[str, int]:
+        """Find the offsets of the values of all members, skipping over the values without keeping them.
+
+        Raises:
+            ValueError: If the object is malformed.
+
+        Returns:
+            dict[str, int]: Offsets of the values, keyed by member name.
+        """
+        if self.members is None:
+            self.members = self.scan()[0]
+        return self.members
+
+    def scan(self) -> tuple[dict[str, int], int]:
+        """Parse the object, finding the offsets of the values of its members and its end."""
+        text = self.text
+        members = {}
+        try:
+            position = WHITESPACE.match(text, self.start + 1).end()
+            if text[position] == "}":
+                return members, position + 1
+            while True:
+                if text[position] != '"':
+                    raise ValueError(f"Expected a member name at {position}")
+                key, position = scanstring(text, position + 1)
+                position = WHITESPACE.match(text, position).end()
+                if text[position] != ":":
+                    raise ValueError(f"Expected : at {position}")
+                position = WHITESPACE.match(text, position + 1).end()
+                members[key] = position
+                _, position = skipValue(text, position)
+                position = WHITESPACE.match(text, position).end()
+                if text[position] == "}":
+                    return members, position + 1
+                if text[position] != ",":
+                    raise ValueError(f"Expected , or }} at {position}")
+                position = WHITESPACE.match(text, position + 1).end()
+        except (IndexError, StopIteration):
+            raise ValueError("Unterminated JSON object")
+
+    def __getitem__(self, key: str) -> Any:
+        try:
+            return self.values[key]
+        except KeyError:
+            pass
+        position = self.index()[key]
+        if self.text[position] == "{":
+            value = lazyObject(self.text, position)
+        else:
+            value = decodeValue(self.text, position)[0]
+        self.values[key] = value
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index())
+
+    def __len__(self) -> int:
+        return len(self.index())
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.index()
+
+    def __repr__(self) -> str:
+        return f"lazyObject({list(self.index())!r})"
+
+    def toDict(self) -> dict[str, Any]:
+        """Decode the whole object."""
+        return decodeValue(self.text, self.start)[0]
+
+def parseObject(body: bytes | bytearray | str) -> lazyObject:
+    """Check that a request body is a complete JSON object and find its members, without decoding them.
+
+    Args:
+        body (bytes | bytearray | str): The request body.
+
+    Raises:
+        ValueError: If the body isn't a JSON object.
+
+    Returns:
+        lazyObject: The view of the object.
+    """
+    text = body if isinstance(body, str) else body.decode("utf-8")
+    start = WHITESPACE.match(text).end()
+    if text[start:start + 1] != "{":
+        raise ValueError("Not a JSON object")
+    view = lazyObject(text, start)
+    view.members, end = view.scan()
+    if WHITESPACE.match(text, end).end() != len(text):
+        raise ValueError(f"Extra data at {end}")
+    return view
+
+class webhookEvent(Mapping):
+    """A webhook payload, which can be used just like the dict of the decoded payload, decoded lazily from the raw request body.
+    Subclasses add typed properties that are the same for GitHub, GitLab and Gitea payloads."""
+
+    __slots__ = ("event", "payload")
+
+    def __init__(self, event: str | None, payload: Mapping[str, Any]):
+        """Wrap a payload.
+
+        Args:
+            event (str | None): The event type.
+            payload (Mapping[str, Any]): The payload, usually a lazyObject.
+        """
+        self.event = event
+        self.payload = payload
+
+    def __getitem__(self, key: str) -> Any:
+        return self.payload[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.payload)
+
+    def __len__(self) -> int:
+        return len(self.payload)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.payload
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.event!r}, {self.payload!r})"
+
+    def toDict(self) -> dict[str, Any]:
+        """Get the fully decoded payload, for code that needs an actual dict."""
+        if isinstance(self.payload, lazyObject):
+            return self.payload.toDict()
+        return dict(self.payload)
+
+    @property
+    def repository(self) -> str | None:
+        """The full name of the repository (owner/name)."""
+        return getRepositoryName(self.payload)
+
+    @property
+    def gitlab(self) -> bool:
+        """Whether the payload was sent by GitLab."""
+        return "object_kind" in self.payload
+
+    def attributes(self) -> Mapping[str, Any]:
+        """Get the object_attributes member of a GitLab payload, or an empty mapping."""
+        attributes = self.payload.get("object_attributes")
+        return attributes if isinstance(attributes, Mapping) else {}
+
+class pushEvent(webhookEvent):
+    """A push of a branch or tag."""
+
+    __slots__ = ()
+
+    @property
+    def ref(self) -> str | None:
+        """The full ref that was pushed, for example refs/heads/main."""
+        return getRef(self.payload)
+
+    @property
+    def branch(self) -> str | None:
+        """The name of the pushed branch, or None if a tag was pushed."""
+        ref = self.ref
+        if ref is None or not ref.startswith("refs/heads/"):
+            return None
+        return ref[len("refs/heads/"):]
+
+    @property
+    def before(self) -> str | None:
+        """The SHA the ref pointed to before the push."""
+        return self.payload.get("before")
+
+    @property
+    def after(self) -> str | None:
+        """The SHA the ref points to after the push, or None if it was deleted."""
+        return getAfter(self.payload)
+
+    @property
+    def commits(self) -> list[Mapping[str, Any]]:
+        """The pushed commits, as listed in the payload."""
+        return self.payload.get("commits") or []
+
+GITLAB_ACTIONS = {"open": "opened", "reopen": "reopened", "close": "closed", "merge": "closed", "update": "synchronize"}
+"""GitLab merge request actions and the GitHub pull request actions they correspond to."""
+
+GITEA_ACTIONS = {"synchronized": "synchronize", "label_updated": "labeled", "label_cleared": "unlabeled"}
+"""Gitea pull request actions and the GitHub pull request actions they correspond to. GitHub never sends these names, so they are mapped without telling the two apart."""
+
+class pullRequestEvent(webhookEvent):
+    """A change of a pull request, or a GitLab merge request."""
+
+    __slots__ = ()
+
+    def pullRequest(self) -> Mapping[str, Any]:
+        """Get the pull_request member of a GitHub or Gitea payload, or an empty mapping."""
+        pullRequest = self.payload.get("pull_request")
+        return pullRequest if isinstance(pullRequest, Mapping) else {}
+
+    @property
+    def action(self) -> str | None:
+        """What happened, named like GitHub does, for example opened, closed or synchronize."""
+        if self.gitlab:
+            action = self.attributes().get("action")
+            return GITLAB_ACTIONS.get(action, action)
+        action = self.payload.get("action")
+        return GITEA_ACTIONS.get(action, action)
+
+    @property
+    def number(self) -> int | None:
+        """The number of the pull request within its repository."""
+        if self.gitlab:
+            return self.attributes().get("iid")
+        return self.payload.get("number")
+
+    @property
+    def title(self) -> str | None:
+        """The title of the pull request."""
+        if self.gitlab:
+            return self.attributes().get("title")
+        return self.pullRequest().get("title")
+
+    @property
+    def sourceBranch(self) -> str | None:
+        """The branch that is to be merged."""
+        if self.gitlab:
+            return self.attributes().get("source_branch")
+        return (self.pullRequest().get("head") or {}).get("ref")
+
+    @property
+    def targetBranch(self) -> str | None:
+        """The branch that is merged into."""
+        if self.gitlab:
+            return self.attributes().get("target_branch")
+        return (self.pullRequest().get("base") or {}).get("ref")
+
+    @property
+    def headSha(self) -> str | None:
+        """The SHA of the latest commit of the pull request."""
+        if self.gitlab:
+            return (self.attributes().get("last_commit") or {}).get("id")
+        return (self.pullRequest().get("head") or {}).get("sha")
+
+    @property
+    def merged(self) -> bool:
+        """Whether the pull request was merged."""
+        if self.gitlab:
+            return self.attributes().get("state") == "merged"
+        return bool(self.pullRequest().get("merged"))
+
+    @property
+    def url(self) -> str | None:
+        """The web page of the pull request."""
+        if self.gitlab:
+            return self.attributes().get("url")
+        return self.pullRequest().get("html_url")
+
+GITHUB_STATUSES = {"failure": "failed", "cancelled": "canceled", "in_progress": "running", "queued": "pending"}
+"""GitHub workflow run conclusions and statuses and the GitLab pipeline statuses they correspond to."""
+
+class pipelineEvent(webhookEvent):
+    """A change of a GitLab pipeline, or a GitHub or Gitea workflow run."""
+
+    __slots__ = ()
+
+    def run(self) -> Mapping[str, Any]:
+        """Get the object describing the pipeline or workflow run."""
+        if self.gitlab:
+            return self.attributes()
+        run = self.payload.get("workflow_run")
+        return run if isinstance(run, Mapping) else {}
+
+    @property
+    def id(self) -> int | None:
+        """The id of the pipeline or workflow run."""
+        return self.run().get("id")
+
+    @property
+    def branch(self) -> str | None:
+        """The branch the pipeline runs for."""
+        return self.run().get("ref" if self.gitlab else "head_branch")
+
+    @property
+    def sha(self) -> str | None:
+        """The SHA of the commit the pipeline runs for."""
+        return self.run().get("sha" if self.gitlab else "head_sha")
+
+    @property
+    def status(self) -> str | None:
+        """The status named like GitLab does, for example pending, running, success or failed."""
+        run = self.run()
+        if self.gitlab:
+            return run.get("status")
+        status = run.get("conclusion") or run.get("status")
+        return GITHUB_STATUSES.get(status, status)
+
+EVENT_TYPES: dict[str, type[webhookEvent]] = {"push": pushEvent, "tag_push": pushEvent, "pull_request": pullRequestEvent, "merge_request": pullRequestEvent, "pipeline": pipelineEvent, "workflow_run": pipelineEvent}
+"""The event view class used for each event type. Other events are wrapped in a plain webhookEvent."""
+
+def eventView(event: str | None, body: bytes | bytearray) -> webhookEvent:
+    """Wrap a raw request body in the typed view of its event type, without decoding it.
+
+    Args:
+        event (str | None): The normalized event type, as returned by getEvent.
+        body (bytes | bytearray): The raw request body.
+
+    Raises:
+        ValueError: If the body isn't a JSON object.
+
+    Returns:
+        webhookEvent: The view.
+    """
+    return EVENT_TYPES.get(event, webhookEvent)(event, parseObject(body))
@@ -1,12 +1,71 @@
 from .webhook import webhookBlueprint
+from .structuredLog import lazyPayload
+from .router import eventRouter
+from .batching import batchConsumer
 from typing import Callable, Any
 from logging import Logger
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from contextvars import ContextVar
+from inspect import iscoroutinefunction
+from threading import Event, Lock
+from time import monotonic, perf_counter
+import asyncio
 import json
 
+routedFunctions: ContextVar[tuple[Callable[[dict[str, Any]], bool | Any], ...]] = ContextVar("routedFunctions", default=())
+"""The functions registered using on that match the delivery being processed, handed from dispatchWebhook to processWebhook."""
+
+def summarizeResults(results: list[tuple[Callable[[dict[str, Any]], bool | Any], Any, Exception | None]], log: Logger | None = None) -> tuple[int, str]:
+    """Turn the results of webhook processing functions into a status code and message.
+    If any function returned False or raised an exception, the status code is 400.
+    If any function returned an invalid type, the status code is 500.
+    Otherwise, the status code is 200.
+
+    Args:
+        results (list[tuple[Callable, Any, Exception | None]]): Each function with its return value and the exception it raised.
+        log (Logger | None, optional): Optional logger. Defaults to None.
+
+    Returns:
+        tuple[int, str]: The status code and message.
+    """
+    success = True
+    output:dict[str, str | bool] = {}
+    for function, res, e in results:
+        if e is not None:
+            output[function.__name__] = str(e)
+            if log is not None:
+                log.error("Function %s raised an exception: %s", function.__name__, e)
+            success = False
+            continue
+        if isinstance(res, bool):
+            if not res:
+                if log is not None:
+                    log.error("Function %s returned false", function.__name__)
+                success = False
+                output[function.__name__] = res
+            else:
+                if log is not None:
+                    log.debug("Function %s returned true", function.__name__)
+                output[function.__name__] = res
+        else:
+            if log is not None:
+                log.debug("Function %s returned a string", function.__name__)
+            try:
+                output[function.__name__] = str(res)
+            except Exception as e:
+                if log is not None:
+                    log.error("Function %s returned an invalid type", function.__name__)
+                return 500, f"Function {function.__name__} returned an invalid type"
+    if success:
+        return 200, str(output)
+    else:
+        return 400, json.dumps(output)
+
 class functionWebhookBlueprint(webhookBlueprint):
-    """A subclass of webhookBlueprint that processes the webhook data using a list of functions. The functions should return True if the webhook data is valid, and False otherwise. If the function returns a string, it will be included in the output."""
+    """A subclass of webhookBlueprint that processes the webhook data using a list of functions. The functions should return True if the webhook data is valid, and False otherwise. If the function returns a string, it will be included in the output.
+    Functions may also be coroutine functions, in which case they are ran in their own event loop."""
     
-    def __init__(self, webhookToken: str | None, functions: list[Callable[[dict[str, Any]], bool | Any]], log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | None = None, *args, **kwargs):
+    def __init__(self, webhookToken: str | None, functions: list[Callable[[dict[str, Any]], bool | Any]], log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | None = None, *args, maxWorkers:int | None = None, timeout:float | None = None, timeouts:dict[str, float] | None = None, **kwargs):
         """Initialize the webhook blueprint with a list of functions to process the webhook data.
 
         Args:
@@ -19,10 +78,25 @@ class functionWebhookBlueprint(webhookBlueprint):
             gitea (bool, optional): Whether the blueprint should process webhook requests from Gitea or other requests using basic auth. Defaults to True.
             ipWhitelist (list[str] | None, optional): Optional whitelist that all incoming requests will be checked against. Defaults to None.
             args: Additional arguments to pass to the Blueprint constructor.
+            maxWorkers (int | None, optional): If provided, the functions are ran concurrently on a thread pool of this size instead of one after another. Defaults to None.
+            timeout (float | None, optional): Default number of seconds each function may run for when ran concurrently, counted from when it starts running on the pool. Functions that aren't coroutine functions can't be stopped, and keep their pool thread until they return, counted in leaked. Defaults to None.
+            timeouts (dict[str, float] | None, optional): Per function timeouts, keyed by function name, overriding the default timeout. Defaults to None.
             kwargs: Additional keyword arguments to pass to the Blueprint constructor.
         """
         super().__init__(webhookToken, log, name, github, gitlab, gitea, ipWhitelist, *args, **kwargs)
         self.functions = functions
+        self.executor: ThreadPoolExecutor | None = None
+        self.maxWorkers = maxWorkers
+        self.leaked = 0 # functions still holding a pool thread after timing out
+        self.leakLock = Lock()
+        if maxWorkers is not None:
+            self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix=name)
+        self.timeout = timeout
+        if timeouts is None:
+            timeouts = {}
+        self.timeouts = timeouts
+        self.batchRouter = eventRouter()
+        self.batchConsumers: list[batchConsumer] = []
         
     def processWebhook(self, data: dict[str, Any]) -> tuple[int, str]:
         """Process the webhook data using the list of functions.
@@ -30,46 +104,174 @@ class functionWebhookBlueprint(webhookBlueprint):
         If any function returns an invalid type, the process will return a 500 status code.
         Otherwise, the process will return a 200 status code.
         All function outputs are returned to git as a string.
+        The functions registered using on that match the delivery are called together with the listed ones, so subclasses overriding this method should call it to keep them working.
+        If the blueprint was created with maxWorkers, the functions run concurrently and a function exceeding its timeout counts as having raised an exception.
+        Once every pool thread is held by a function that timed out, deliveries are refused with 503 until one of them returns.
 
         Args:
             data (dict[str, Any]): The webhook data.
 
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        return self.applyFunctions([*self.functions, *routedFunctions.get()], data)
+    
+    def applyFunctions(self, functions: list[Callable[[dict[str, Any]], bool | Any]], data: dict[str, Any]) -> tuple[int, str]:
+        """Process the webhook data using the given functions, as described in processWebhook.
+
+        Args:
+            functions (list[Callable[[dict[str, Any]], bool | Any]]): The functions to call.
+            data (dict[str, Any]): The webhook data.
+
         Returns:
             tuple[int, str]: The status code and message.
         """
         if self.log is not None:
-            self.log.debug(f"Processing webhook: {data}")
-        success = True
-        output:dict[str, str | bool] = {}
-        for function in self.functions:
-            try:
-                res = function(data)
-            except Exception as e:
-                output[function.__name__] = str(e)
-                if self.log is not None:
-                    self.log.error(f"Function {function.__name__} raised an exception: {e}")
-                success = False
-                continue
-            if isinstance(res, bool):
-                if not res:
-                    if self.log is not None:
-                        self.log.error(f"Function {function.__name__} returned false")
-                    success = False
-                    output[function.__name__] = res
-                else:
-                    if self.log is not None:
-                        self.log.debug(f"Function {function.__name__} returned true")
-                    output[function.__name__] = res
-            else:
-                if self.log is not None:
-                    self.log.debug(f"Function {function.__name__} returned a string")
+            self.log.debug("Processing webhook: %s", lazyPayload(data))
+        if self.executor is not None and self.leaked >= self.maxWorkers:
+            if self.log is not None:
+                self.log.error("All %d workers are held by functions that timed out, refusing the delivery", self.leaked)
+            return 503, "All workers are held by functions that timed out"
+        return summarizeResults(self.runFunctions(functions, data), self.log)
+    
+    def runFunctions(self, functions: list[Callable[[dict[str, Any]], bool | Any]], data: dict[str, Any]) -> list[tuple[Callable[[dict[str, Any]], bool | Any], Any, Exception | None]]:
+        """Run functions on the webhook data, either one after another or concurrently.
+
+        Args:
+            functions (list[Callable[[dict[str, Any]], bool | Any]]): The functions to call.
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            list[tuple[Callable, Any, Exception | None]]: Each function with its return value and the exception it raised, in the order of the given functions.
+        """
+        results = []
+        if self.executor is None:
+            for function in functions:
                 try:
-                    output[function.__name__] = str(res)
+                    results.append((function, self.callFunction(function, data, None), None))
                 except Exception as e:
+                    results.append((function, None, e))
+            return results
+        calls = []
+        for function in functions:
+            started: list[float] = []
+            running = Event()
+            calls.append((function, started, running, self.executor.submit(self.startFunction, started, running, function, data, self.getTimeout(function))))
+        for function, started, running, future in calls:
+            timeout = self.getTimeout(function)
+            try:
+                if timeout is None:
+                    results.append((function, future.result(), None))
+                    continue
+                running.wait() # time spent waiting for a pool thread doesn't count
+                results.append((function, future.result(max(0.0, started[0] + timeout - monotonic())), None))
+            except FutureTimeoutError:
+                if not future.done():
+                    with self.leakLock:
+                        self.leaked += 1
+                    future.add_done_callback(self.reclaimThread)
                     if self.log is not None:
-                        self.log.error(f"Function {function.__name__} returned an invalid type")
-                    return 500, f"Function {function.__name__} returned an invalid type"
-        if success:
-            return 200, str(output)
-        else:
-            return 400, json.dumps(output)
+                        self.log.warning("Function %s timed out and holds a worker until it returns", function.__name__)
+                results.append((function, None, TimeoutError(f"Timed out after {timeout} seconds")))
+            except Exception as e:
+                results.append((function, None, e))
+        return results
+    
+    def startFunction(self, started: list[float], running: Event, function: Callable[[dict[str, Any]], bool | Any], data: dict[str, Any], timeout: float | None) -> Any:
+        """Record when a function starts running on a pool thread, then call it."""
+        started.append(monotonic())
+        running.set()
+        return self.callFunction(function, data, timeout)
+    
+    def reclaimThread(self, future: Future) -> None:
+        """Count a function that timed out as no longer holding its pool thread."""
+        with self.leakLock:
+            self.leaked -= 1
+    
+    def callFunction(self, function: Callable[[dict[str, Any]], bool | Any], data: dict[str, Any], timeout: float | None) -> Any:
+        """Call a single function, running coroutine functions to completion in a new event loop.
+
+        Args:
+            function (Callable): The function to call.
+            data (dict[str, Any]): The webhook data.
+            timeout (float | None): Seconds after which a coroutine function is cancelled.
+
+        Returns:
+            Any: The return value of the function.
+        """
+        started = perf_counter()
+        try:
+            if iscoroutinefunction(function):
+                try:
+                    return asyncio.run(asyncio.wait_for(function(data), timeout))
+                except asyncio.TimeoutError:
+                    raise TimeoutError(f"Timed out after {timeout} seconds")
+            return function(data)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe("function_seconds", perf_counter() - started, function=function.__name__)
+    
+    def getTimeout(self, function: Callable[[dict[str, Any]], bool | Any]) -> float | None:
+        """Get the number of seconds a function may run for."""
+        return self.timeouts.get(function.__name__, self.timeout)
+    
+    def batch(self, event:str = "*", ref:str | None = None, repo:str | None = None, maxSize:int = 100, maxDelay:float = 1.0) -> Callable[[Callable[[list[dict[str, Any]]], bool | Any]], Callable[[list[dict[str, Any]]], bool | Any]]:
+        """Decorator registering a batch consumer, a function called with a list of payloads collected over a time and size window instead of once per delivery.
+        Deliveries are acknowledged right away, and failed batches are reported through the log and the batches_total metric.
+        Call flushBatches on shutdown to process the payloads still waiting for their batch.
+
+        Args:
+            event (str, optional): The event type the consumer is limited to. Use * to match all events. Defaults to "*".
+            ref (str | None, optional): Full ref the consumer is limited to, for example refs/heads/main. Defaults to None.
+            repo (str | None, optional): Repository name or shell style pattern the consumer is limited to, for example org/*. Defaults to None.
+            maxSize (int, optional): Maximum number of payloads in a batch. Defaults to 100.
+            maxDelay (float, optional): Maximum number of seconds a payload waits for its batch to fill up. Defaults to 1.0.
+        """
+        def decorator(func:Callable[[list[dict[str, Any]]], bool | Any]) -> Callable[[list[dict[str, Any]]], bool | Any]:
+            consumer = batchConsumer(func, self.callFunction, maxSize, maxDelay, self.getTimeout(func), self.log, self.metrics)
+            self.batchConsumers.append(consumer)
+            self.batchRouter.add(event, consumer, ref, repo)
+            return func
+        return decorator
+    
+    def flushBatches(self, wait:bool = True) -> None:
+        """Process the payloads waiting for their batch without waiting for the batch window to close.
+
+        Args:
+            wait (bool, optional): Whether to wait until the batches are processed. Defaults to True.
+        """
+        futures = [consumer.flush() for consumer in self.batchConsumers]
+        if wait:
+            for future in futures:
+                if future is not None:
+                    future.result()
+    
+    def acceptsEvent(self, event: str | None) -> bool:
+        if self.functions or self.batchRouter.handles(event):
+            return True
+        if self.batchRouter and not self.router:
+            return False # only batched events are handled
+        return super().acceptsEvent(event)
+    
+    def dispatchWebhook(self, event: str | None, data: dict[str, Any]) -> tuple[int, str]:
+        """Process the webhook using processWebhook, which calls the list of functions together with the functions registered using on that match the delivery.
+        The outputs of the registered functions are included in the output just like those of the listed functions.
+        The webhook data is also added to the batches of matching batch consumers.
+
+        Args:
+            event (str | None): The event type, or None if the request didn't specify one.
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        if self.batchRouter:
+            for consumer in self.batchRouter.match(event, data):
+                consumer.add(data)
+        if not self.router:
+            return self.processWebhook(data)
+        token = routedFunctions.set(tuple(self.router.match(event, data)))
+        try:
+            return self.processWebhook(data)
+        finally:
+            routedFunctions.reset(token)
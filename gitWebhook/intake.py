@@ -0,0 +1,64 @@
+from typing import Any, BinaryIO, Callable
+from hmac import HMAC
+from .secretProvider import digestGroup
+import json
+
+try:
+    from orjson import loads as orjsonLoads
+except ImportError: # orjson is an optional dependency
+    orjsonLoads = None
+
+CHUNK_SIZE = 64 * 1024
+
+MAX_BODY_SIZE = 25 * 1024 * 1024 # GitHub caps webhook payloads at 25 MB
+
+jsonLoads: Callable[[bytes | bytearray], Any] = orjsonLoads if orjsonLoads is not None else json.loads
+"""The fastest JSON decoder available, orjson if it is installed and the standard library json otherwise."""
+
+class payloadTooLarge(Exception):
+    """Raised when a request body exceeds the allowed size."""
+
+def readBody(stream: BinaryIO, contentLength: int | None, maxSize: int | None = MAX_BODY_SIZE, digest: HMAC | digestGroup | None = None, chunkSize: int = CHUNK_SIZE) -> bytearray:
+    """Read a request body in chunks into a single buffer, feeding each chunk to an HMAC and enforcing a size limit as it goes.
+    Bodies declaring a length over the limit are rejected without being read.
+
+    Args:
+        stream (BinaryIO): The request input stream.
+        contentLength (int | None): The declared length of the body, or None if it is unknown (chunked encoding).
+        maxSize (int | None, optional): Maximum allowed body size in bytes. Defaults to MAX_BODY_SIZE.
+        digest (HMAC | digestGroup | None, optional): Optional HMAC, or group of HMACs, updated with the body. Defaults to None.
+        chunkSize (int, optional): Number of bytes read at once. Defaults to CHUNK_SIZE.
+
+    Raises:
+        payloadTooLarge: If the body is larger than maxSize.
+
+    Returns:
+        bytearray: The body.
+    """
+    if maxSize is not None and contentLength is not None and contentLength > maxSize:
+        raise payloadTooLarge(f"Declared body size {contentLength} exceeds {maxSize} bytes")
+    if contentLength is not None and hasattr(stream, "readinto"):
+        body = bytearray(contentLength)
+        view = memoryview(body)
+        read = 0
+        while read < contentLength:
+            count = stream.readinto(view[read:read + chunkSize])
+            if not count:
+                break
+            if digest is not None:
+                digest.update(view[read:read + count])
+            read += count
+        view.release()
+        del body[read:]
+        return body
+    body = bytearray()
+    while True:
+        chunk = stream.read(chunkSize)
+        if not chunk:
+            break
+        if maxSize is not None and len(body) + len(chunk) > maxSize:
+            raise payloadTooLarge(f"Body exceeds {maxSize} bytes")
+        if digest is not None:
+            digest.update(chunk)
+        body += chunk
+    return body
@@ -0,0 +1,191 @@
+from ipaddress import ip_address, ip_network, IPv6Address
+from bisect import bisect_right
+from threading import Thread, Event
+from urllib.request import urlopen, Request as UrlRequest
+from logging import Logger
+from typing import Any, Iterable
+import json
+import os
+
+GITHUB_META_URL = "https://api.github.com/meta"
+
+class ipRangeIndex:
+    """An IP address whitelist of individual addresses and IPv4 or IPv6 networks, compiled into sorted integer ranges searched using bisection."""
+
+    def __init__(self, entries: Iterable[str]):
+        """Compile the whitelist.
+        Entries that aren't valid addresses or networks are compared verbatim, like whitelists used to be.
+
+        Args:
+            entries (Iterable[str]): Addresses (192.0.2.1) and networks (192.0.2.0/24, 2001:db8::/32).
+        """
+        ranges: dict[int, list[tuple[int, int]]] = {4: [], 6: []}
+        self.verbatim: set[str] = set()
+        for entry in entries:
+            try:
+                network = ip_network(entry.strip(), strict=False)
+            except ValueError:
+                self.verbatim.add(entry)
+                continue
+            ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+        self.starts: dict[int, list[int]] = {}
+        self.ends: dict[int, list[int]] = {}
+        for version, versionRanges in ranges.items():
+            merged: list[tuple[int, int]] = []
+            for start, end in sorted(versionRanges):
+                if merged and start <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+                else:
+                    merged.append((start, end))
+            self.starts[version] = [start for start, _ in merged]
+            self.ends[version] = [end for _, end in merged]
+
+    def __contains__(self, address: Any) -> bool:
+        if not isinstance(address, str):
+            return False
+        if address in self.verbatim:
+            return True
+        try:
+            parsed = ip_address(address)
+        except ValueError:
+            return False
+        if isinstance(parsed, IPv6Address) and parsed.ipv4_mapped is not None:
+            parsed = parsed.ipv4_mapped
+        value = int(parsed)
+        starts = self.starts[parsed.version]
+        i = bisect_right(starts, value) - 1
+        return i >= 0 and value <= self.ends[parsed.version][i]
+
+    def __len__(self) -> int:
+        return len(self.starts[4]) + len(self.starts[6]) + len(self.verbatim)
+
+def compileWhitelist(whitelist: Any) -> Any:
+    """Compile a list of addresses and networks into an ipRangeIndex. Other whitelist objects, and None, are returned as they are.
+
+    Args:
+        whitelist (Any): A list of addresses and networks, an object supporting the in operator, or None.
+
+    Returns:
+        Any: The compiled whitelist.
+    """
+    if isinstance(whitelist, (list, tuple, set, frozenset)):
+        return ipRangeIndex(whitelist)
+    return whitelist
+
+def forwardedClient(address: str | None, forwarded: str | None, trustedProxies: Any) -> str | None:
+    """Determine the client address of a request that may have passed through trusted reverse proxies.
+    If the request came from a trusted proxy, hops listed in the X-Forwarded-For header are skipped from the right until an untrusted one is found.
+
+    Args:
+        address (str | None): The address the request was received from.
+        forwarded (str | None): The value of the X-Forwarded-For header.
+        trustedProxies (Any): Whitelist of trusted proxies, or None.
+
+    Returns:
+        str | None: The client address.
+    """
+    if trustedProxies is None or address is None or address not in trustedProxies or not forwarded:
+        return address
+    for hop in reversed(forwarded.split(",")):
+        address = hop.strip()
+        if address not in trustedProxies:
+            break
+    return address
+
+class providerMetaWhitelist:
+    """A whitelist built from the ranges a git app publishes in a meta document, like the one at https://api.github.com/meta.
+    The document is reloaded periodically in a background thread, while lookups use the last successfully loaded ranges."""
+
+    def __init__(self, source: str = GITHUB_META_URL, keys: Iterable[str] = ("hooks",), refreshInterval: float | None = 3600.0, cachePath: str | None = None, log: Logger | None = None, timeout: float = 10.0):
+        """Load the meta document and start refreshing it in the background.
+
+        Args:
+            source (str, optional): URL or path to a local file holding the meta document. Defaults to GITHUB_META_URL.
+            keys (Iterable[str], optional): Keys of the document whose ranges are whitelisted. Defaults to ("hooks",).
+            refreshInterval (float | None, optional): Seconds between reloads. If None, the document is only loaded once. Defaults to 3600.0.
+            cachePath (str | None, optional): Optional file the last loaded document is stored in, and which is used on startup until the source has been loaded. Defaults to None.
+            log (Logger | None, optional): Optional logger. Defaults to None.
+            timeout (float, optional): Timeout in seconds for fetching the document from a URL. Defaults to 10.0.
+        """
+        self.source = source
+        self.keys = tuple(keys)
+        self.refreshInterval = refreshInterval
+        self.cachePath = cachePath
+        self.log = log
+        self.timeout = timeout
+        self.index = ipRangeIndex(())
+        self.stopped = Event()
+        self.thread: Thread | None = None
+        if cachePath is not None and os.path.exists(cachePath):
+            try:
+                with open(cachePath, "rb") as f:
+                    self.index = self.compile(json.load(f))
+            except (OSError, ValueError) as e:
+                if self.log is not None:
+                    self.log.error(f"Could not load cached meta document {cachePath}: {e}")
+        cached = len(self.index) > 0
+        if not cached:
+            self.refresh()
+        if refreshInterval is not None or cached:
+            self.thread = Thread(target=self.run, args=(cached,), name="providerMetaWhitelist", daemon=True)
+            self.thread.start()
+
+    def compile(self, document: dict[str, Any]) -> ipRangeIndex:
+        """Compile the ranges of a meta document."""
+        entries = []
+        for key in self.keys:
+            entries.extend(document.get(key, ()))
+        return ipRangeIndex(entries)
+
+    def fetch(self) -> bytes:
+        """Read the raw meta document from the source."""
+        if self.source.startswith(("http://", "https://")):
+            with urlopen(UrlRequest(self.source, headers={"Accept": "application/json"}), timeout=self.timeout) as response:
+                return response.read()
+        with open(self.source, "rb") as f:
+            return f.read()
+
+    def refresh(self) -> bool:
+        """Reload the meta document. On failure the previously loaded ranges are kept.
+
+        Returns:
+            bool: True if the document was loaded.
+        """
+        try:
+            raw = self.fetch()
+            index = self.compile(json.loads(raw))
+        except (OSError, ValueError) as e:
+            if self.log is not None:
+                self.log.error(f"Could not load meta document from {self.source}: {e}")
+            return False
+        self.index = index
+        if self.cachePath is not None:
+            try:
+                with open(self.cachePath, "wb") as f:
+                    f.write(raw)
+            except OSError as e:
+                if self.log is not None:
+                    self.log.error(f"Could not cache meta document in {self.cachePath}: {e}")
+        if self.log is not None:
+            self.log.debug(f"Loaded {len(index)} ranges from {self.source}")
+        return True
+
+    def run(self, immediate: bool = False) -> None:
+        """Refresh the document periodically until stopped.
+
+        Args:
+            immediate (bool, optional): Whether to refresh once before waiting for the first interval. Defaults to False.
+        """
+        if immediate:
+            self.refresh()
+        if self.refreshInterval is None:
+            return
+        while not self.stopped.wait(self.refreshInterval):
+            self.refresh()
+
+    def stop(self) -> None:
+        """Stop refreshing the document."""
+        self.stopped.set()
+
+    def __contains__(self, address: Any) -> bool:
+        return address in self.index
@@ -0,0 +1,202 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Lock, Timer
+from logging import Logger
+from typing import Any, Callable
+from time import time
+from uuid import uuid4
+
+JOB_QUEUED = "queued"
+
+JOB_RUNNING = "running"
+
+JOB_PASSED = "passed"
+
+JOB_FAILED = "failed"
+
+class webhookJob:
+    """A unit of work created from a webhook delivery and executed in the background."""
+
+    def __init__(self, function: Callable[[], tuple[int, str]], key: Any = None):
+        """Initialize a queued job.
+
+        Args:
+            function (Callable[[], tuple[int, str]]): The work to be done. Should return a status code and message just like processWebhook.
+            key (Any, optional): Optional key identifying what the job works on. Jobs with the same key never run concurrently. Defaults to None.
+        """
+        self.id = uuid4().hex
+        self.function = function
+        self.key = key
+        self.coalesced = 0
+        self.status = JOB_QUEUED
+        self.code: int | None = None
+        self.message: str | None = None
+        self.queued = time()
+        self.started: float | None = None
+        self.finished: float | None = None
+
+    def run(self) -> None:
+        """Run the job, recording its result and timings."""
+        self.status = JOB_RUNNING
+        self.started = time()
+        try:
+            self.code, self.message = self.function()
+        except Exception as e:
+            self.code, self.message = 500, str(e)
+        self.finished = time()
+        self.status = JOB_PASSED if self.code < 400 else JOB_FAILED
+
+    def toDict(self) -> dict[str, Any]:
+        """Return a JSON serializable representation of the job.
+
+        Returns:
+            dict[str, Any]: The job id, status, result and timings.
+        """
+        return {
+            "id": self.id,
+            "status": self.status,
+            "coalesced": self.coalesced,
+            "code": self.code,
+            "message": self.message,
+            "queued": self.queued,
+            "started": self.started,
+            "finished": self.finished,
+            "waited": None if self.started is None else self.started - self.queued,
+            "duration": None if self.started is None or self.finished is None else self.finished - self.started,
+        }
+
+class jobQueue:
+    """A bounded thread pool executing webhookJob instances, that remembers a limited history of finished jobs.
+    Jobs submitted with a key are coalesced: while a job for a key is waiting to run, further submissions for that key are merged into it."""
+
+    def __init__(self, maxWorkers: int = 1, maxQueued: int = 100, maxHistory: int = 1000, log: Logger | None = None):
+        """Initialize the job queue.
+
+        Args:
+            maxWorkers (int, optional): Number of threads executing jobs. Defaults to 1.
+            maxQueued (int, optional): Maximum number of jobs that may wait for execution. Defaults to 100.
+            maxHistory (int, optional): Maximum number of jobs remembered for status queries. Defaults to 1000.
+            log (Logger | None, optional): Optional logger. Defaults to None.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix="webhookJob")
+        self.maxQueued = maxQueued
+        self.maxHistory = maxHistory
+        self.log = log
+        self.jobs: OrderedDict[str, webhookJob] = OrderedDict()
+        self.pending = 0
+        self.lock = Lock()
+        self.waiting: dict[Any, webhookJob] = {}
+        self.keyLocks: dict[Any, Lock] = {}
+        self.keyJobs: dict[Any, int] = {}
+        self.timers: dict[str, Timer] = {}
+
+    def submit(self, function: Callable[[], tuple[int, str]], key: Any = None, delay: float = 0.0) -> webhookJob | None:
+        """Queue a new job for execution.
+        If a job with the same key is still waiting to run, its work is replaced with the given function and that job is returned instead.
+
+        Args:
+            function (Callable[[], tuple[int, str]]): The work to be done.
+            key (Any, optional): Optional key used for coalescing and serializing jobs. Defaults to None.
+            delay (float, optional): Seconds to wait before the job becomes runnable, during which submissions with the same key are coalesced into it. Defaults to 0.0.
+
+        Returns:
+            webhookJob | None: The queued job, or None if the queue is full.
+        """
+        with self.lock:
+            if key is not None and key in self.waiting:
+                job = self.waiting[key]
+                job.function = function
+                job.coalesced += 1
+                if self.log is not None:
+                    self.log.debug(f"Coalesced delivery into job {job.id}")
+                return job
+            if self.pending >= self.maxQueued:
+                if self.log is not None:
+                    self.log.warning("Job queue is full, rejecting job")
+                return None
+            self.pending += 1
+            job = webhookJob(function, key)
+            self.jobs[job.id] = job
+            while len(self.jobs) > self.maxHistory:
+                self.jobs.popitem(last=False)
+            if key is not None:
+                self.waiting[key] = job
+                self.keyLocks.setdefault(key, Lock())
+                self.keyJobs[key] = self.keyJobs.get(key, 0) + 1
+        if delay > 0:
+            timer = Timer(delay, self.release, (job,))
+            timer.daemon = True
+            with self.lock:
+                self.timers[job.id] = timer
+            timer.start()
+        else:
+            self.executor.submit(self.execute, job)
+        return job
+
+    def release(self, job: webhookJob) -> None:
+        """Hand a delayed job over to the worker threads once its delay has passed."""
+        with self.lock:
+            if self.timers.pop(job.id, None) is None:
+                return # already released by shutdown
+        self.executor.submit(self.execute, job)
+
+    def execute(self, job: webhookJob) -> None:
+        """Run a job inside a worker thread, after any running job with the same key has finished."""
+        if job.key is None:
+            self.start(job)
+            job.run()
+        else:
+            try:
+                with self.keyLocks[job.key]:
+                    self.start(job)
+                    job.run()
+            finally:
+                self.forgetKey(job.key)
+        if self.log is not None:
+            self.log.info(f"Job {job.id} {job.status} with status code {job.code}")
+
+    def forgetKey(self, key: Any) -> None:
+        """Drop the lock of a key once no job with that key is waiting or running, so that locks don't pile up for every branch ever seen."""
+        with self.lock:
+            self.keyJobs[key] -= 1
+            if self.keyJobs[key] == 0:
+                del self.keyJobs[key]
+                del self.keyLocks[key]
+
+    def start(self, job: webhookJob) -> None:
+        """Mark a job as no longer waiting, so that new submissions with its key create a follow-up job."""
+        with self.lock:
+            self.pending -= 1
+            if job.key is not None and self.waiting.get(job.key) is job:
+                del self.waiting[job.key]
+        if self.log is not None:
+            self.log.debug(f"Running job {job.id}")
+
+    def get(self, jobId: str) -> webhookJob | None:
+        """Get a job by its id.
+
+        Args:
+            jobId (str): The job id.
+
+        Returns:
+            webhookJob | None: The job, or None if it is unknown or has been forgotten.
+        """
+        with self.lock:
+            return self.jobs.get(jobId)
+
+    def shutdown(self, wait: bool = True) -> None:
+        """Stop accepting jobs and release the worker threads.
+
+        Args:
+            wait (bool, optional): Whether to wait for queued jobs to finish. Delayed jobs are run immediately if True, and dropped otherwise. Defaults to True.
+        """
+        with self.lock:
+            timers = self.timers
+            self.timers = {}
+        for timer in timers.values():
+            timer.cancel()
+            if wait:
+                self.executor.submit(self.execute, timer.args[0])
+            elif timer.args[0].key is not None:
+                self.forgetKey(timer.args[0].key)
+        self.executor.shutdown(wait=wait)
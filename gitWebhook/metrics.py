@@ -0,0 +1,177 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Any
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+KNOWN_EVENTS = frozenset((
+    "push", "tag_push", "create", "delete", "ping", "pull_request", "pull_request_review", "pull_request_review_comment", "merge_request", "issues", "issue", "issue_comment", "note",
+    "release", "status", "check_run", "check_suite", "workflow_run", "workflow_job", "pipeline", "job", "build", "deployment", "deployment_status", "wiki_page", "gollum",
+    "repository", "member", "fork", "star", "watch", "emoji", "resource_access_token", "member_hook", "subgroup", "system",
+))
+"""Normalized event types that are counted under their own name. Others are counted as other, so that made up event headers can't create unbounded series."""
+
+def eventLabel(event: str | None) -> str:
+    """Get the metric label of an event type of a verified delivery, one of KNOWN_EVENTS, other or unknown if there was no event header."""
+    if event is None:
+        return "unknown"
+    return event if event in KNOWN_EVENTS else "other"
+
+class histogram:
+    """Distribution of observed values over fixed buckets."""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        """Initialize an empty histogram.
+
+        Args:
+            buckets (tuple[float, ...]): Sorted upper bounds of the buckets. An implicit +Inf bucket follows them.
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        """Add a value to the histogram."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> list[int]:
+        """Get the number of values less than or equal to each bucket bound, including +Inf."""
+        total = 0
+        counts = []
+        for count in self.counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def quantile(self, q: float) -> float | None:
+        """Estimate a quantile by linear interpolation within the bucket it falls into.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float | None: The estimate, or None if nothing was observed.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            if count and total + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - total) / count
+            total += count
+        return self.buckets[-1]
+
+def escapeLabel(value: str) -> str:
+    """Escape a label value for the Prometheus text exposition format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def formatLabels(labels: tuple[tuple[str, str], ...]) -> str:
+    """Format labels for the Prometheus text exposition format."""
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escapeLabel(value)}"' for key, value in labels) + "}"
+
+class webhookMetrics:
+    """Collector of latency histograms and counters recorded by the webhook blueprints, which can be scraped in process or in the Prometheus text format.
+    Blueprints only record metrics when given an instance of this class, so there is next to no overhead otherwise."""
+
+    def __init__(self, prefix: str = "gitwebhook", buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        """Initialize an empty collector.
+
+        Args:
+            prefix (str, optional): Prefix of all metric names in the Prometheus output. Defaults to "gitwebhook".
+            buckets (tuple[float, ...], optional): Histogram bucket bounds in seconds. Defaults to DEFAULT_BUCKETS.
+        """
+        self.prefix = prefix
+        self.buckets = buckets
+        self.histograms: dict[str, dict[tuple[tuple[str, str], ...], histogram]] = {}
+        self.counters: dict[str, dict[tuple[tuple[str, str], ...], float]] = {}
+        self.lock = Lock()
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """Record a value, usually a duration in seconds, in a histogram.
+
+        Args:
+            name (str): The metric name, for example stage_seconds.
+            value (float): The value.
+            labels (Any): Labels distinguishing series of the metric, for example stage="verify".
+        """
+        key = tuple((k, str(v)) for k, v in labels.items())
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = histogram(self.buckets)
+            hist.observe(value)
+
+    def increment(self, name: str, amount: float = 1, **labels: Any) -> None:
+        """Increase a counter.
+
+        Args:
+            name (str): The metric name, for example deliveries_total.
+            amount (float, optional): The amount to increase the counter by. Defaults to 1.
+            labels (Any): Labels distinguishing series of the metric.
+        """
+        key = tuple((k, str(v)) for k, v in labels.items())
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def get(self, name: str, **labels: Any) -> histogram | float | None:
+        """Get a single series.
+
+        Args:
+            name (str): The metric name.
+            labels (Any): The labels of the series.
+
+        Returns:
+            histogram | float | None: The histogram or counter value, or None if nothing was recorded.
+        """
+        key = tuple((k, str(v)) for k, v in labels.items())
+        with self.lock:
+            if name in self.histograms:
+                return self.histograms[name].get(key)
+            return self.counters.get(name, {}).get(key)
+
+    def snapshot(self) -> dict[str, Any]:
+        """Get a copy of all recorded metrics.
+
+        Returns:
+            dict[str, Any]: Histograms (with count, sum, p50 and p99 estimates) and counters, keyed by metric name, each holding a list of series.
+        """
+        with self.lock:
+            return {
+                "histograms": {name: [{"labels": dict(key), "count": hist.count, "sum": hist.sum, "p50": hist.quantile(0.5), "p99": hist.quantile(0.99)} for key, hist in series.items()] for name, series in self.histograms.items()},
+                "counters": {name: [{"labels": dict(key), "value": value} for key, value in series.items()] for name, series in self.counters.items()},
+            }
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics.
+        """
+        lines = []
+        with self.lock:
+            for name, series in self.histograms.items():
+                fullName = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {fullName} histogram")
+                for key, hist in series.items():
+                    for bound, count in zip(self.buckets + (float("inf"),), hist.cumulative()):
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{fullName}_bucket{formatLabels(key + (('le', le),))} {count}")
+                    lines.append(f"{fullName}_sum{formatLabels(key)} {hist.sum}")
+                    lines.append(f"{fullName}_count{formatLabels(key)} {hist.count}")
+            for name, series in self.counters.items():
+                fullName = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {fullName} counter")
+                for key, value in series.items():
+                    lines.append(f"{fullName}{formatLabels(key)} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,226 @@
+from logging import Logger
+from typing import Any, Iterable
+from subprocess import run, CompletedProcess
+from threading import Lock
+from time import perf_counter
+from unittest import TestSuite
+from .pullerWebhook import pullerWebhookBlueprint
+from .payload import getRepositoryName, getRef, getAfter, isSha
+from .testSelection import testSelector
+
+class repositoryCheckout:
+    """A local checkout of a repository branch, that pushes to the branch are deployed to."""
+
+    def __init__(self, repository: str, path: str, branch: str = "main", remote: str = "origin", depth: int | None = None, filter: str | None = None, tests: TestSuite | None = None, testMap: dict[str, TestSuite | Iterable[str]] | testSelector | None = None):
+        """Describe a checkout.
+
+        Args:
+            repository (str): The repository name as sent by the git app, like org/repo (GitHub, Gitea) or group/project (GitLab).
+            path (str): Path to the local checkout.
+            branch (str, optional): The branch checked out. Pushes to other branches are ignored. Defaults to "main".
+            remote (str, optional): The remote fetched from. Defaults to "origin".
+            depth (int | None, optional): If set, fetches are shallow and limited to this many commits. Defaults to None.
+            filter (str | None, optional): Optional partial clone filter used for fetches, like blob:none. Defaults to None.
+            tests (TestSuite | None, optional): Tests ran after updating this checkout, instead of the tests of the blueprint. Defaults to None.
+            testMap (dict[str, TestSuite | Iterable[str]] | testSelector | None, optional): Mapping of file path patterns to affected tests used instead of the testMap of the blueprint. Defaults to None.
+        """
+        self.repository = repository
+        self.path = path
+        self.branch = branch
+        self.ref = f"refs/heads/{branch}"
+        self.remote = remote
+        self.depth = depth
+        self.filter = filter
+        self.tests = tests
+        if isinstance(testMap, dict):
+            testMap = testSelector(testMap)
+        self.testSelector = testMap
+        self.lock = Lock()
+
+class multiPullerWebhookBlueprint(pullerWebhookBlueprint):
+    """A subclass of pullerWebhookBlueprint that deploys pushes to any number of registered local checkouts.
+    Only the pushed ref is fetched, and the checkout is fast-forwarded to the exact commit the push points to.
+    Updates of the same checkout are serialized, while different checkouts are updated in parallel."""
+
+    def __init__(self, webhookToken: str | None, checkouts: Iterable[repositoryCheckout] = (), tests: TestSuite | None = None, log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | None = None, gitCommand: str = "/usr/bin/git", commandEnv: dict[str, str] | None = None, *args, maxWorkers: int = 4, **kwargs):
+        """Initialize the webhook blueprint for deploying to multiple checkouts.
+
+        Args:
+            webhookToken (str | None): The token used to verify the webhook. If None, no verification is done.
+            checkouts (Iterable[repositoryCheckout], optional): The checkouts to deploy to. More can be added using addCheckout. Defaults to ().
+            tests (TestSuite | None, optional): An optional unittest.TestSuite that will be ran after updating checkouts that have no tests of their own. Defaults to None.
+            log (Logger | None, optional): Optional logger that will be used by this blueprint. Defaults to None.
+            name (str, optional): Flask blueprint name. Must be unique. Defaults to "webhook".
+            github (bool, optional): Whether the blueprint should process webhook requests from GitHub. Defaults to True.
+            gitlab (bool, optional): Whether the blueprint should process webhook requests from GitLab. Defaults to True.
+            gitea (bool, optional): Whether the blueprint should process webhook requests from Gitea or other requests using basic auth. Defaults to True.
+            ipWhitelist (list[str] | None, optional): Optional whitelist that all incoming requests will be checked against. Defaults to None.
+            gitCommand (str, optional): Path to the git executable. Defaults to "/usr/bin/git".
+            commandEnv (dict[str, str] | None, optional): Optional environment that will be used by git. Defaults to None.
+            maxWorkers (int, optional): Number of checkouts updated in parallel when asyncJobs is enabled. Defaults to 4.
+        """
+        super().__init__(webhookToken, tests, log, name, github, gitlab, gitea, ipWhitelist, gitCommand, commandEnv, *args, maxWorkers=maxWorkers, **kwargs)
+        self.checkouts: dict[tuple[str, str], repositoryCheckout] = {}
+        for checkout in checkouts:
+            self.addCheckout(checkout)
+
+    def addCheckout(self, checkout: repositoryCheckout) -> repositoryCheckout:
+        """Register a checkout to deploy to.
+
+        Args:
+            checkout (repositoryCheckout): The checkout.
+
+        Raises:
+            ValueError: If a checkout of the same repository branch is already registered.
+
+        Returns:
+            repositoryCheckout: The registered checkout.
+        """
+        key = (checkout.repository, checkout.ref)
+        if key in self.checkouts:
+            raise ValueError(f"A checkout of {checkout.repository} {checkout.branch} is already registered")
+        self.checkouts[key] = checkout
+        return checkout
+
+    def resolve(self, data: dict[str, Any]) -> repositoryCheckout | None:
+        """Find the checkout a push should be deployed to.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            repositoryCheckout | None: The checkout or None if no checkout of the pushed repository branch is registered.
+        """
+        return self.checkouts.get((getRepositoryName(data), getRef(data)))
+
+    def processWebhook(self, data: dict[str, Any]) -> tuple[int, str]:
+        """Process the webhook data by updating the checkout of the pushed repository branch and running tests.
+        Pushes to repository branches without a registered checkout are acknowledged without doing anything.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        if self.resolve(data) is None:
+            if self.log is not None:
+                self.log.info(f"No checkout registered for {getRepositoryName(data)} {getRef(data)}")
+            return 200, "No checkout registered"
+        return super().processWebhook(data)
+
+    def jobKey(self, data: dict[str, Any]) -> str | None:
+        """Get the key under which deliveries are coalesced, the path of the checkout they are deployed to.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            str | None: The checkout path, or None if no checkout is registered.
+        """
+        checkout = self.resolve(data)
+        if checkout is None:
+            return None
+        return checkout.path
+
+    def checkoutKey(self, data: dict[str, Any]) -> str:
+        """Get the key under which the coordinator serializes work, the path of the checkout the delivery is deployed to.
+        Only called for deliveries a checkout is registered for.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            str: The checkout path.
+        """
+        return self.resolve(data).path
+
+    def pullAndTest(self, data: dict[str, Any]) -> tuple[int, str]:
+        """Fetch the pushed ref into the matching checkout, fast-forward it to the pushed commit and run the tests.
+        If the tests fail the checkout is reset to where it was.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        checkout = self.resolve(data)
+        if checkout is None:
+            return 200, "No checkout registered"
+        after = getAfter(data)
+        if after is None:
+            return 200, "Nothing to deploy"
+        if not isSha(after):
+            if self.log is not None:
+                self.log.warning(f"A push to {checkout.path} with an invalid commit SHA")
+            return 400, "Invalid commit SHA"
+        with checkout.lock:
+            previous = self.head(checkout.path)
+            if previous == after:
+                if self.log is not None:
+                    self.log.info(f"{checkout.path} already at {after}, skipping fetch")
+                return 200, "Already up to date"
+            options = ["--no-tags"]
+            if checkout.depth is not None:
+                options.append(f"--depth={checkout.depth}")
+            if checkout.filter is not None:
+                options.append(f"--filter={checkout.filter}")
+            process = self.git(checkout, "fetch", *options, checkout.remote, f"+{checkout.ref}:refs/remotes/{checkout.remote}/{checkout.branch}")
+            if process.returncode == 0 and not self.hasCommit(checkout, after):
+                # the branch moved on and a shallow fetch did not reach the pushed commit
+                process = self.git(checkout, "fetch", *options, "--end-of-options", checkout.remote, after)
+            if process.returncode != 0:
+                if self.log is not None:
+                    self.log.error(f"Error while fetching into {checkout.path}: {process.stderr.decode('utf-8')}")
+                return 500, process.stderr.decode("utf-8")
+            if checkout.depth is None:
+                process = self.git(checkout, "merge", "--ff-only", "--end-of-options", after)
+            else: # shallow history can't show the update is a fast-forward
+                process = self.git(checkout, "reset", "--keep", after, "--") # older versions of reset reject --end-of-options
+            if process.returncode != 0:
+                if self.log is not None:
+                    self.log.error(f"Error while updating {checkout.path}: {process.stderr.decode('utf-8')}")
+                return 500, process.stderr.decode("utf-8")
+            if self.log is not None:
+                self.log.info(f"Updated {checkout.path} from {previous} to {after}")
+            tests = checkout.tests if checkout.tests is not None else self.tests
+            if tests is None:
+                return 200, "Webhook received successfully"
+            tests = self.selectTests(tests, data, previous, checkout.path, checkout.testSelector)
+            if tests.countTestCases() == 0:
+                if self.log is not None:
+                    self.log.info(f"No tests affected by the update of {checkout.path}")
+                return 200, "No tests affected"
+            result = self.runTests(tests)
+            if result.wasSuccessful():
+                if self.log is not None:
+                    self.log.info(f"{result.testsRun} tests passed ")
+                return 200, "Tests passed"
+            if previous is None: # an unborn checkout has no commit to go back to
+                resetStatus = "skipped"
+            else:
+                resetStatus = self.git(checkout, "reset", "--keep", previous, "--").returncode
+            if self.log is not None:
+                self.log.error(f"Tests did not pass, Errors: {result.errors}, Failures: {result.failures}. Reset status: {resetStatus}")
+            return 428, f"Tests did not pass, Errors: {result.errors}, Failures: {result.failures}. Reset status: {resetStatus}"
+
+    def hasCommit(self, checkout: repositoryCheckout, sha: str) -> bool:
+        """Check whether a commit is present in a checkout."""
+        return run([self.gitCommand, "cat-file", "-e", "--end-of-options", f"{sha}^{{commit}}"], cwd=checkout.path, env=self.commandEnv, capture_output=True).returncode == 0
+
+    def git(self, checkout: repositoryCheckout, *args: str) -> CompletedProcess:
+        """Run a git command in a checkout, recording its duration.
+
+        Args:
+            checkout (repositoryCheckout): The checkout.
+            args (str): The git arguments.
+
+        Returns:
+            CompletedProcess: The finished process.
+        """
+        started = perf_counter()
+        process = run([self.gitCommand, *args], cwd=checkout.path, env=self.commandEnv, capture_output=True)
+        if self.metrics is not None:
+            self.metrics.observe("git_seconds", perf_counter() - started, operation=args[0])
+        return process
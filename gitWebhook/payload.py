@@ -0,0 +1,61 @@
+from typing import Any, Mapping
+import re
+
+NULL_SHA = "0" * 40
+
+SHA_PATTERN = re.compile(r"[0-9a-f]{40}|[0-9a-f]{64}")
+"""Full SHA-1 or SHA-256 commit ids."""
+
+def isSha(value: str) -> bool:
+    """Check whether a value sent in a payload is a full commit SHA, and thus safe to pass to git, which would take values starting with - for options.
+
+    Args:
+        value (str): The value.
+
+    Returns:
+        bool: True if the value is a lowercase hex SHA-1 or SHA-256.
+    """
+    return SHA_PATTERN.fullmatch(value) is not None
+
+def getRepositoryName(data: Mapping[str, Any]) -> str | None:
+    """Get the full name of the repository a webhook payload refers to.
+
+    Args:
+        data (Mapping[str, Any]): The webhook data.
+
+    Returns:
+        str | None: The repository name (owner/name) or None if it could not be determined.
+    """
+    repository = data.get("repository")
+    if isinstance(repository, Mapping) and isinstance(repository.get("full_name"), str):
+        return repository["full_name"] # GitHub and Gitea
+    project = data.get("project")
+    if isinstance(project, Mapping) and isinstance(project.get("path_with_namespace"), str):
+        return project["path_with_namespace"] # GitLab
+    return None
+
+def getRef(data: Mapping[str, Any]) -> str | None:
+    """Get the git ref a webhook payload refers to.
+
+    Args:
+        data (Mapping[str, Any]): The webhook data.
+
+    Returns:
+        str | None: The full ref (for example refs/heads/main) or None if it could not be determined.
+    """
+    ref = data.get("ref")
+    return ref if isinstance(ref, str) else None
+
+def getAfter(data: Mapping[str, Any]) -> str | None:
+    """Get the commit SHA a push webhook payload moved the ref to.
+
+    Args:
+        data (Mapping[str, Any]): The webhook data.
+
+    Returns:
+        str | None: The SHA or None if it could not be determined, or the ref was deleted.
+    """
+    after = data.get("after")
+    if not isinstance(after, str) or after == NULL_SHA:
+        return None
+    return after
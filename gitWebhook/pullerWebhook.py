@@ -1,14 +1,23 @@
 from logging import Logger
-from typing import Any
-from unittest import TestSuite
+from typing import Any, Iterable
+from flask import Response, abort
 from .webhook import webhookBlueprint
+from .jobQueue import jobQueue
+from .payload import getRepositoryName, getRef, getAfter, isSha
+from .testSelection import testSelector, changedFiles, iterTests, runTestsInProcesses
+from .worktreeDeploy import worktreeDeployer, deployError
+from .structuredLog import lazyPayload
+from .coordination import workerCoordinator
 from subprocess import run
+from time import perf_counter
 from unittest import TestSuite, TestResult
+import json
+import os
 
 class pullerWebhookBlueprint(webhookBlueprint):
     """A subclass of webhookBlueprint that processes the webhook data by pulling from a git repository and running tests."""
     
-    def __init__(self, webhookToken: str | None, tests: TestSuite | None = None, log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | None = None, gitCommand: str = "/usr/bin/git", commandEnv: dict[str, str] | None = None, *args, **kwargs):
+    def __init__(self, webhookToken: str | None, tests: TestSuite | None = None, log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | None = None, gitCommand: str = "/usr/bin/git", commandEnv: dict[str, str] | None = None, *args, asyncJobs: bool = False, maxWorkers: int = 1, maxQueuedJobs: int = 100, coalesceWindow: float | None = None, testMap: dict[str, TestSuite | Iterable[str]] | testSelector | None = None, testProcesses: int | None = None, deployer: worktreeDeployer | None = None, coordinator: workerCoordinator | None = None, **kwargs):
         """Initialize the webhook blueprint for pulling from a git repository and running tests.
 
         Args:
@@ -22,6 +31,17 @@ class pullerWebhookBlueprint(webhookBlueprint):
             ipWhitelist (list[str] | None, optional): Optional whitelist that all incoming requests will be checked against. Defaults to None.
             gitCommand (str, optional): Path to the git executable. Defaults to "/usr/bin/git".
             commandEnv (dict[str, str] | None, optional): Optional environment that will be used by git during pulling. Defaults to None.
+            asyncJobs (bool, optional): Whether to pull and test in the background, responding with 202 and a job id immediately. Job status is then available at GET jobs/<id>. Defaults to False.
+            maxWorkers (int, optional): Number of background workers used when asyncJobs is enabled. Defaults to 1.
+            maxQueuedJobs (int, optional): Maximum number of background jobs waiting for a worker. Further deliveries are rejected with 503. Defaults to 100.
+            coalesceWindow (float | None, optional): Seconds for which a background pull waits for further deliveries regarding the same repository and ref. Deliveries arriving during that window, or while a pull of the same ref is running, are collapsed into a single follow-up pull. Requires asyncJobs. Defaults to None.
+            testMap (dict[str, TestSuite | Iterable[str]] | testSelector | None, optional): Optional mapping of file path patterns to the tests affected by changes of matching files. Only the tests affected by a pull are ran, and all of them if any changed file matches no pattern. Defaults to None.
+            testProcesses (int | None, optional): If set, tests are ran in a pool of this many processes, loaded there by their names. Defaults to None.
+            deployer (worktreeDeployer | None, optional): If set, pushes are deployed by preparing and testing them in a separate worktree, which is only switched live once the testCommand of the deployer passes, instead of pulling into the current working directory. Can't be combined with tests or testMap, which would test the code already loaded by this process rather than the prepared worktree. Defaults to None.
+            coordinator (workerCoordinator | None, optional): If set, pulls are coordinated with the other worker processes of the host through lock files, so that exactly one worker pulls and tests a repository at a time. Defaults to None.
+
+        Raises:
+            ValueError: If coalesceWindow is set without asyncJobs, or deployer is combined with tests or testMap.
         """
         super().__init__(webhookToken, log, name, github, gitlab, gitea, ipWhitelist, *args, **kwargs)
         self.tests = tests
@@ -29,30 +49,139 @@ class pullerWebhookBlueprint(webhookBlueprint):
         if commandEnv is None:
             commandEnv = dict(GIT_SSH_COMMAND="/usr/bin/ssh")
         self.commandEnv = commandEnv
+        if coalesceWindow is not None and not asyncJobs:
+            raise ValueError("coalesceWindow requires asyncJobs to be enabled")
+        if deployer is not None and (tests is not None or testMap is not None):
+            raise ValueError("Deployments are tested by the testCommand of the deployer, in-process tests can't test a prepared worktree")
+        self.coalesceWindow = coalesceWindow
+        if isinstance(testMap, dict):
+            testMap = testSelector(testMap)
+        self.testSelector = testMap
+        self.testProcesses = testProcesses
+        self.deployer = deployer
+        self.coordinator = coordinator
+        self.jobs: jobQueue | None = None
+        if asyncJobs:
+            self.jobs = jobQueue(maxWorkers, maxQueuedJobs, log=log)
+            self.route("/jobs/<jobId>", methods=["GET"])(self.jobStatus)
     
     def processWebhook(self, data: dict[str, Any]) -> tuple[int, str]:
         """Process the webhook data by pulling from a git repository and running tests.
         If the tests are not provided, only the pull will be done.
         Otherwise the tests will be ran and if they fail the merge will be aborted.
+        If asyncJobs is enabled the work is queued instead, and the job id is returned with a 202 status code.
+        Deliveries coalesced into an already queued job return that job's id.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        if self.jobs is None:
+            return self.coordinatedPullAndTest(data)
+        if self.coalesceWindow is None:
+            job = self.jobs.submit(lambda: self.coordinatedPullAndTest(data))
+        else:
+            job = self.jobs.submit(lambda: self.coordinatedPullAndTest(data), self.jobKey(data), self.coalesceWindow)
+        if job is None:
+            return 503, "Job queue is full"
+        if self.log is not None:
+            self.log.info(f"Queued job {job.id}")
+        return 202, json.dumps({"id": job.id, "status": job.status, "coalesced": job.coalesced})
+    
+    def acceptsEvent(self, event: str | None) -> bool:
+        """Check whether a delivery of the given event type should be processed.
+        Every event is, as pulls don't depend on the handlers registered using on, which are only called in addition.
+
+        Args:
+            event (str | None): The event type, or None if the request didn't specify one.
+
+        Returns:
+            bool: Always True.
+        """
+        return True
+    
+    def jobKey(self, data: dict[str, Any]) -> tuple[str, str] | None:
+        """Get the key under which deliveries are coalesced.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[str, str] | None: The repository name and ref, or None if the delivery shouldn't be coalesced.
+        """
+        repository = getRepositoryName(data)
+        ref = getRef(data)
+        if repository is None or ref is None:
+            return None
+        return repository, ref
+    
+    def checkoutKey(self, data: dict[str, Any]) -> str:
+        """Get the key under which the coordinator serializes work, the path of the checkout the delivery is pulled into.
+        Deliveries for different refs still pull the same checkout, so they share the key.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            str: The path of the live worktree if there is a deployer, otherwise the current working directory.
+        """
+        if self.deployer is not None:
+            return self.deployer.livePath
+        return os.getcwd()
+    
+    def coordinatedPullAndTest(self, data: dict[str, Any]) -> tuple[int, str]:
+        """Pull and test while holding the lock the coordinator keeps for the checkout, if there is a coordinator.
+        Workers waiting for the lock reuse the result of the worker that held it if that worker already handled the same commit.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        if self.coordinator is None:
+            return self.pullAndTest(data)
+        return self.coordinator.run(self.checkoutKey(data), getAfter(data), data, self.pullAndTest)
+    
+    def pullAndTest(self, data: dict[str, Any]) -> tuple[int, str]:
+        """Pull from the git repository and run the tests.
+        The pull is skipped if the local HEAD already is at the commit the payload points to.
 
-        Args: 
+        Args:
             data (dict[str, Any]): The webhook data.
 
         Returns:
             tuple[int, str]: The status code and message.
         """
         if self.log is not None:
-            self.log.debug(f"Processing webhook: {data}")
-        process = run([self.gitCommand, "pull"], env=self.commandEnv)
+            self.log.debug("Processing webhook: %s", lazyPayload(data))
+        if self.deployer is not None:
+            return self.deploy(data)
+        after = getAfter(data)
+        previous = self.head()
+        if after is not None and previous == after:
+            if self.log is not None:
+                self.log.info(f"HEAD already at {after}, skipping pull")
+            return 200, "Already up to date"
+        started = perf_counter()
+        process = run([self.gitCommand, "pull"], env=self.commandEnv, capture_output=True)
+        if self.metrics is not None:
+            self.metrics.observe("git_seconds", perf_counter() - started, operation="pull")
         if process.returncode != 0:
             if self.log is not None:
                 self.log.error(f"Error while pulling: {process.stderr.decode('utf-8')}")
             return 500, process.stderr.decode("utf-8")
         if self.tests is not None:
+            tests = self.selectTests(self.tests, data, previous)
+            if tests.countTestCases() == 0:
+                if self.log is not None:
+                    self.log.info("No tests affected by the pull")
+                return 200, "No tests affected"
             if self.log is not None:
                 self.log.debug("Running tests")
-            result = TestResult()
-            self.tests.run(result) # Why does this method want a TestResult object? Why can't it just return the result?
+            result = self.runTests(tests)
             if result.wasSuccessful():
                 if self.log is not None:
                     self.log.info(f"{result.testsRun} tests passed ")
@@ -64,4 +193,144 @@ class pullerWebhookBlueprint(webhookBlueprint):
                 return 428, f"Tests did not pass, Errors: {result.errors}, Failures: {result.failures}. Merge abort status: {abortProcess.returncode}"
         else:
             return 200, "Webhook received successfully"
-    
\ No newline at end of file
+    
+    def deploy(self, data: dict[str, Any]) -> tuple[int, str]:
+        """Deploy the pushed commit using the worktree deployer.
+        The commit is checked out in a worktree that isn't live, tested there, and only switched live if the tests pass.
+
+        Args:
+            data (dict[str, Any]): The webhook data.
+
+        Returns:
+            tuple[int, str]: The status code and message.
+        """
+        deployer = self.deployer
+        ref = getRef(data)
+        if ref is not None and ref != deployer.ref:
+            if self.log is not None:
+                self.log.info(f"Ignoring push to {ref}")
+            return 200, f"Ignored push to {ref}"
+        after = getAfter(data)
+        if after is not None and not isSha(after):
+            if self.log is not None:
+                self.log.warning("A push with an invalid commit SHA")
+            return 400, "Invalid commit SHA"
+        with deployer.lock:
+            previous = deployer.live()
+            if after is not None and previous == after:
+                if self.log is not None:
+                    self.log.info(f"{after} already live, skipping deployment")
+                return 200, "Already up to date"
+            try:
+                started = perf_counter()
+                sha = deployer.fetch(after)
+                if self.metrics is not None:
+                    self.metrics.observe("git_seconds", perf_counter() - started, operation="fetch")
+                if sha == previous:
+                    return 200, "Already up to date"
+                started = perf_counter()
+                path = deployer.prepare(sha)
+                if self.metrics is not None:
+                    self.metrics.observe("git_seconds", perf_counter() - started, operation="checkout")
+            except deployError as e:
+                if self.log is not None:
+                    self.log.error(f"Error while preparing deployment: {e}")
+                return 500, str(e)
+            try:
+                passed, output = deployer.test(path)
+            except OSError as e: # the test command couldn't be started
+                if self.log is not None:
+                    self.log.error(f"Error while running the test command in {path}, {previous} stays live: {e}")
+                return 500, f"Error while running the test command: {e}"
+            if not passed:
+                if self.log is not None:
+                    self.log.error(f"Test command failed in {path}, {previous} stays live: {output}")
+                return 428, f"Tests did not pass: {output}"
+            try:
+                deployer.activate(path, sha)
+            except OSError as e:
+                if self.log is not None:
+                    self.log.error(f"Error while switching {path} live: {e}")
+                return 500, f"Error while switching the deployment live: {e}"
+            if self.log is not None:
+                self.log.info(f"Deployed {sha} from {path}")
+            return 200, f"Deployed {sha}"
+    
+    def selectTests(self, tests: TestSuite, data: dict[str, Any], previous: str | None, path: str | None = None, selector: testSelector | None = None) -> TestSuite:
+        """Select the tests affected by a pull.
+        The changed files are determined by comparing the previous HEAD with the current one, or taken from the payload if that isn't possible.
+
+        Args:
+            tests (TestSuite): All tests.
+            data (dict[str, Any]): The webhook data.
+            previous (str | None): The HEAD before the pull.
+            path (str | None, optional): Path to the repository. Defaults to None, which is the current working directory.
+            selector (testSelector | None, optional): The selector to use instead of the one of the blueprint. Defaults to None.
+
+        Returns:
+            TestSuite: The selected tests.
+        """
+        if selector is None:
+            selector = self.testSelector
+        if selector is None:
+            return tests
+        files = None
+        if previous:
+            process = run([self.gitCommand, "diff", "--name-only", previous, "HEAD"], cwd=path, env=self.commandEnv, capture_output=True)
+            if process.returncode == 0:
+                files = set(process.stdout.decode("utf-8").splitlines())
+        if files is None:
+            files = changedFiles(data)
+        return selector.select(tests, files)
+    
+    def runTests(self, tests: TestSuite) -> TestResult:
+        """Run a test suite, recording its duration and outcome.
+        If testProcesses is set the tests are ran in a process pool.
+
+        Args:
+            tests (TestSuite): The tests.
+
+        Returns:
+            TestResult: The result.
+        """
+        started = perf_counter()
+        if self.testProcesses is not None:
+            result = runTestsInProcesses([test.id() for test in iterTests(tests)], self.testProcesses)
+        else:
+            result = TestResult()
+            tests.run(result) # Why does this method want a TestResult object? Why can't it just return the result?
+        if self.metrics is not None:
+            self.metrics.observe("tests_seconds", perf_counter() - started)
+            self.metrics.increment("test_runs_total", passed=result.wasSuccessful())
+        return result
+    
+    def head(self, path: str | None = None) -> str | None:
+        """Get the SHA of the local HEAD.
+
+        Args:
+            path (str | None, optional): Path to the repository. Defaults to None, which is the current working directory.
+
+        Returns:
+            str | None: The SHA or None if it could not be determined.
+        """
+        process = run([self.gitCommand, "rev-parse", "HEAD"], cwd=path, env=self.commandEnv, capture_output=True)
+        if process.returncode != 0:
+            return None
+        return process.stdout.decode("utf-8").strip()
+    
+    def jobStatus(self, jobId: str) -> Response:
+        """Method that acts as a GET endpoint reporting the state of a background job.
+
+        Args:
+            jobId (str): The id returned when the job was queued.
+
+        Returns:
+            Response: JSON describing the job status, result and timings.
+        """
+        self.verifyOrigin()
+        if self.jobs is None:
+            abort(404)
+        job = self.jobs.get(jobId)
+        if job is None:
+            abort(404)
+        return Response(json.dumps(job.toDict()), status=200, mimetype="application/json")
@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
+from importlib import import_module
+from time import perf_counter, sleep
+from typing import Any, Iterable
+from .webhook import webhookBlueprint
+from .capture import capturedDelivery, readCapture
+from .metrics import webhookMetrics
+import argparse
+import json
+import sys
+
+REPLAY_BUCKETS = tuple(0.00001 * 1.25 ** i for i in range(80))
+"""Fine grained histogram bucket bounds, from 10 microseconds to about 500 seconds, for precise offline quantiles."""
+
+class captureReplay:
+    """Feeds captured deliveries through a blueprint, bypassing the HTTP layer and verification, to profile and compare handlers offline.
+    Each delivery is decoded and dispatched just like a live one, and the latencies of whole deliveries, of the functions of functionWebhookBlueprint and of handlers registered using on are collected per name.
+    Deliveries are dispatched through a shallow copy of the blueprint with its own metrics, so replaying against a blueprint that is serving traffic leaves its metrics alone."""
+
+    def __init__(self, blueprint: webhookBlueprint, parallelism: int = 1, realtime: bool = False, speed: float = 1.0):
+        """Initialize the runner.
+
+        Args:
+            blueprint (webhookBlueprint): The blueprint, an instance of any webhookBlueprint subclass.
+            parallelism (int, optional): Number of deliveries processed at once. Defaults to 1.
+            realtime (bool, optional): Whether deliveries are fed at the pace they were recorded at, instead of as fast as possible. Defaults to False.
+            speed (float, optional): How many times faster than recorded deliveries are fed in realtime mode. Defaults to 1.0.
+        """
+        self.blueprint = blueprint
+        self.parallelism = parallelism
+        self.realtime = realtime
+        self.speed = speed
+
+    def deliver(self, blueprint: webhookBlueprint, delivery: capturedDelivery, metrics: webhookMetrics) -> int | None:
+        """Process a single delivery, recording its latency by event type.
+
+        Args:
+            blueprint (webhookBlueprint): The copy of the blueprint collecting handler latencies into metrics.
+            delivery (capturedDelivery): The delivery.
+            metrics (webhookMetrics): The metrics of the replay.
+
+        Returns:
+            int | None: The status code, or None if the blueprint ignores the event.
+        """
+        event = delivery.event
+        if not blueprint.acceptsEvent(event):
+            metrics.increment("replayed_total", event=event or "unknown", status="ignored")
+            return None
+        started = perf_counter()
+        try:
+            code = blueprint.dispatchWebhook(event, blueprint.decodePayload(event, delivery.body))[0]
+        except Exception:
+            code = 500
+        metrics.observe("delivery_seconds", perf_counter() - started, event=event or "unknown")
+        metrics.increment("replayed_total", event=event or "unknown", status=code)
+        return code
+
+    def run(self, deliveries: str | Iterable[str] | Iterable[capturedDelivery]) -> dict[str, Any]:
+        """Replay deliveries and report on them.
+
+        Args:
+            deliveries (str | Iterable[str] | Iterable[capturedDelivery]): Capture files, a directory holding them, or deliveries read from them.
+
+        Returns:
+            dict[str, Any]: The number of replayed deliveries, the elapsed seconds and throughput, and per event and per handler counts, throughput and latency quantiles.
+        """
+        if isinstance(deliveries, str):
+            deliveries = list(readCapture(deliveries))
+        else:
+            deliveries = [delivery for item in deliveries for delivery in (readCapture(item) if isinstance(item, str) else (item,))]
+        metrics = webhookMetrics(buckets=REPLAY_BUCKETS)
+        blueprint = copy(self.blueprint)
+        blueprint.metrics = metrics
+        started = perf_counter()
+        with ThreadPoolExecutor(max_workers=self.parallelism, thread_name_prefix="replay") as executor:
+            futures = []
+            first = deliveries[0].time if deliveries else 0.0
+            for delivery in deliveries:
+                if self.realtime:
+                    delay = started + (delivery.time - first) / self.speed - perf_counter()
+                    if delay > 0:
+                        sleep(delay)
+                futures.append(executor.submit(self.deliver, blueprint, delivery, metrics))
+            codes = [future.result() for future in futures]
+        elapsed = perf_counter() - started
+        return {
+            "deliveries": len(codes),
+            "ignored": codes.count(None),
+            "failed": sum(1 for code in codes if code is not None and code >= 400),
+            "seconds": elapsed,
+            "throughput": len(codes) / elapsed if elapsed > 0 else 0.0,
+            "events": summarize(metrics, "delivery_seconds", "event"),
+            "handlers": summarize(metrics, "function_seconds", "function"),
+        }
+
+def summarize(metrics: webhookMetrics, name: str, label: str) -> dict[str, dict[str, Any]]:
+    """Summarize the latency histograms of a metric by one of their labels.
+
+    Args:
+        metrics (webhookMetrics): The collector.
+        name (str): The metric name.
+        label (str): The label series are keyed by.
+
+    Returns:
+        dict[str, dict[str, Any]]: Call count, total seconds, throughput while busy and p50 and p99 latencies, keyed by label value.
+    """
+    summary = {}
+    for series in metrics.snapshot()["histograms"].get(name, []):
+        summary[series["labels"][label]] = {"count": series["count"], "seconds": series["sum"], "throughput": series["count"] / series["sum"] if series["sum"] > 0 else 0.0, "p50": series["p50"], "p99": series["p99"]}
+    return summary
+
+def loadBlueprint(spec: str) -> webhookBlueprint:
+    """Import a blueprint given as module:attribute, calling the attribute if it isn't a blueprint, like a factory function."""
+    moduleName, _, attribute = spec.partition(":")
+    blueprint = getattr(import_module(moduleName), attribute or "webhook")
+    if not isinstance(blueprint, webhookBlueprint):
+        blueprint = blueprint()
+    return blueprint
+
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description="Replay captured webhook deliveries through a blueprint and report per handler throughput and latency.")
+    parser.add_argument("blueprint", help="The blueprint as module:attribute, the attribute may also be a function creating the blueprint")
+    parser.add_argument("captures", nargs="+", help="Capture files or directories")
+    parser.add_argument("--parallelism", type=int, default=1, help="Number of deliveries processed at once")
+    parser.add_argument("--realtime", action="store_true", help="Feed deliveries at the pace they were recorded at")
+    parser.add_argument("--speed", type=float, default=1.0, help="Speed up factor of realtime replays")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args(argv)
+    report = captureReplay(loadBlueprint(args.blueprint), args.parallelism, args.realtime, args.speed).run(args.captures)
+    print(f"{report['deliveries']} deliveries in {report['seconds']:.2f}s, {report['throughput']:.1f}/s, {report['failed']} failed, {report['ignored']} ignored")
+    for kind in ("events", "handlers"):
+        for name, summary in sorted(report[kind].items()):
+            print(f"{kind[:-1]:7} {name:30} {summary['count']:8} calls {summary['throughput']:10.1f}/s p50 {summary['p50'] * 1000:9.3f}ms p99 {summary['p99'] * 1000:9.3f}ms")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,63 @@
+from fnmatch import fnmatchcase
+from typing import Any, Callable, Mapping
+from .payload import getRepositoryName, getRef
+
+ANY_EVENT = "*"
+
+class eventRouter:
+    """Index of webhook handlers keyed by event type, then by ref, each with an optional repository name pattern."""
+
+    def __init__(self):
+        """Initialize an empty router."""
+        self.index: dict[str, dict[str | None, list[tuple[str | None, Callable[..., Any]]]]] = {}
+
+    def add(self, event: str, handler: Callable[..., Any], ref: str | None = None, repo: str | None = None) -> None:
+        """Register a handler.
+
+        Args:
+            event (str): The event type, for example push or pull_request. Use * to match all events.
+            handler (Callable[..., Any]): The handler.
+            ref (str | None, optional): Full ref the handler is limited to, for example refs/heads/main. Defaults to None.
+            repo (str | None, optional): Repository name or shell style pattern the handler is limited to, for example org/*. Defaults to None.
+        """
+        self.index.setdefault(event, {}).setdefault(ref, []).append((repo, handler))
+
+    def handles(self, event: str | None) -> bool:
+        """Check whether any handler might be interested in an event, without looking at the payload.
+
+        Args:
+            event (str | None): The event type.
+
+        Returns:
+            bool: True if handlers are registered for the event.
+        """
+        return ANY_EVENT in self.index or (event is not None and event in self.index)
+
+    def match(self, event: str | None, data: Mapping[str, Any]) -> list[Callable[..., Any]]:
+        """Find the handlers registered for a delivery.
+
+        Args:
+            event (str | None): The event type.
+            data (Mapping[str, Any]): The webhook data.
+
+        Returns:
+            list[Callable[..., Any]]: The matching handlers.
+        """
+        handlers = []
+        ref = None
+        repo = None
+        for key in (event, ANY_EVENT):
+            refs = self.index.get(key) if key is not None else None
+            if not refs:
+                continue
+            if ref is None:
+                ref = getRef(data)
+                repo = getRepositoryName(data)
+            for routes in (refs.get(None, ()), refs.get(ref, ()) if ref is not None else ()):
+                for pattern, handler in routes:
+                    if pattern is None or (repo is not None and fnmatchcase(repo, pattern)):
+                        handlers.append(handler)
+        return handlers
+
+    def __bool__(self) -> bool:
+        return bool(self.index)
@@ -0,0 +1,237 @@
+from collections import OrderedDict
+from fnmatch import fnmatchcase
+from hashlib import sha256
+from hmac import new as hmacNew, compare_digest, HMAC
+from threading import Lock
+from time import monotonic
+from typing import Callable, Iterable, Mapping
+
+KEY_HEADERS = ("X-GitHub-Hook-Installation-Target-ID", "X-GitHub-Hook-ID", "X-Gitlab-Webhook-UUID", "X-Gitea-Hook-ID")
+"""Headers identifying the repository, organization or hook a delivery belongs to, in the order they are looked up."""
+
+class webhookSecret:
+    """One or more secrets accepted for a webhook, the current one first, followed by the ones being rotated out, optionally bound to the repositories they may sign deliveries for.
+    The HMAC key state of every secret is computed once and copied for each request."""
+
+    def __init__(self, secrets: str | Iterable[str], repositories: Iterable[str] | None = None):
+        """Prepare the secrets.
+
+        Args:
+            secrets (str | Iterable[str]): The secret or secrets.
+            repositories (Iterable[str] | None, optional): Repository names or shell style patterns, for example org/*, of the repositories the secrets are valid for. Defaults to None, which doesn't bind the secrets to repositories.
+
+        Raises:
+            ValueError: If no secret is given.
+        """
+        if isinstance(secrets, str):
+            secrets = (secrets,)
+        self.secrets = tuple(secrets)
+        if not self.secrets:
+            raise ValueError("At least one secret is required")
+        self.repositories = tuple(repositories) if repositories is not None else None
+        self.encoded = tuple(secret.encode("utf-8") for secret in self.secrets)
+        self.hmacs = tuple(hmacNew(secret, digestmod=sha256) for secret in self.encoded)
+
+    def digest(self) -> "digestGroup":
+        """Get fresh HMACs of all secrets, to be updated with a request body."""
+        return digestGroup([hmac.copy() for hmac in self.hmacs])
+
+    def verifyToken(self, token: str | None) -> bool:
+        """Check in constant time whether a token sent in a header is one of the secrets.
+
+        Args:
+            token (str | None): The token.
+
+        Returns:
+            bool: True if the token matches a secret.
+        """
+        if token is None:
+            return False
+        encoded = token.encode("utf-8")
+        matched = False
+        for secret in self.encoded:
+            matched |= compare_digest(encoded, secret)
+        return matched
+
+    def allows(self, repository: str | None) -> bool:
+        """Check whether the secrets are valid for a repository.
+
+        Args:
+            repository (str | None): The full name of the repository of a verified payload.
+
+        Returns:
+            bool: True if the secrets aren't bound to repositories or the repository matches one of them.
+        """
+        if self.repositories is None:
+            return True
+        return repository is not None and any(fnmatchcase(repository, pattern) for pattern in self.repositories)
+
+    def rotated(self, secret: str) -> "webhookSecret":
+        """Get a copy that accepts a new secret besides the current ones.
+
+        Args:
+            secret (str): The new secret, which becomes the current one.
+
+        Returns:
+            webhookSecret: The copy.
+        """
+        return webhookSecret((secret,) + tuple(s for s in self.secrets if s != secret), self.repositories)
+
+    def retired(self, secret: str) -> "webhookSecret":
+        """Get a copy that no longer accepts a secret.
+
+        Args:
+            secret (str): The secret.
+
+        Returns:
+            webhookSecret: The copy.
+        """
+        return webhookSecret((s for s in self.secrets if s != secret), self.repositories)
+
+class digestGroup:
+    """HMACs of a request body computed using several secrets at once."""
+
+    def __init__(self, hmacs: list[HMAC]):
+        self.hmacs = hmacs
+
+    def update(self, data: bytes | bytearray | memoryview) -> None:
+        """Update all HMACs with a chunk of the body."""
+        for hmac in self.hmacs:
+            hmac.update(data)
+
+    def matches(self, signature: str, prefix: str = "") -> bool:
+        """Check in constant time whether a signature matches the HMAC of any of the secrets.
+
+        Args:
+            signature (str): The signature sent with the request.
+            prefix (str, optional): Prefix of the signature, like sha256=. Defaults to "".
+
+        Returns:
+            bool: True if the signature matches.
+        """
+        encoded = signature.encode("utf-8", "surrogateescape") # compare_digest rejects non ASCII strings
+        matched = False
+        for hmac in self.hmacs:
+            matched |= compare_digest(encoded, (prefix + hmac.hexdigest()).encode("ascii"))
+        return matched
+
+def toSecret(secret: str | Iterable[str] | webhookSecret | None) -> webhookSecret | None:
+    """Wrap secrets in a webhookSecret, unless they already are one or None."""
+    if secret is None or isinstance(secret, webhookSecret):
+        return secret
+    return webhookSecret(secret)
+
+class secretProvider:
+    """Resolves the secrets of a delivery from its headers, allowing a single blueprint to serve many repositories, organizations or hooks with separate secrets.
+    Secrets are looked up by the value of the first KEY_HEADERS header that is known, in a mapping or using a resolver whose results are cached.
+    Key headers aren't covered by the signature, so anybody knowing one secret could send it along with the key of another tenant. Secrets found by key must therefore be bound to the repositories they are valid for, which is checked against the verified payload using authorize."""
+
+    def __init__(self, secrets: Mapping[str, str | Iterable[str] | webhookSecret] | None = None, default: str | Iterable[str] | webhookSecret | None = None, resolver: Callable[[str], str | Iterable[str] | webhookSecret | None] | None = None, keyHeaders: Iterable[str] = KEY_HEADERS, ttl: float = 300.0, maxSize: int = 1024, resolverRate: float | None = 10.0, bindRepositories: bool = True):
+        """Initialize the provider.
+
+        Args:
+            secrets (Mapping[str, str | Iterable[str] | webhookSecret] | None, optional): Secrets keyed by hook, repository or organization id. A list of secrets accepts all of them, which allows rotating secrets. Use webhookSecret to bind secrets to repositories. Defaults to None.
+            default (str | Iterable[str] | webhookSecret | None, optional): Secrets of deliveries with no known key. If None such deliveries are rejected. Defaults to None.
+            resolver (Callable[[str], str | Iterable[str] | webhookSecret | None] | None, optional): Function looking up the secrets of keys missing from secrets, for example in a database. Return a webhookSecret to bind the secrets to repositories. Defaults to None.
+            keyHeaders (Iterable[str], optional): Headers holding keys. Defaults to KEY_HEADERS.
+            ttl (float, optional): Seconds for which results of the resolver are cached. Defaults to 300.0.
+            maxSize (int, optional): Maximum number of cached results of the resolver. Defaults to 1024.
+            resolverRate (float | None, optional): Maximum number of resolver calls per second, with bursts of as many calls, so that deliveries with made up keys can't flood the resolver. Keys over the limit are treated as unknown. Defaults to 10.0, None doesn't limit the resolver.
+            bindRepositories (bool, optional): Whether secrets found by key must be bound to repositories. If False unbound secrets found by key are valid for any repository, which is only safe if all tenants are trusted. Defaults to True.
+
+        Raises:
+            ValueError: If resolverRate isn't positive.
+        """
+        if resolverRate is not None and resolverRate <= 0:
+            raise ValueError("resolverRate must be positive")
+        self.secrets: dict[str, webhookSecret] = {key: toSecret(secret) for key, secret in (secrets or {}).items()}
+        self.default = toSecret(default)
+        self.resolver = resolver
+        self.keyHeaders = tuple(keyHeaders)
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self.cache: OrderedDict[str, tuple[float, webhookSecret | None]] = OrderedDict()
+        self.resolverRate = resolverRate
+        self.resolverTokens = resolverRate or 0.0
+        self.resolverUpdated = monotonic()
+        self.throttled = 0
+        self.bindRepositories = bindRepositories
+        self.lock = Lock()
+
+    def resolve(self, headers: Mapping[str, str]) -> webhookSecret | None:
+        """Find the secrets of a delivery.
+
+        Args:
+            headers (Mapping[str, str]): The request headers.
+
+        Returns:
+            webhookSecret | None: The secrets, or None if the delivery has no known key and there is no default.
+        """
+        for header in self.keyHeaders:
+            key = headers.get(header)
+            if key is None:
+                continue
+            secret = self.secrets.get(key)
+            if secret is None and self.resolver is not None:
+                secret = self.lookup(key)
+            if secret is not None:
+                return secret
+        return self.default
+
+    def lookup(self, key: str) -> webhookSecret | None:
+        """Get the secrets of a key from the resolver, through the cache."""
+        now = monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and cached[0] > now:
+                self.cache.move_to_end(key)
+                return cached[1]
+            if self.resolverRate is not None:
+                self.resolverTokens = min(self.resolverRate, self.resolverTokens + (now - self.resolverUpdated) * self.resolverRate)
+                self.resolverUpdated = now
+                if self.resolverTokens < 1:
+                    self.throttled += 1
+                    return None
+                self.resolverTokens -= 1
+        secret = toSecret(self.resolver(key))
+        with self.lock:
+            self.cache[key] = (now + self.ttl, secret)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.maxSize:
+                self.cache.popitem(last=False)
+        return secret
+
+    def authorize(self, secret: webhookSecret, repository: str | None) -> bool:
+        """Check whether a secret that verified a delivery may sign deliveries for the repository named in its payload.
+
+        Args:
+            secret (webhookSecret): The secret returned by resolve.
+            repository (str | None): The full name of the repository of the payload.
+
+        Returns:
+            bool: True if the delivery is authorized.
+        """
+        if secret.repositories is None:
+            return secret is self.default or not self.bindRepositories
+        return secret.allows(repository)
+
+    def set(self, key: str, secret: str | Iterable[str] | webhookSecret) -> None:
+        """Set the secrets of a key."""
+        self.secrets[key] = toSecret(secret)
+
+    def rotate(self, key: str, secret: str) -> None:
+        """Start accepting a new secret for a key, while still accepting the old ones until they are retired."""
+        current = self.secrets.get(key)
+        self.secrets[key] = webhookSecret(secret) if current is None else current.rotated(secret)
+
+    def retire(self, key: str, secret: str) -> None:
+        """Stop accepting a secret for a key."""
+        self.secrets[key] = self.secrets[key].retired(secret)
+
+    def invalidate(self, key: str | None = None) -> None:
+        """Forget cached results of the resolver, for one key or all of them."""
+        with self.lock:
+            if key is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(key, None)
@@ -0,0 +1,108 @@
+from logging import Logger, Handler, Formatter, LogRecord
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from typing import Any, Mapping
+import copy
+import json
+
+EXCEPTION_FORMATTER = Formatter()
+
+MAX_LOGGED_LENGTH = 2048
+
+FIELDS = ("deliveryId", "provider", "event", "repository", "status", "duration")
+"""Structured fields attached to delivery log records through the extra argument."""
+
+def jsonDefault(value: Any) -> Any:
+    """Render values json can't serialize, turning mappings like event views into dicts."""
+    if isinstance(value, Mapping):
+        return dict(value)
+    return str(value)
+
+class lazyPayload:
+    """A value rendered for logging only when a record is actually emitted, truncated to a maximum length.
+    Pass it as an argument of a %-style log call, so that nothing is rendered when the level is disabled.
+    Values are encoded incrementally, and encoding stops once the limit is reached, so a large payload is never rendered in full."""
+
+    __slots__ = ("value", "limit")
+
+    def __init__(self, value: Any, limit: int = MAX_LOGGED_LENGTH):
+        """Wrap a value.
+
+        Args:
+            value (Any): The value. Strings are logged as they are, anything else is rendered as JSON.
+            limit (int, optional): Maximum number of characters logged. Defaults to MAX_LOGGED_LENGTH.
+        """
+        self.value = value
+        self.limit = limit
+
+    def __str__(self) -> str:
+        if isinstance(self.value, str):
+            if len(self.value) > self.limit:
+                return f"{self.value[:self.limit]}... ({len(self.value) - self.limit} more characters)"
+            return self.value
+        chunks = []
+        length = 0
+        try:
+            for chunk in json.JSONEncoder(default=jsonDefault).iterencode(self.value):
+                chunks.append(chunk)
+                length += len(chunk)
+                if length > self.limit:
+                    return f"{''.join(chunks)[:self.limit]}... (truncated)"
+        except (TypeError, ValueError, RuntimeError): # RuntimeError if another thread changes the payload meanwhile
+            text = repr(self.value)
+            return f"{text[:self.limit]}... (truncated)" if len(text) > self.limit else text
+        return "".join(chunks)
+
+class jsonFormatter(Formatter):
+    """Formats records as single line JSON objects including the structured delivery fields."""
+
+    def format(self, record: LogRecord) -> str:
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text: # formatted before being queued
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class deferredQueueHandler(QueueHandler):
+    """A QueueHandler that leaves formatting and log I/O to the listener thread.
+    The message is still rendered in the logging thread, like QueueHandler does, once the level check passed, since payloads passed as arguments may change or be released as soon as the log call returns.
+    Unlike QueueHandler the record isn't formatted there, so the handlers of the listener format it as usual."""
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        message = record.getMessage()
+        exceptionText = record.exc_text
+        if record.exc_info and not exceptionText:
+            exceptionText = EXCEPTION_FORMATTER.formatException(record.exc_info)
+        record = copy.copy(record)
+        record.message = message
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exceptionText
+        return record
+
+def queueLogging(log: Logger, *handlers: Handler) -> QueueListener:
+    """Make a logger hand its records to a background thread through a queue.
+    The handlers, by default the ones attached to the logger, are moved to a listener thread which is started and returned, and should be stopped on shutdown.
+
+    Args:
+        log (Logger): The logger.
+        handlers (Handler): Handlers the records are emitted to. Defaults to the handlers of the logger.
+
+    Returns:
+        QueueListener: The started listener.
+    """
+    if not handlers:
+        handlers = tuple(log.handlers)
+    for handler in handlers:
+        log.removeHandler(handler)
+    queue: SimpleQueue[LogRecord] = SimpleQueue()
+    log.addHandler(deferredQueueHandler(queue))
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    return listener
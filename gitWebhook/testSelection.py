@@ -0,0 +1,139 @@
+from concurrent.futures import ProcessPoolExecutor
+from fnmatch import fnmatchcase
+from typing import Any, Iterable, Iterator
+from unittest import TestCase, TestSuite, TestResult, TestLoader, defaultTestLoader
+
+def changedFiles(data: dict[str, Any]) -> set[str] | None:
+    """Get the paths of all files added, modified or removed by the commits of a push.
+
+    Args:
+        data (dict[str, Any]): The webhook data.
+
+    Returns:
+        set[str] | None: The paths, or None if they can't be determined, because the payload doesn't list the files, or lists only some of the pushed commits, or the push was forced.
+    """
+    commits = data.get("commits")
+    if not isinstance(commits, list) or not commits or data.get("forced"):
+        return None
+    total = data.get("total_commits_count") # GitLab
+    if isinstance(total, int) and total > len(commits):
+        return None
+    files = set()
+    for commit in commits:
+        for key in ("added", "modified", "removed"):
+            paths = commit.get(key)
+            if paths is None:
+                return None
+            files.update(paths)
+    return files
+
+def iterTests(suite: TestSuite | TestCase) -> Iterator[TestCase]:
+    """Iterate over the individual test cases in a possibly nested suite."""
+    if isinstance(suite, TestSuite):
+        for test in suite:
+            yield from iterTests(test)
+    else:
+        yield suite
+
+class testSelector:
+    """A mapping of file path patterns to the tests affected by changes of the matching files."""
+
+    def __init__(self, mapping: dict[str, TestSuite | Iterable[str]], loader: TestLoader = defaultTestLoader):
+        """Initialize the selector.
+
+        Args:
+            mapping (dict[str, TestSuite | Iterable[str]]): Shell style patterns (src/parser/*) mapped to a suite or test names (tests.test_parser.TestParser). Map a pattern to an empty list to mark files that need no tests, like docs/*.
+            loader (TestLoader, optional): Loader used to load tests by name. Defaults to defaultTestLoader.
+        """
+        self.mapping: list[tuple[str, TestSuite]] = []
+        for pattern, tests in mapping.items():
+            if not isinstance(tests, TestSuite):
+                tests = loader.loadTestsFromNames(list(tests))
+            self.mapping.append((pattern, tests))
+
+    def select(self, tests: TestSuite, files: Iterable[str] | None) -> TestSuite:
+        """Select the tests affected by changes to files.
+        If the files are unknown, or any of them matches no pattern, all tests are selected.
+
+        Args:
+            tests (TestSuite): All tests.
+            files (Iterable[str] | None): The changed files, or None if unknown.
+
+        Returns:
+            TestSuite: The selected tests.
+        """
+        if files is None:
+            return tests
+        selected: dict[str, TestCase] = {}
+        for path in files:
+            matched = False
+            for pattern, subset in self.mapping:
+                if fnmatchcase(path, pattern):
+                    matched = True
+                    for test in iterTests(subset):
+                        selected.setdefault(test.id(), test)
+            if not matched:
+                return tests
+        return TestSuite(selected.values())
+
+class remoteTest:
+    """Stands in for a test that ran in another process, in the failure lists of a merged TestResult."""
+
+    def __init__(self, testId: str):
+        self.testId = testId
+
+    def id(self) -> str:
+        return self.testId
+
+    def __str__(self) -> str:
+        return self.testId
+
+    def __repr__(self) -> str:
+        return f"<remoteTest {self.testId}>"
+
+def runTestIds(ids: list[str]) -> dict[str, Any]:
+    """Load tests by name and run them. Executed in worker processes.
+
+    Args:
+        ids (list[str]): The test names.
+
+    Returns:
+        dict[str, Any]: The number of tests ran, and the failures, errors and skips as (test id, details) pairs.
+    """
+    result = TestResult()
+    defaultTestLoader.loadTestsFromNames(ids).run(result)
+    def pairs(entries):
+        return [(test.id(), details) for test, details in entries]
+    return {
+        "testsRun": result.testsRun,
+        "failures": pairs(result.failures),
+        "errors": pairs(result.errors),
+        "skipped": pairs(result.skipped),
+        "expectedFailures": pairs(result.expectedFailures),
+        "unexpectedSuccesses": [test.id() for test in result.unexpectedSuccesses],
+    }
+
+def runTestsInProcesses(ids: Iterable[str], processes: int) -> TestResult:
+    """Run tests in a pool of processes and merge the results.
+    Tests are loaded by name in the workers, and tests of the same class run together in one worker so that class fixtures are set up once.
+
+    Args:
+        ids (Iterable[str]): Names of the tests, as returned by TestCase.id.
+        processes (int): Number of worker processes.
+
+    Returns:
+        TestResult: The merged result. Tests in its lists are remoteTest instances.
+    """
+    groups: dict[str, list[str]] = {}
+    for testId in ids:
+        groups.setdefault(testId.rpartition(".")[0], []).append(testId)
+    result = TestResult()
+    if not groups:
+        return result
+    with ProcessPoolExecutor(max_workers=min(processes, len(groups))) as executor:
+        for partial in executor.map(runTestIds, groups.values()):
+            result.testsRun += partial["testsRun"]
+            for key in ("failures", "errors", "skipped", "expectedFailures"):
+                getattr(result, key).extend((remoteTest(testId), details) for testId, details in partial[key])
+            result.unexpectedSuccesses.extend(remoteTest(testId) for testId in partial["unexpectedSuccesses"])
+    return result
@@ -1,14 +1,44 @@
-from flask import Blueprint, request, Response, abort, Request
+from flask import Blueprint, request, Response, abort, Request, g
 from hashlib import sha256
-from hmac import new as hmacNew
-from typing import Any, Callable
-from logging import Logger
+from hmac import new as hmacNew, compare_digest
+from typing import Any, Callable, Mapping
+from logging import Logger, INFO
 from .abstractWebhook import gitWebhookBlueprintABC
+from .deliveryCache import deliveryCache as deliveryCacheType
+from .router import eventRouter
+from .intake import readBody, jsonLoads, payloadTooLarge, MAX_BODY_SIZE
+from .ipWhitelist import ipRangeIndex, providerMetaWhitelist, compileWhitelist, forwardedClient
+from .metrics import webhookMetrics, eventLabel
+from .deliveryJournal import deliveryJournal
+from .secretProvider import secretProvider
+from .admission import admissionController, repositoryKey
+from .structuredLog import lazyPayload
+from .events import eventView
+from .capture import deliveryCapture
+from .payload import getRepositoryName
+from math import ceil
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import json
 
 GITHUB_HEADER = "X-Hub-Signature-256"
 
+GITHUB_SIGNATURE_PREFIX = "sha256="
+
 GITLAB_HEADER = "X-Gitlab-Token"
 
+FORWARDED_HEADER = "X-Forwarded-For"
+
+DELIVERY_HEADERS = ("X-GitHub-Delivery", "X-Gitlab-Event-UUID", "X-Gitea-Delivery")
+
+EVENT_HEADERS = ("X-GitHub-Event", "X-Gitlab-Event", "X-Gitea-Event")
+
+def equalSecrets(received: str | None, expected: str) -> bool:
+    """Compare a value sent with a request to the expected secret in constant time"""
+    if received is None:
+        return False
+    return compare_digest(received.encode("utf-8", "surrogateescape"), expected.encode("utf-8")) # compare_digest rejects non ASCII strings
+
 def verifyGithubRequest(request: Request, token:str) -> bool:
     """Verify the GitHub signature of a webhook request"""
     signature = request.headers.get(GITHUB_HEADER)
@@ -16,33 +46,88 @@ def verifyGithubRequest(request: Request, token:str) -> bool:
         return False
     hash_object = hmacNew(token.encode("utf-8"), msg=request.get_data(), digestmod=sha256)
     expected_signature = "sha256=" + hash_object.hexdigest()
-    return signature == expected_signature
+    return equalSecrets(signature, expected_signature)
 
 def verifyGitlabRequest(request: Request, token:str) -> bool:
     """Verify the GitLab token of a webhook request"""
-    return request.headers.get(GITLAB_HEADER) == token
+    return equalSecrets(request.headers.get(GITLAB_HEADER), token)
 
 def verifyBasicAuth(request: Request, token:str) -> bool:
     """Verify the basic authorization of a webhook request"""
-    return str(request.authorization) == token
+    if request.authorization is None:
+        return False
+    return equalSecrets(str(request.authorization), token)
+
+def getDeliveryId(headers: Mapping[str, str]) -> str | None:
+    """Get the unique delivery id of a webhook request, which stays the same when the request is redelivered"""
+    for header in DELIVERY_HEADERS:
+        deliveryId = headers.get(header)
+        if deliveryId:
+            return deliveryId
+    return None
+
+def getProvider(headers: Mapping[str, str]) -> str:
+    """Get the name of the git app that sent a webhook request, based on its event header"""
+    if "X-Gitea-Event" in headers: # Gitea also sends GitHub headers
+        return "gitea"
+    if "X-Gitlab-Event" in headers:
+        return "gitlab"
+    if "X-GitHub-Event" in headers:
+        return "github"
+    return "unknown"
+
+def getEvent(headers: Mapping[str, str]) -> str | None:
+    """Get the event type of a webhook request, with GitLab event names normalized to match the other git apps (Push Hook becomes push)"""
+    for header in EVENT_HEADERS:
+        event = headers.get(header)
+        if event:
+            if event.endswith(" Hook"):
+                event = event[:-5]
+            return event.lower().replace(" ", "_")
+    return None
+
+def deliveryFields(headers: Mapping[str, str], data: dict[str, Any] | None = None, **fields: Any) -> dict[str, Any]:
+    """Collect the structured fields describing a delivery, to be passed as the extra argument of a log call.
+
+    Args:
+        headers (Mapping[str, str]): The request headers.
+        data (dict[str, Any] | None, optional): The webhook data, if it was decoded. Defaults to None.
+        fields (Any): Further fields, like status and duration.
 
-# TODO add automatic github IP whitelisting
+    Returns:
+        dict[str, Any]: The fields.
+    """
+    result = {"deliveryId": getDeliveryId(headers), "provider": getProvider(headers), "event": getEvent(headers), "repository": getRepositoryName(data) if data is not None else None}
+    result.update(fields)
+    return result
 
 class webhookBlueprint(Blueprint, gitWebhookBlueprintABC):
     """Wrapper over the flask blueprint that creates an endpoint for receiving and processing git webhooks. Overwrite the processWebhook method to process the webhook data."""
     
-    def __init__(self, webhookToken:str | None, log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | None = None, *args, **kwargs):
+    def __init__(self, webhookToken:str | secretProvider | None, log:Logger | None = None, name:str="webhook", github:bool=True, gitlab:bool=True, gitea:bool=True, ipWhitelist:list[str] | ipRangeIndex | providerMetaWhitelist | None = None, *args, trustedProxies:list[str] | None = None, deliveryCache:deliveryCacheType | None = None, maxBodySize:int | None = MAX_BODY_SIZE, jsonDecoder:Callable[[bytes | bytearray], Any] = jsonLoads, metrics:webhookMetrics | None = None, metricsRoute:str | None = "/metrics", metricsWhitelist:list[str] | ipRangeIndex | None = None, journal:deliveryJournal | None = None, journalWorkers:int = 1, admission:admissionController | None = None, typedEvents:bool = False, capture:deliveryCapture | None = None, **kwargs):
         """Initailize the webhook blueprint, register the recieveWebhook method as a POST endpoint.
 
         Args:
-            webhookToken (str | None): The token used to verify the webhook. If None, no verification is done.
+            webhookToken (str | secretProvider | None): The token used to verify the webhook, or a secretProvider resolving separate secrets per hook, repository or organization. If None, no verification is done.
             log (Logger | None, optional): Optional logger that will be used by this blueprint. Defaults to None.
             name (str, optional): Flask blueprint name. Must be unique. Defaults to "webhook".
             github (bool, optional): Whether the blueprint should process webhook requests from GitHub. Defaults to True.
             gitlab (bool, optional): Whether the blueprint should process webhook requests from GitLab. Defaults to True.
             gitea (bool, optional): Whether the blueprint should process webhook requests from Gitea or other requests using basic auth. Defaults to True.
-            ipWhitelist (list[str] | None, optional): Optional whitelist that all incoming requests will be checked against. Defaults to None.
+            ipWhitelist (list[str] | ipRangeIndex | providerMetaWhitelist | None, optional): Optional whitelist that all incoming requests will be checked against. Lists may contain addresses and networks, and are compiled into an ipRangeIndex. Use providerMetaWhitelist to whitelist the ranges published by GitHub. Defaults to None.
             args: Additional arguments to pass to the Blueprint constructor.
+            trustedProxies (list[str] | None, optional): Addresses and networks of reverse proxies whose X-Forwarded-For header is trusted when determining the client address. Defaults to None.
+            deliveryCache (deliveryCache | None, optional): Optional cache of seen delivery ids. Redeliveries of a request found in the cache are acknowledged without being processed. Defaults to None.
+            maxBodySize (int | None, optional): Maximum request body size in bytes. Larger requests are rejected with 413, before being read if they declare their length. Defaults to 25 MB.
+            jsonDecoder (Callable[[bytes | bytearray], Any], optional): Function used to decode the request body. Defaults to orjson.loads if orjson is installed and json.loads otherwise.
+            metrics (webhookMetrics | None, optional): Optional collector of per stage latencies and delivery counters. Defaults to None.
+            metricsRoute (str | None, optional): Route at which the metrics are served in the Prometheus text format, if metrics are collected. The route isn't checked against ipWhitelist, since scrapers rarely share addresses with git apps. Defaults to "/metrics".
+            metricsWhitelist (list[str] | ipRangeIndex | None, optional): Optional addresses and networks allowed to scrape the metrics route, others get 403. Defaults to None, which allows everybody.
+            journal (deliveryJournal | None, optional): Optional journal verified deliveries are durably written to before being acknowledged with 202. They are then processed by background workers, and deliveries left unfinished by a restart are replayed once the blueprint is registered. Defaults to None.
+            journalWorkers (int, optional): Number of background workers processing journaled deliveries. Defaults to 1.
+            admission (admissionController | None, optional): Optional limits on the deliveries processed at once and on the rate of deliveries per IP address and repository. Deliveries over a limit are rejected with 503 and Retry-After before their body is read. Defaults to None.
+            typedEvents (bool, optional): Whether handlers receive typed event views, like pushEvent, that decode the payload lazily from the raw body instead of dicts. The views can be used like the dicts. Defaults to False.
+            capture (deliveryCapture | None, optional): Optional capture the deliveries that are processed are recorded to, so that they can be replayed offline using captureReplay. Duplicates, ignored events and rejected deliveries aren't recorded. Defaults to None.
             kwargs: Additional keyword arguments to pass to the Blueprint constructor.
         """
         
@@ -52,23 +137,120 @@ class webhookBlueprint(Blueprint, gitWebhookBlueprintABC):
             if self.log is not None:
                 self.log.warning("No webhook token provided. THIS IS VERY UNSAFE")
         self.webhookToken = webhookToken
+        self.secrets: secretProvider | None = None
+        if isinstance(webhookToken, secretProvider):
+            self.secrets = webhookToken
+        elif webhookToken is not None:
+            self.secrets = secretProvider(default=webhookToken)
         self.github = github
         self.gitlab = gitlab
         self.gitea = gitea
         self.ipWhitelist = ipWhitelist
+        self.trustedProxies = compileWhitelist(trustedProxies)
+        self.deliveryCache = deliveryCache
+        self.maxBodySize = maxBodySize
+        self.jsonDecoder = jsonDecoder
+        self.typedEvents = typedEvents
+        self.capture = capture
+        self.metrics = metrics
+        self.metricsWhitelist = compileWhitelist(metricsWhitelist)
         self.hooks = []
+        self.router = eventRouter()
         self.route("/", methods=["POST"])(self.receiveWebhook)
+        self.admission = admission
+        if self.admission is not None:
+            self.teardown_request(self.releaseAdmission)
+        self.journal = journal
+        self.journalExecutor: ThreadPoolExecutor | None = None
+        if self.journal is not None:
+            self.journalExecutor = ThreadPoolExecutor(journalWorkers, thread_name_prefix=f"{name}-journal")
+            self.record_once(lambda state: self.replayUnfinished())
+        if self.metrics is not None:
+            self.before_request(self.startTimer)
+            self.after_request(self.countDelivery)
+            if metricsRoute is not None:
+                self.route(metricsRoute, methods=["GET"])(self.metricsEndpoint)
     
-    def receiveWebhook(self) -> Response:
+    @property
+    def ipWhitelist(self) -> ipRangeIndex | providerMetaWhitelist | None:
+        """The whitelist all incoming requests are checked against. Lists assigned to it are compiled into an ipRangeIndex."""
+        return self.compiledWhitelist
+    
+    @ipWhitelist.setter
+    def ipWhitelist(self, whitelist:list[str] | ipRangeIndex | providerMetaWhitelist | None) -> None:
+        self.compiledWhitelist = compileWhitelist(whitelist)
+    
+    def clientAddress(self) -> str | None:
+        """Get the address of the client that sent the current request.
+        If the request came through trusted proxies, the address is taken from X-Forwarded-For, skipping the trusted hops from the right.
+
+        Returns:
+            str | None: The client address or None if it is unknown.
+        """
+        return forwardedClient(request.remote_addr, request.headers.get(FORWARDED_HEADER), self.trustedProxies)
+    
+    def verifyOrigin(self) -> None:
+        """Abort the current request with 403 if it doesn't originate from a whitelisted IP address."""
         if self.ipWhitelist is not None:
-            if request.remote_addr is None:
+            address = self.clientAddress()
+            if address is None:
                 if self.log is not None:
                     self.log.warning("Received a request with no IP address")
                 abort(403)
-            if request.remote_addr not in self.ipWhitelist:
+            if address not in self.ipWhitelist:
                 if self.log is not None:
-                    self.log.warning(f"Received a request from an unauthorized IP address: {request.remote_addr}")
+                    self.log.warning(f"Received a request from an unauthorized IP address: {address}")
                 abort(403)
+    
+    def stageDone(self, stage:str, started:float) -> float:
+        """Record the duration of a processing stage, if metrics are collected.
+
+        Args:
+            stage (str): Name of the stage.
+            started (float): perf_counter value from when the stage started.
+
+        Returns:
+            float: perf_counter value from now, for timing the next stage.
+        """
+        now = perf_counter()
+        if self.metrics is not None:
+            self.metrics.observe("stage_seconds", now - started, stage=stage)
+        return now
+    
+    def startTimer(self) -> None:
+        """Remember when the current request started."""
+        g.webhookStarted = perf_counter()
+    
+    def countDelivery(self, response:Response) -> Response:
+        """Count a finished webhook request by git app, event and status code, and record its total duration.
+        The event header is only trusted once the request is verified, unverified requests are counted under the unverified event."""
+        if request.endpoint == f"{self.name}.receiveWebhook":
+            event = eventLabel(g.webhookEvent) if "webhookEvent" in g else "unverified"
+            self.metrics.increment("deliveries_total", provider=getProvider(request.headers), event=event, status=response.status_code)
+            self.metrics.observe("request_seconds", perf_counter() - g.webhookStarted)
+        return response
+    
+    def metricsEndpoint(self) -> Response:
+        """Method that acts as a GET endpoint serving the collected metrics in the Prometheus text format.
+
+        Returns:
+            Response: The metrics.
+        """
+        if self.metricsWhitelist is not None and self.clientAddress() not in self.metricsWhitelist:
+            if self.log is not None:
+                self.log.warning(f"Metrics requested from an unauthorized IP address: {self.clientAddress()}")
+            abort(403)
+        return Response(self.metrics.render(), status=200, mimetype="text/plain; version=0.0.4")
+    
+    def receiveWebhook(self) -> Response:
+        received = started = perf_counter()
+        self.verifyOrigin()
+        started = self.stageDone("origin", started)
+        if self.admission is not None:
+            shed = self.admission.admit(self.clientAddress())
+            if shed is not None:
+                return self.shedDelivery(*shed)
+            g.webhookAdmitted = True
         if self.log is not None:
             self.log.debug("Received a POST request to the webhook endpoint")
         #check if the content type is json
@@ -76,19 +258,33 @@ class webhookBlueprint(Blueprint, gitWebhookBlueprintABC):
             if self.log is not None:
                 self.log.warning(f"A request with an invalid content type: {request.content_type}")
             abort(415)
-        if self.webhookToken is not None: #verification
+        if self.maxBodySize is not None and request.content_length is not None and request.content_length > self.maxBodySize:
+            if self.log is not None:
+                self.log.warning(f"A request with a body too large: {request.content_length}")
+            abort(413)
+        digest = None
+        signature = None
+        secret = None
+        if self.secrets is not None: #verification, headers are checked before the body is read
+            secret = self.secrets.resolve(request.headers)
+            if secret is None:
+                if self.log is not None:
+                    self.log.warning("A request with no known secret")
+                abort(401)
             if GITHUB_HEADER in request.headers and self.github:
-                if not verifyGithubRequest(request, self.webhookToken):
+                signature = request.headers[GITHUB_HEADER]
+                if not signature.startswith(GITHUB_SIGNATURE_PREFIX):
                     if self.log is not None:
                         self.log.warning("A request with an invalid GitHub signaturez")
                     abort(401)
-            elif GITLAB_HEADER in request.headers and self.github:
-                if not verifyGitlabRequest(request, self.webhookToken):
+                digest = secret.digest()
+            elif GITLAB_HEADER in request.headers and self.gitlab:
+                if not secret.verifyToken(request.headers[GITLAB_HEADER]):
                     if self.log is not None:
                         self.log.warning("A request with an invalid GitLab token")
                     abort(401)
             elif request.authorization is not None and self.gitea: # basic authorization which is what Gitea uses
-                if not verifyBasicAuth(request, self.webhookToken):
+                if not secret.verifyToken(str(request.authorization)):
                     if self.log is not None:
                         self.log.warning("A request with an invalid basic authorization")
                     abort(401)
@@ -96,19 +292,172 @@ class webhookBlueprint(Blueprint, gitWebhookBlueprintABC):
                 if self.log is not None:
                     self.log.warning("A request with no signature found")
                 abort(401) #no feedback, in case somebody is trying to guess the token
+        try:
+            body = readBody(request.stream, request.content_length, self.maxBodySize, digest)
+        except payloadTooLarge:
+            if self.log is not None:
+                self.log.warning("A request with a body too large")
+            abort(413)
+        if digest is not None and not digest.matches(signature, GITHUB_SIGNATURE_PREFIX):
+            if self.log is not None:
+                self.log.warning("A request with an invalid GitHub signaturez")
+            abort(401)
+        g.webhookBody = body
+        request._cached_data = body # the stream is consumed, so that request.get_data and get_json keep working in hooks
+        g.webhookEvent = getEvent(request.headers)
+        if self.admission is not None: # the repository headers can only be trusted once the delivery is verified
+            shed = self.admission.admitRepository(repositoryKey(request.headers))
+            if shed is not None:
+                return self.shedDelivery(*shed)
+        started = self.stageDone("verify", started)
         #logs beforehand were warnings, so that messages regarding unauthorized requests can be filtered
-        for hook in self.hooks:
-            hook()
-        data = request.json
-        if data is None or not isinstance(data, dict):
+        deliveryId = getDeliveryId(request.headers)
+        if self.deliveryCache is not None:
+            if deliveryId is not None and not self.deliveryCache.add(deliveryId):
+                if self.log is not None:
+                    self.log.info("Ignoring duplicate delivery %s", deliveryId, extra=deliveryFields(request.headers, status=200))
+                return Response("Duplicate delivery", status=200)
+        try: # deliveries that fail are forgotten, so that their redelivery is processed
+            for hook in self.hooks:
+                hook()
+            started = self.stageDone("hooks", started)
+            event = g.webhookEvent
+            if not self.acceptsEvent(event):
+                if self.log is not None:
+                    self.log.debug(f"Ignoring unhandled event {event}")
+                return Response("Event ignored", status=200)
+            try:
+                data = self.decodePayload(event, body)
+            except ValueError:
+                data = None
+            if data is None or not isinstance(data, Mapping):
+                if self.log is not None:
+                    self.log.error("A request with invalid JSON")
+                abort(400, "Invalid JSON")
+            if secret is not None and not self.secrets.authorize(secret, getRepositoryName(data)):
+                if self.log is not None:
+                    self.log.warning("A request signed with a secret not valid for repository %s", getRepositoryName(data))
+                abort(403)
+            started = self.stageDone("parse", started)
+            #at this point the webhook is verified
+            if self.capture is not None: # only deliveries that are processed, so that replays see the same traffic
+                self.capture.record(request.headers, body, event)
+            if self.journal is not None:
+                seq = self.journal.append(deliveryId, event, body)
+                admitted = g.pop("webhookAdmitted", False) # the admission is held until the background work is done
+                try:
+                    self.journalExecutor.submit(self.processJournalEntry, seq, event, data, admitted)
+                except BaseException:
+                    if admitted:
+                        self.admission.release()
+                    raise
+                self.stageDone("journal", started)
+                if self.log is not None and self.log.isEnabledFor(INFO):
+                    self.log.info("Webhook journaled as %d", seq, extra=deliveryFields(request.headers, data, status=202, duration=perf_counter() - received))
+                return Response(json.dumps({"seq": seq}), status=202, mimetype="application/json")
+            ret = self.dispatchWebhook(event, data)
+            if ret[0] >= 500:
+                self.forgetDelivery(deliveryId) # let the git app retry
+            self.stageDone("process", started)
+            if self.log is not None and self.log.isEnabledFor(INFO):
+                self.log.info("Webhook processed with status code %d and message: %s", ret[0], lazyPayload(ret[1]), extra=deliveryFields(request.headers, data, status=ret[0], duration=perf_counter() - received))
+            return Response(ret[1], status=ret[0])
+        except BaseException:
+            self.forgetDelivery(deliveryId)
+            raise
+    
+    def forgetDelivery(self, deliveryId:str | None) -> None:
+        """Remove a delivery that wasn't processed from the delivery cache, so that a redelivery is processed."""
+        if deliveryId is not None and self.deliveryCache is not None:
+            self.deliveryCache.discard(deliveryId)
+    
+    def decodePayload(self, event:str | None, body:bytes | bytearray) -> dict[str, Any] | Mapping[str, Any]:
+        """Decode a request body, into a typed event view if typedEvents is enabled.
+
+        Args:
+            event (str | None): The event type.
+            body (bytes | bytearray): The raw request body.
+
+        Raises:
+            ValueError: If the body isn't valid JSON.
+
+        Returns:
+            dict[str, Any] | Mapping[str, Any]: The webhook data.
+        """
+        if self.typedEvents:
+            return eventView(event, body)
+        return self.jsonDecoder(body)
+    
+    def shedDelivery(self, reason:str, retryAfter:float) -> Response:
+        """Reject a delivery over a limit of the admission controller with 503 and Retry-After."""
+        if self.metrics is not None:
+            self.metrics.increment("shed_total", reason=reason)
+        if self.log is not None:
+            self.log.warning(f"Shedding a delivery from {self.clientAddress()}, {reason} limit reached")
+        return Response("Too many deliveries", status=503, headers={"Retry-After": str(ceil(retryAfter))})
+    
+    def releaseAdmission(self, exception:BaseException | None) -> None:
+        """Release the admission of a delivery once its request is torn down."""
+        if g.pop("webhookAdmitted", False):
+            self.admission.release()
+    
+    def processJournalEntry(self, seq:int, event:str | None, data:dict[str, Any], admitted:bool = False) -> tuple[int, str]:
+        """Process a journaled delivery and record its completion in the journal.
+
+        Args:
+            seq (int): The sequence number of the journal entry.
+            event (str | None): The event type.
+            data (dict[str, Any]): The webhook data.
+            admitted (bool, optional): Whether the delivery holds an admission, which is released once it is processed. Defaults to False.
+
+        Returns:
+            tuple[int, str]: HTTP return code with a message
+        """
+        try:
+            ret = self.dispatchWebhook(event, data)
+        except Exception as e:
             if self.log is not None:
-                self.log.error("A request with invalid JSON")
-            abort(400, "Invalid JSON")
-        #at this point the webhook is verified
-        ret = self.processWebhook(data)
+                self.log.error(f"Error while processing journaled delivery {seq}: {e}")
+            ret = (500, str(e))
+        finally:
+            if admitted:
+                self.admission.release()
+        self.journal.complete(seq, ret[0], ret[1])
         if self.log is not None:
-            self.log.info(f"Webhook processed with status code {ret[0]} and message: {ret[1]}")
-        return Response(ret[1], status=ret[0])
+            self.log.info("Journaled delivery %d processed with status code %d and message: %s", seq, ret[0], lazyPayload(ret[1]), extra={"event": event, "repository": getRepositoryName(data), "status": ret[0]})
+        return ret
+    
+    def replayUnfinished(self) -> int:
+        """Queue the journaled deliveries that were never finished, for example because the process restarted, for processing.
+        Deliveries still owned by other workers sharing the journal are left to them.
+
+        Returns:
+            int: The number of queued deliveries.
+        """
+        entries = self.journal.claimUnfinished()
+        for entry in entries:
+            self.journalExecutor.submit(self.processJournalEntry, entry.seq, entry.event, self.decodePayload(entry.event, entry.body))
+        if entries and self.log is not None:
+            self.log.info(f"Replaying {len(entries)} unfinished deliveries")
+        return len(entries)
+    
+    def replay(self, since:float | None = None, until:float | None = None, event:str | None = None) -> list[tuple[int, int, str]]:
+        """Process journaled deliveries again, for example to backfill a newly added handler. Runs in the calling thread.
+
+        Args:
+            since (float | None, optional): Only deliveries received at or after this UNIX timestamp. Defaults to None.
+            until (float | None, optional): Only deliveries received before this UNIX timestamp. Defaults to None.
+            event (str | None, optional): Only deliveries of this event type. Defaults to None.
+
+        Raises:
+            ValueError: If the blueprint has no journal.
+
+        Returns:
+            list[tuple[int, int, str]]: The sequence number, status code and message of every processed delivery.
+        """
+        if self.journal is None:
+            raise ValueError("The blueprint has no journal")
+        return [(entry.seq, *self.processJournalEntry(entry.seq, entry.event, self.decodePayload(entry.event, entry.body))) for entry in self.journal.entries(since, until, event)]
     
     def processWebhook(self, data:dict[str, Any]) -> tuple[int, str]:
         """Process the webhook. Return a tuple of (status code, message)
@@ -121,16 +470,63 @@ class webhookBlueprint(Blueprint, gitWebhookBlueprintABC):
         """
         return (200, "OK")
     
+    def acceptsEvent(self, event:str | None) -> bool:
+        """Check whether a delivery of the given event type should be processed. Deliveries that aren't are acknowledged before their body is parsed.
+        Once any handler has been registered using on, only events with registered handlers are accepted.
+
+        Args:
+            event (str | None): The event type, or None if the request didn't specify one.
+
+        Returns:
+            bool: True if the delivery should be processed.
+        """
+        return not self.router or self.router.handles(event)
+    
+    def dispatchWebhook(self, event:str | None, data:dict[str, Any]) -> tuple[int, str]:
+        """Call the handlers registered using on that match the delivery, and then process the webhook.
+
+        Args:
+            event (str | None): The event type, or None if the request didn't specify one.
+            data (dict[str, Any]): The webhook data
+        
+        Returns:
+            tuple[int, str]: HTTP return code with a message
+        """
+        for handler in self.router.match(event, data):
+            if self.metrics is None:
+                handler(data)
+                continue
+            started = perf_counter()
+            try:
+                handler(data)
+            finally:
+                self.metrics.observe("function_seconds", perf_counter() - started, function=handler.__name__)
+        return self.processWebhook(data)
+    
+    def on(self, event:str, ref:str | None = None, repo:str | None = None) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+        """Decorator registering a function that will be called with the webhook data, only for deliveries of the given event type.
+        Handlers are kept in an index keyed by event type and ref, so deliveries only reach the handlers interested in them.
+        
+        Args:
+            event (str): The event type, for example push or pull_request. GitLab event names are normalized, so Merge Request Hook becomes merge_request. Use * to match all events.
+            ref (str | None, optional): Full ref the handler is limited to, for example refs/heads/main. Defaults to None.
+            repo (str | None, optional): Repository name or shell style pattern the handler is limited to, for example org/*. Defaults to None.
+        """
+        def decorator(func:Callable[..., Any]) -> Callable[..., Any]:
+            self.router.add(event, func, ref, repo)
+            return func
+        return decorator
+    
     def hook(self, func:Callable[..., Any]) -> Callable[..., Any]:
         """Adds a function to the list of functions that will be called when a webhook is received.
         This is different from what functionWebhook functions do as this function is called before the processWebhook method and the return value is not checked.
+        The request body has already been read at that point, and is available as flask.g.webhookBody as well as through request.get_data and request.get_json.
         
         Args:
             func (Callable): The function to add to the list of functions that will be called when a webhook is received.
         """
         self.hooks.append(func)
         def inner(*args, **kwargs):
-            print("test")
             if self.log is not None:
                 self.log.debug("Received a POST request to a hooked function")
             return func(*args, **kwargs)
@@ -0,0 +1,174 @@
+from subprocess import run, CompletedProcess
+from threading import Lock
+from time import time
+from typing import Any
+import json
+import os
+from .payload import isSha
+
+class deployError(Exception):
+    """Raised when preparing or switching a deployment fails."""
+
+class worktreeDeployer:
+    """Deploys revisions of a repository by preparing them in git worktrees and atomically pointing a symlink at the live one.
+    Worktrees are reused, so preparing a revision only updates the files that changed, and previous deployments are kept around for instant rollback."""
+
+    def __init__(self, repository: str, livePath: str, worktreesPath: str | None = None, branch: str = "main", remote: str = "origin", keep: int = 2, testCommand: list[str] | None = None, gitCommand: str = "/usr/bin/git", commandEnv: dict[str, str] | None = None):
+        """Initialize the deployer.
+
+        Args:
+            repository (str): Path to the repository (a clone, possibly bare) whose object store the worktrees share.
+            livePath (str): Path of the symlink pointing at the live worktree. Must be a symlink or not exist.
+            worktreesPath (str | None, optional): Directory holding the worktrees. Defaults to None, which is livePath with a .worktrees suffix.
+            branch (str, optional): The deployed branch. Defaults to "main".
+            remote (str, optional): The remote fetched from. Defaults to "origin".
+            keep (int, optional): Number of previous deployments kept for rollback. Defaults to 2.
+            testCommand (list[str] | None, optional): Optional command ran inside a prepared worktree. The deployment only goes live if it succeeds. Defaults to None.
+            gitCommand (str, optional): Path to the git executable. Defaults to "/usr/bin/git".
+            commandEnv (dict[str, str] | None, optional): Optional environment that will be used by git and the test command. Defaults to None.
+
+        Raises:
+            ValueError: If livePath exists and isn't a symlink.
+        """
+        if os.path.lexists(livePath) and not os.path.islink(livePath):
+            raise ValueError(f"{livePath} exists and is not a symlink")
+        self.repository = os.path.abspath(repository)
+        self.livePath = os.path.abspath(livePath)
+        self.worktreesPath = os.path.abspath(worktreesPath if worktreesPath is not None else f"{livePath}.worktrees")
+        self.branch = branch
+        self.ref = f"refs/heads/{branch}"
+        self.remote = remote
+        self.keep = keep
+        self.testCommand = testCommand
+        self.gitCommand = gitCommand
+        self.commandEnv = commandEnv
+        self.lock = Lock()
+        self.statePath = os.path.join(self.worktreesPath, "deployments.json")
+        os.makedirs(self.worktreesPath, exist_ok=True)
+        self.history: list[dict[str, Any]] = []
+        if os.path.exists(self.statePath):
+            with open(self.statePath) as f:
+                self.history = json.load(f)
+        self.git(self.repository, "worktree", "prune")
+
+    def git(self, cwd: str, *args: str) -> CompletedProcess:
+        """Run a git command, raising deployError if it fails."""
+        process = run([self.gitCommand, *args], cwd=cwd, env=self.commandEnv, capture_output=True)
+        if process.returncode != 0:
+            raise deployError(f"git {args[0]} failed: {process.stderr.decode('utf-8').strip()}")
+        return process
+
+    def live(self) -> str | None:
+        """Get the SHA of the live deployment, or None if nothing was deployed yet."""
+        if not self.history:
+            return None
+        return self.history[0]["sha"]
+
+    def fetch(self, sha: str | None = None) -> str:
+        """Fetch the deployed branch into the repository.
+
+        Args:
+            sha (str | None, optional): The commit that should be deployed. It is fetched directly if the branch moved past it. Defaults to None, which is the tip of the branch.
+
+        Raises:
+            ValueError: If sha isn't a full commit SHA.
+            deployError: If fetching failed.
+
+        Returns:
+            str: The SHA of the commit to deploy.
+        """
+        if sha is not None and not isSha(sha):
+            raise ValueError(f"Invalid commit SHA: {sha!r}")
+        self.git(self.repository, "fetch", "--no-tags", self.remote, f"+{self.ref}:refs/remotes/{self.remote}/{self.branch}")
+        if sha is None:
+            return self.git(self.repository, "rev-parse", f"refs/remotes/{self.remote}/{self.branch}").stdout.decode("utf-8").strip()
+        if run([self.gitCommand, "cat-file", "-e", "--end-of-options", f"{sha}^{{commit}}"], cwd=self.repository, env=self.commandEnv, capture_output=True).returncode != 0:
+            self.git(self.repository, "fetch", "--no-tags", "--end-of-options", self.remote, sha)
+        return sha
+
+    def prepare(self, sha: str) -> str:
+        """Check out a commit in a worktree that is neither live nor kept for rollback.
+        An existing worktree is reused if there is one, so only the changed files are written.
+
+        Args:
+            sha (str): The commit.
+
+        Raises:
+            deployError: If the checkout failed.
+
+        Returns:
+            str: Path to the worktree.
+        """
+        used = {deployment["path"] for deployment in self.history}
+        slots = [os.path.join(self.worktreesPath, str(i)) for i in range(self.keep + 2)]
+        free = [slot for slot in slots if slot not in used]
+        existing = [slot for slot in free if os.path.isdir(slot)]
+        if existing:
+            path = existing[0]
+            self.git(path, "checkout", "--quiet", "--force", "--detach", sha, "--") # checkout --detach rejects --end-of-options
+            self.git(path, "clean", "-fdq")
+        else:
+            path = free[0]
+            self.git(self.repository, "worktree", "add", "--detach", "--end-of-options", path, sha)
+        return path
+
+    def test(self, path: str) -> tuple[bool, str]:
+        """Run the test command inside a worktree.
+
+        Args:
+            path (str): Path to the worktree.
+
+        Returns:
+            tuple[bool, str]: Whether the command succeeded and its output.
+        """
+        if self.testCommand is None:
+            return True, ""
+        process = run(self.testCommand, cwd=path, env=self.commandEnv, capture_output=True)
+        return process.returncode == 0, (process.stdout + process.stderr).decode("utf-8", "replace")
+
+    def switch(self, path: str) -> None:
+        """Atomically point the live symlink at a worktree."""
+        temporary = f"{self.livePath}.{os.getpid()}.tmp"
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+        os.symlink(path, temporary)
+        os.replace(temporary, self.livePath)
+
+    def activate(self, path: str, sha: str) -> None:
+        """Make a prepared worktree live, and forget deployments beyond the ones kept for rollback.
+
+        Args:
+            path (str): Path to the worktree.
+            sha (str): The commit checked out in it.
+        """
+        self.switch(path)
+        self.history.insert(0, {"path": path, "sha": sha, "deployed": time()})
+        del self.history[self.keep + 1:]
+        self.save()
+
+    def rollback(self, steps: int = 1) -> str:
+        """Make a previous deployment live again.
+
+        Args:
+            steps (int, optional): How many deployments to go back. Defaults to 1.
+
+        Raises:
+            deployError: If there aren't that many previous deployments.
+
+        Returns:
+            str: The SHA of the deployment that is live now.
+        """
+        with self.lock:
+            if steps < 1 or steps >= len(self.history):
+                raise deployError(f"There are only {max(len(self.history) - 1, 0)} previous deployments")
+            self.switch(self.history[steps]["path"])
+            del self.history[:steps]
+            self.save()
+            return self.history[0]["sha"]
+
+    def save(self) -> None:
+        """Store the deployment history."""
+        temporary = f"{self.statePath}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(self.history, f)
+        os.replace(temporary, self.statePath)
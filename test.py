@@ -1,8 +1,40 @@
 import unittest
 from flask import Request, Flask
-from gitWebhook.webhook import verifyGithubRequest, verifyGitlabRequest, webhookBlueprint
+from gitWebhook.webhook import verifyGithubRequest, verifyGitlabRequest, webhookBlueprint, getEvent
 from gitWebhook.functionWebhook import functionWebhookBlueprint
+from gitWebhook.pullerWebhook import pullerWebhookBlueprint
+from gitWebhook.jobQueue import jobQueue
+from gitWebhook.payload import getRepositoryName, getRef, getAfter
+from gitWebhook.deliveryCache import deliveryCache, sqliteDeliveryCache
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import io
+from gitWebhook.intake import readBody, payloadTooLarge
+from gitWebhook.ipWhitelist import ipRangeIndex, providerMetaWhitelist
+from gitWebhook.asyncWebhook import asyncWebhookBlueprint, asyncFunctionWebhookBlueprint
+from gitWebhook.metrics import webhookMetrics, histogram
+from gitWebhook.multiPullerWebhook import multiPullerWebhookBlueprint, repositoryCheckout
+from gitWebhook.worktreeDeploy import worktreeDeployer, deployError
+from gitWebhook.deliveryJournal import deliveryJournal
+from gitWebhook.secretProvider import secretProvider, webhookSecret
+from gitWebhook.admission import admissionController
+from gitWebhook.coordination import workerCoordinator, fileLock
+from gitWebhook.events import eventView, pushEvent, pullRequestEvent, pipelineEvent
+from gitWebhook.capture import deliveryCapture, readCapture, capturedDelivery
+from gitWebhook.replay import captureReplay
+from gitWebhook.structuredLog import lazyPayload, jsonFormatter, queueLogging
+from gitWebhook.testSelection import testSelector, changedFiles, runTestsInProcesses, remoteTest
+from subprocess import run, Popen, PIPE
+import sys
+import benchmark
+import os
 import random
+import json
+import time
+import threading
+from shutil import which
+import logging
 from hmac import new as hmacNew
 from hashlib import sha256
 
@@ -33,6 +65,12 @@ class TestVerification(unittest.TestCase):
         self.assertTrue(verifyGitlabRequest(self.validRequest, "1234"))
         self.assertFalse(verifyGitlabRequest(self.validRequest, "12345"))
         self.assertFalse(verifyGitlabRequest(self.invalidRequest, "1234"))
+        self.assertFalse(verifyGitlabRequest(self.validRequest, "1234\u00e9"))
+
+def signedJson(token:str, payload:dict) -> tuple[dict[str, str], bytes]:
+    data = json.dumps(payload).encode("utf-8")
+    hash_object = hmacNew(token.encode("utf-8"), msg=data, digestmod=sha256)
+    return {"X-Hub-Signature-256": f"sha256={hash_object.hexdigest()}", "Content-Type": "application/json"}, data
 
 # TODO add tests for basic auth
 
@@ -104,11 +142,11 @@ class TestWehbookBlueprint(unittest.TestCase):
         limitedHeaders["Content-Type"] = "application/json"
         self.webhook.github = False
         resp = self.client.post("/valid/", headers=limitedHeaders, data=request.data)
-        self.assertEqual(resp.status_code, 401)
+        self.assertEqual(resp.status_code, 400)
         self.webhook.github = True
         self.webhook.gitlab = False
         resp = self.client.post("/valid/", headers=limitedHeaders, data=request.data)
-        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.status_code, 401)
     
     def testProcessWebhook(self):
         self.assertEqual(self.webhook.processWebhook({"test":"test"}), (200, "OK"))
@@ -143,6 +181,96 @@ class TestFunctionWebhookBlueprint(unittest.TestCase):
     def testProcessWebhook(self):
         self.assertEqual(self.webhook.processWebhook({"test":"test"}), (400, '{"<lambda>": false}'))
 
+class TestConcurrentFunctions(unittest.TestCase):
+    def testConcurrent(self):
+        def slow(data):
+            time.sleep(0.1)
+            return True
+        async def slowAsync(data):
+            await asyncio.sleep(0.1)
+            return "async"
+        webhook = functionWebhookBlueprint(VALID_TOKEN, name="valid", functions=[slow, slowAsync], maxWorkers=4)
+        start = time.monotonic()
+        code, message = webhook.processWebhook({"test":"test"})
+        self.assertLess(time.monotonic() - start, 0.18)
+        self.assertEqual(code, 200)
+        self.assertEqual(message, str({"slow": True, "slowAsync": "async"}))
+    
+    def testTimeout(self):
+        def fast(data):
+            return True
+        def slow(data):
+            time.sleep(0.2)
+            return True
+        async def slowAsync(data):
+            await asyncio.sleep(0.2)
+            return True
+        webhook = functionWebhookBlueprint(VALID_TOKEN, name="valid", functions=[fast, slow, slowAsync], maxWorkers=4, timeout=1.0, timeouts={"slow": 0.05, "slowAsync": 0.05})
+        code, message = webhook.processWebhook({"test":"test"})
+        self.assertEqual(code, 400)
+        output = json.loads(message)
+        self.assertTrue(output["fast"])
+        self.assertIn("Timed out", output["slow"])
+        self.assertIn("Timed out", output["slowAsync"])
+    
+    def testQueuedTimeout(self):
+        def first(data):
+            time.sleep(0.1)
+            return True
+        def second(data):
+            time.sleep(0.1)
+            return True
+        webhook = functionWebhookBlueprint(VALID_TOKEN, name="valid", functions=[first, second], maxWorkers=1, timeout=0.15)
+        self.assertEqual(webhook.processWebhook({"test":"test"})[0], 200) # second waits for first without timing out
+    
+    def testLeakedThreads(self):
+        release = threading.Event()
+        def stuck(data):
+            return release.wait(5)
+        webhook = functionWebhookBlueprint(VALID_TOKEN, name="valid", functions=[stuck], maxWorkers=1, timeout=0.05)
+        self.assertEqual(webhook.processWebhook({"test":"test"})[0], 400)
+        self.assertEqual(webhook.leaked, 1)
+        self.assertEqual(webhook.processWebhook({"test":"test"})[0], 503)
+        release.set()
+        webhook.executor.shutdown()
+        self.assertEqual(webhook.leaked, 0)
+    
+    def testSequentialAsync(self):
+        async def asyncFunction(data):
+            return False
+        webhook = functionWebhookBlueprint(VALID_TOKEN, name="valid", functions=[asyncFunction])
+        self.assertEqual(webhook.processWebhook({"test":"test"}), (400, '{"asyncFunction": false}'))
+
+class TestBatching(unittest.TestCase):
+    def testBatches(self):
+        metrics = webhookMetrics()
+        webhook = functionWebhookBlueprint(VALID_TOKEN, [], name="valid", metrics=metrics)
+        batches = []
+        @webhook.batch("status", maxSize=3, maxDelay=10)
+        def statuses(payloads):
+            batches.append([data["id"] for data in payloads])
+            return True
+        @webhook.batch("check_run", maxDelay=0.05)
+        async def checks(payloads):
+            raise ValueError("downstream unavailable")
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        client = app.test_client()
+        for i in range(4):
+            headers, data = signedJson(VALID_TOKEN, {"id": i})
+            headers["X-GitHub-Event"] = "status"
+            self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 200)
+        headers, data = signedJson(VALID_TOKEN, {"id": 4})
+        headers["X-GitHub-Event"] = "check_run"
+        self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 200)
+        headers["X-GitHub-Event"] = "push"
+        self.assertEqual(client.post("/valid/", headers=headers, data=data).data, b"Event ignored")
+        time.sleep(0.2)
+        self.assertEqual(metrics.get("batches_total", function="checks", status="failed"), 1)
+        webhook.flushBatches()
+        self.assertEqual(batches, [[0, 1, 2], [3]])
+        self.assertEqual(metrics.get("batched_deliveries_total", function="statuses", status="passed"), 4)
+
 class TestHooks(unittest.TestCase):
     def setUp(self) -> None:
         self.webhook = webhookBlueprint(VALID_TOKEN, name="valid")
@@ -161,6 +289,1130 @@ class TestHooks(unittest.TestCase):
         request.headers["Content-Type"] = "application/json"
         resp = self.client.post("/valid/", headers=request.headers, data=request.data)
         self.assertTrue(self.hooked)
+    
+    def testHookReadsBody(self):
+        from flask import request
+        bodies = []
+        @self.webhook.hook
+        def hook():
+            bodies.append((request.get_json(), request.get_data()))
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 200)
+        self.assertEqual(bodies, [({"test": "test"}, data)])
+
+class TestPullerWebhookBlueprint(unittest.TestCase):
+    def setUp(self) -> None:
+        self.webhook = pullerWebhookBlueprint(VALID_TOKEN, name="valid", gitCommand=which("true"), asyncJobs=True)
+        self.app = Flask(__name__)
+        self.app.register_blueprint(self.webhook, url_prefix="/valid")
+        self.app.config.update({"TESTING": True})
+        self.client = self.app.test_client()
+        return super().setUp()
+    
+    def tearDown(self) -> None:
+        self.webhook.jobs.shutdown()
+        return super().tearDown()
+    
+    def testAsyncJob(self):
+        headers, data = signedJson(VALID_TOKEN, {"ref": "refs/heads/main"})
+        resp = self.client.post("/valid/", headers=headers, data=data)
+        self.assertEqual(resp.status_code, 202)
+        jobId = json.loads(resp.data)["id"]
+        for _ in range(100):
+            status = self.client.get(f"/valid/jobs/{jobId}").json
+            if status["status"] not in ("queued", "running"):
+                break
+            time.sleep(0.01)
+        self.assertEqual(status["status"], "passed")
+        self.assertEqual(status["code"], 200)
+        self.assertIsNotNone(status["duration"])
+        
+    def testUnknownJob(self):
+        self.assertEqual(self.client.get("/valid/jobs/unknown").status_code, 404)
+
+class TestCoalescing(unittest.TestCase):
+    def setUp(self) -> None:
+        self.queue = jobQueue()
+        self.runs = []
+        return super().setUp()
+    
+    def tearDown(self) -> None:
+        self.queue.shutdown()
+        return super().tearDown()
+    
+    def testCoalesce(self):
+        jobs = [self.queue.submit(lambda i=i: self.runs.append(i) or (200, "OK"), ("repo", "main"), 0.05) for i in range(5)]
+        self.assertTrue(all(job is jobs[0] for job in jobs))
+        other = self.queue.submit(lambda: self.runs.append("other") or (200, "OK"), ("repo", "dev"), 0.05)
+        self.assertIsNot(other, jobs[0])
+        time.sleep(0.2)
+        self.queue.shutdown()
+        self.assertEqual(sorted(self.runs, key=str), [4, "other"])
+        self.assertEqual(jobs[0].coalesced, 4)
+        self.assertEqual(jobs[0].status, "passed")
+        self.assertEqual(self.queue.keyLocks, {})
+    
+    def testKeyLocksDropped(self):
+        queue = jobQueue(maxWorkers=4)
+        for i in range(20):
+            queue.submit(lambda: time.sleep(0.01) or (200, "OK"), ("repo", f"branch{i % 5}"))
+        queue.shutdown()
+        self.assertEqual((queue.keyLocks, queue.keyJobs), ({}, {}))
+        queue = jobQueue()
+        queue.submit(lambda: (200, "OK"), ("repo", "main"), 10.0)
+        queue.shutdown(wait=False)
+        self.assertEqual((queue.keyLocks, queue.keyJobs), ({}, {}))
+    
+    def testPayloadFields(self):
+        github = {"ref": "refs/heads/main", "after": "a" * 40, "repository": {"full_name": "org/repo"}}
+        gitlab = {"ref": "refs/heads/main", "after": "0" * 40, "project": {"path_with_namespace": "group/repo"}}
+        self.assertEqual(getRepositoryName(github), "org/repo")
+        self.assertEqual(getRepositoryName(gitlab), "group/repo")
+        self.assertEqual(getRef(gitlab), "refs/heads/main")
+        self.assertEqual(getAfter(github), "a" * 40)
+        self.assertIsNone(getAfter(gitlab))
+        self.assertIsNone(getRepositoryName({}))
+    
+    def testPullerCoalesce(self):
+        webhook = pullerWebhookBlueprint(VALID_TOKEN, name="valid", gitCommand=which("true"), asyncJobs=True, coalesceWindow=0.05)
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        client = app.test_client()
+        headers, data = signedJson(VALID_TOKEN, {"ref": "refs/heads/main", "repository": {"full_name": "org/repo"}})
+        ids = {json.loads(client.post("/valid/", headers=headers, data=data).data)["id"] for _ in range(3)}
+        self.assertEqual(len(ids), 1)
+        webhook.jobs.shutdown()
+        self.assertRaises(ValueError, pullerWebhookBlueprint, VALID_TOKEN, coalesceWindow=1.0)
+
+class gitTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.env = dict(os.environ, GIT_AUTHOR_NAME="test", GIT_AUTHOR_EMAIL="test@example.com", GIT_COMMITTER_NAME="test", GIT_COMMITTER_EMAIL="test@example.com")
+        self.upstream = os.path.join(self.dir.name, "upstream")
+        self.git("init", "-q", "-b", "main", self.upstream)
+        self.commit()
+        return super().setUp()
+    
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+        return super().tearDown()
+    
+    def git(self, *args, cwd=None) -> str:
+        return run(["git", *args], cwd=cwd, env=self.env, capture_output=True, check=True).stdout.decode("utf-8").strip()
+    
+    def commit(self) -> str:
+        self.git("commit", "-q", "--allow-empty", "-m", "change", cwd=self.upstream)
+        return self.git("rev-parse", "HEAD", cwd=self.upstream)
+    
+    def clone(self, name, *args) -> str:
+        path = os.path.join(self.dir.name, name)
+        self.git("clone", "-q", *args, "file://" + self.upstream, path)
+        return path
+
+class TestMultiPuller(gitTestCase):
+    def testDeploy(self):
+        full = self.clone("full")
+        shallow = self.clone("shallow", "--depth=1")
+        webhook = multiPullerWebhookBlueprint(VALID_TOKEN, [repositoryCheckout("org/repo", full), repositoryCheckout("org/other", shallow, depth=1)], name="valid", gitCommand=which("git"), commandEnv=self.env)
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        client = app.test_client()
+        for repository, path in (("org/repo", full), ("org/other", shallow)):
+            after = self.commit()
+            self.commit() # the branch moves on before the delivery is processed
+            headers, data = signedJson(VALID_TOKEN, {"ref": "refs/heads/main", "after": after, "repository": {"full_name": repository}})
+            response = client.post("/valid/", headers=headers, data=data)
+            self.assertEqual(response.status_code, 200, response.data)
+            self.assertEqual(webhook.head(path), after)
+            self.assertEqual(client.post("/valid/", headers=headers, data=data).data, b"Already up to date")
+        headers, data = signedJson(VALID_TOKEN, {"ref": "refs/heads/dev", "after": after, "repository": {"full_name": "org/repo"}})
+        self.assertEqual(client.post("/valid/", headers=headers, data=data).data, b"No checkout registered")
+        self.assertRaises(ValueError, webhook.addCheckout, repositoryCheckout("org/repo", shallow))
+    
+    def testFailedTests(self):
+        path = self.clone("full")
+        previous = self.git("rev-parse", "HEAD", cwd=path)
+        class failing(unittest.TestCase):
+            def runTest(self):
+                self.fail()
+        webhook = multiPullerWebhookBlueprint(None, [repositoryCheckout("org/repo", path, tests=unittest.TestSuite([failing()]))], gitCommand=which("git"), commandEnv=self.env)
+        code, _ = webhook.pullAndTest({"ref": "refs/heads/main", "after": self.commit(), "repository": {"full_name": "org/repo"}})
+        self.assertEqual(code, 428)
+        self.assertEqual(webhook.head(path), previous)
+        unborn = os.path.join(self.dir.name, "unborn")
+        self.git("init", "-q", "-b", "main", unborn)
+        self.git("remote", "add", "origin", "file://" + self.upstream, cwd=unborn)
+        webhook.addCheckout(repositoryCheckout("org/unborn", unborn, tests=unittest.TestSuite([failing()])))
+        code, message = webhook.pullAndTest({"ref": "refs/heads/main", "after": self.commit(), "repository": {"full_name": "org/unborn"}})
+        self.assertEqual(code, 428)
+        self.assertTrue(message.endswith("Reset status: skipped"))
+
+    def testInvalidSha(self):
+        path = self.clone("full")
+        previous = self.git("rev-parse", "HEAD", cwd=path)
+        webhook = multiPullerWebhookBlueprint(None, [repositoryCheckout("org/repo", path)], gitCommand=which("git"), commandEnv=self.env)
+        for after in ("--upload-pack=touch pwned", "HEAD", previous.upper()):
+            self.assertEqual(webhook.pullAndTest({"ref": "refs/heads/main", "after": after, "repository": {"full_name": "org/repo"}}), (400, "Invalid commit SHA"))
+        self.assertEqual(webhook.head(path), previous)
+
+    def testSelectedTests(self):
+        path = self.clone("full")
+        with open(os.path.join(self.upstream, "README.md"), "w") as f:
+            f.write("docs")
+        self.git("add", "README.md", cwd=self.upstream)
+        after = self.commit()
+        failing = unittest.TestSuite([unittest.FunctionTestCase(lambda: self.fail())])
+        webhook = multiPullerWebhookBlueprint(None, [repositoryCheckout("org/repo", path, tests=failing, testMap={"*.md": []})], gitCommand=which("git"), commandEnv=self.env)
+        self.assertEqual(webhook.pullAndTest({"ref": "refs/heads/main", "after": after, "repository": {"full_name": "org/repo"}}), (200, "No tests affected"))
+        self.assertEqual(webhook.head(path), after)
+
+class TestWorktreeDeploy(gitTestCase):
+    def testDeploy(self):
+        repository = self.clone("repository")
+        live = os.path.join(self.dir.name, "live")
+        deployer = worktreeDeployer(repository, live, keep=1, testCommand=["test", "!", "-e", "broken"], gitCommand=which("git"), commandEnv=self.env)
+        webhook = pullerWebhookBlueprint(None, deployer=deployer, gitCommand=which("git"), commandEnv=self.env)
+        first = self.commit()
+        self.assertEqual(webhook.pullAndTest({"ref": "refs/heads/main", "after": first}), (200, f"Deployed {first}"))
+        self.assertTrue(os.path.islink(live))
+        self.assertEqual(webhook.head(live), first)
+        with open(os.path.join(self.upstream, "broken"), "w") as f:
+            f.write("")
+        self.git("add", "broken", cwd=self.upstream)
+        code, _ = webhook.pullAndTest({"ref": "refs/heads/main", "after": self.commit()})
+        self.assertEqual(code, 428)
+        self.assertEqual(webhook.head(live), first)
+        self.git("rm", "-q", "broken", cwd=self.upstream)
+        third = self.commit()
+        self.assertEqual(webhook.pullAndTest({"ref": "refs/heads/main"}), (200, f"Deployed {third}"))
+        self.assertEqual(webhook.head(live), third)
+        self.assertEqual(len(os.listdir(deployer.worktreesPath)), 3) # two worktrees and the history
+        self.assertEqual(webhook.pullAndTest({"ref": "refs/heads/dev"}), (200, "Ignored push to refs/heads/dev"))
+        self.assertEqual(webhook.pullAndTest({"ref": "refs/heads/main", "after": third}), (200, "Already up to date"))
+        self.assertEqual(deployer.rollback(), first)
+        self.assertEqual(webhook.head(live), first)
+        self.assertRaises(deployError, deployer.rollback)
+        self.assertEqual(worktreeDeployer(repository, live, gitCommand=which("git"), commandEnv=self.env).live(), first)
+        self.assertRaises(ValueError, worktreeDeployer, repository, self.upstream)
+        self.assertEqual(webhook.pullAndTest({"ref": "refs/heads/main", "after": "--upload-pack=touch pwned"}), (400, "Invalid commit SHA"))
+        self.assertRaises(ValueError, deployer.fetch, "--upload-pack=touch pwned")
+        self.assertRaises(ValueError, pullerWebhookBlueprint, None, unittest.TestSuite(), deployer=deployer)
+        self.assertRaises(ValueError, pullerWebhookBlueprint, None, deployer=deployer, testMap={"*": []})
+        deployer.testCommand = [os.path.join(self.dir.name, "missing")]
+        code, _ = webhook.pullAndTest({"ref": "refs/heads/main", "after": self.commit()})
+        self.assertEqual(code, 500)
+        self.assertEqual(webhook.head(live), first)
+        self.assertTrue(deployer.lock.acquire(blocking=False))
+        deployer.lock.release()
+
+class TestCoordination(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.calls = []
+        return super().setUp()
+    
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+        return super().tearDown()
+    
+    def pull(self, data):
+        self.calls.append(data["after"])
+        time.sleep(0.2)
+        return 200, f"Pulled {data['after']}"
+    
+    def testWait(self):
+        coordinator = workerCoordinator(self.dir.name)
+        with ThreadPoolExecutor(2) as executor:
+            futures = [executor.submit(coordinator.run, "org/repo", "a", {"after": "a"}, self.pull) for _ in range(2)]
+            results = [future.result() for future in futures]
+        self.assertEqual(results, [(200, "Pulled a")] * 2)
+        self.assertEqual(self.calls, ["a"])
+        self.assertEqual(coordinator.result("org/repo")["target"], "a")
+        coordinator.timeout = 0.05
+        lockPath = coordinator.paths("org/repo")[0]
+        holder = Popen([sys.executable, "-c", f"import sys; from gitWebhook.coordination import fileLock; fileLock({lockPath!r}).acquire(); print('locked', flush=True); sys.stdin.read()"], stdin=PIPE, stdout=PIPE)
+        self.assertEqual(holder.stdout.readline(), b"locked\n")
+        self.assertFalse(fileLock(lockPath).acquire(blocking=False))
+        self.assertEqual(coordinator.run("org/repo", "b", {"after": "b"}, self.pull), (503, "Timed out waiting for another worker"))
+        holder.communicate()
+        self.assertEqual(coordinator.run("org/repo", "b", {"after": "b"}, self.pull), (200, "Pulled b"))
+    
+    def testHandOver(self):
+        coordinator = workerCoordinator(self.dir.name, wait=False)
+        with ThreadPoolExecutor(2) as executor:
+            leader = executor.submit(coordinator.run, "org/repo", "a", {"after": "a"}, self.pull)
+            time.sleep(0.05)
+            self.assertEqual(coordinator.run("org/repo", "b", {"after": "b"}, self.pull), (202, "Handed over to another worker"))
+            self.assertEqual(leader.result(), (200, "Pulled a"))
+        self.assertEqual(self.calls, ["a", "b"])
+        self.assertEqual(coordinator.result("org/repo")["target"], "b")
+    
+    def testPuller(self):
+        coordinator = workerCoordinator(self.dir.name)
+        webhook = pullerWebhookBlueprint(VALID_TOKEN, name="valid", coordinator=coordinator)
+        webhook.pullAndTest = self.pull
+        data = {"after": "a", "ref": "refs/heads/main", "repository": {"full_name": "org/repo"}}
+        self.assertEqual(webhook.processWebhook(data), (200, "Pulled a"))
+        self.assertEqual(webhook.processWebhook(data), (200, "Pulled a"))
+        self.assertEqual(self.calls, ["a"])
+    
+    def testPullerRefsShareCheckout(self):
+        checkout = os.path.join(self.dir.name, "checkout")
+        os.mkdir(checkout)
+        git = os.path.join(self.dir.name, "git")
+        with open(git, "w") as f:
+            f.write('#!/bin/sh\n[ "$1" = pull ] || exit 1\nmkdir pulling || exit 1\nsleep 0.3\nrmdir pulling\n')
+        os.chmod(git, 0o755)
+        code = "import sys; from gitWebhook.pullerWebhook import pullerWebhookBlueprint; from gitWebhook.coordination import workerCoordinator; " \
+            f"webhook = pullerWebhookBlueprint(None, gitCommand={git!r}, coordinator=workerCoordinator({os.path.join(self.dir.name, 'locks')!r})); " \
+            "print(webhook.processWebhook({'ref': sys.argv[1], 'after': sys.argv[2], 'repository': {'full_name': 'org/repo'}})[0])"
+        env = dict(os.environ, PYTHONPATH=os.getcwd())
+        workers = [Popen([sys.executable, "-c", code, ref, after], cwd=checkout, env=env, stdout=PIPE) for ref, after in (("refs/heads/main", "a"), ("refs/heads/dev", "b"))]
+        self.assertEqual([worker.communicate()[0] for worker in workers], [b"200\n"] * 2)
+
+class TestEvents(unittest.TestCase):
+    def testLazy(self):
+        payload = {"ref": "refs/heads/main", "after": "b" * 40, "repository": {"full_name": "org/repo", "owner": {"login": "org"}}, "commits": [{"id": "1", "message": "}\\\"{", "added": ["a.py"], "modified": [], "removed": []}], "empty": {}}
+        event = eventView("push", json.dumps(payload, indent=1).encode("utf-8"))
+        self.assertIsInstance(event, pushEvent)
+        self.assertEqual(event.payload.values, {})
+        self.assertEqual((event.ref, event.branch, event.after, event.repository), ("refs/heads/main", "main", "b" * 40, "org/repo"))
+        self.assertNotIn("commits", event.payload.values)
+        self.assertEqual(event.payload.values["repository"].values.keys(), {"full_name"})
+        self.assertEqual(changedFiles(event), {"a.py"})
+        self.assertEqual(event.commits[0]["message"], payload["commits"][0]["message"])
+        self.assertEqual(event.toDict(), payload)
+        self.assertEqual(dict(event["empty"]), {})
+        self.assertEqual(list(event), list(payload))
+        for body in (b'{"a": 1', b'[1]', b'{"a": 1} 2', b'{"a" 1}', b'{"a": tru}'):
+            self.assertRaises(ValueError, eventView, None, body)
+    
+    def testNormalization(self):
+        github = eventView("pull_request", json.dumps({"action": "opened", "number": 3, "pull_request": {"title": "Fix", "head": {"ref": "fix", "sha": "abc"}, "base": {"ref": "main"}, "merged": False}}).encode("utf-8"))
+        gitlab = eventView("merge_request", json.dumps({"object_kind": "merge_request", "object_attributes": {"action": "open", "iid": 3, "title": "Fix", "source_branch": "fix", "target_branch": "main", "last_commit": {"id": "abc"}, "state": "opened"}}).encode("utf-8"))
+        for event in (github, gitlab):
+            self.assertIsInstance(event, pullRequestEvent)
+            self.assertEqual((event.action, event.number, event.title, event.sourceBranch, event.targetBranch, event.headSha, event.merged), ("opened", 3, "Fix", "fix", "main", "abc", False))
+        gitea = eventView("pull_request", json.dumps({"action": "synchronized", "number": 3, "pull_request": {"title": "Fix", "head": {"ref": "fix", "sha": "abc"}, "base": {"ref": "main"}, "merged": False}}).encode("utf-8"))
+        self.assertEqual((gitea.action, gitea.number, gitea.sourceBranch, gitea.headSha), ("synchronize", 3, "fix", "abc"))
+        self.assertEqual(eventView("pull_request", b'{"action": "synchronize"}').action, "synchronize")
+        github = eventView("workflow_run", json.dumps({"workflow_run": {"id": 7, "head_branch": "main", "head_sha": "abc", "status": "completed", "conclusion": "failure"}}).encode("utf-8"))
+        gitlab = eventView("pipeline", json.dumps({"object_kind": "pipeline", "object_attributes": {"id": 7, "ref": "main", "sha": "abc", "status": "failed"}}).encode("utf-8"))
+        for event in (github, gitlab):
+            self.assertIsInstance(event, pipelineEvent)
+            self.assertEqual((event.id, event.branch, event.sha, event.status), (7, "main", "abc", "failed"))
+    
+    def testBlueprint(self):
+        received = []
+        webhook = functionWebhookBlueprint(VALID_TOKEN, [lambda data: data["repository"]["full_name"] == "org/repo"], name="valid", typedEvents=True)
+        @webhook.on("push", repo="org/*")
+        def push(event):
+            received.append((type(event), event.after))
+            return True
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        client = app.test_client()
+        headers, data = signedJson(VALID_TOKEN, {"ref": "refs/heads/main", "after": "a" * 40, "repository": {"full_name": "org/repo"}})
+        headers["X-GitHub-Event"] = "push"
+        self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 200)
+        self.assertEqual(received, [(pushEvent, "a" * 40)])
+        headers, data = signedJson(VALID_TOKEN, {})
+        data = b"[" + data
+        headers["X-Hub-Signature-256"] = "sha256=" + hmacNew(VALID_TOKEN.encode("utf-8"), msg=data, digestmod=sha256).hexdigest()
+        headers["X-GitHub-Event"] = "push"
+        self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 400)
+
+class TestCapture(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        return super().setUp()
+    
+    def tearDown(self) -> None:
+        self.dir.cleanup()
+        return super().tearDown()
+    
+    def testCapture(self):
+        capture = deliveryCapture(self.dir.name, maxFileSize=600, maxFiles=2, events=["push", "ping"])
+        webhook = webhookBlueprint(VALID_TOKEN, name="valid", capture=capture)
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        client = app.test_client()
+        for i in range(6):
+            headers, data = signedJson(VALID_TOKEN, {"ref": "refs/heads/main", "id": i})
+            headers["X-GitHub-Event"] = "push"
+            headers["Authorization"] = "secret"
+            self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 200)
+        headers["X-GitHub-Event"] = "status"
+        client.post("/valid/", headers=headers, data=data)
+        capture.flush()
+        self.assertEqual(capture.captured, 6)
+        files = capture.files()
+        self.assertEqual(len(files), 2)
+        deliveries = list(readCapture(self.dir.name))
+        ids = [json.loads(delivery.body)["id"] for delivery in deliveries]
+        self.assertLess(len(ids), 6)
+        self.assertEqual(ids, list(range(6 - len(ids), 6)))
+        self.assertEqual(deliveries[0].event, "push")
+        headers = {key.lower(): value for key, value in deliveries[0].headers.items()}
+        self.assertNotIn("authorization", headers)
+        self.assertEqual(headers["x-github-event"], "push")
+        capture.close()
+        with open(files[-1], "rb") as f:
+            content = f.read()
+        with open(files[-1], "wb") as f:
+            f.write(content[:-10])
+        self.assertEqual(len(list(readCapture(files[-1]))), 1)
+        capture = deliveryCapture(self.dir.name, sampleRate=0.0)
+        self.assertFalse(capture.record({}, b"{}", "push"))
+        capture.close()
+    
+    def testOnlyProcessedCaptured(self):
+        capture = deliveryCapture(self.dir.name)
+        webhook = webhookBlueprint(VALID_TOKEN, name="valid", capture=capture, deliveryCache=deliveryCache())
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        client = app.test_client()
+        headers, data = signedJson(VALID_TOKEN, {"ref": "refs/heads/main"})
+        headers["X-GitHub-Delivery"] = "1"
+        for _ in range(2):
+            self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 200)
+        data = b"not json"
+        headers["X-GitHub-Delivery"] = "2"
+        headers["X-Hub-Signature-256"] = "sha256=" + hmacNew(VALID_TOKEN.encode("utf-8"), msg=data, digestmod=sha256).hexdigest()
+        self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 400)
+        capture.flush()
+        self.assertEqual(capture.captured, 1)
+        capture.close()
+    
+    def testDropWhenBehind(self):
+        capture = deliveryCapture(self.dir.name, maxQueued=1)
+        gate = threading.Event()
+        write = capture.write
+        capture.write = lambda line: (gate.wait(5), write(line))
+        results = [capture.record({}, b"{}", "push") for _ in range(3)]
+        gate.set()
+        capture.close()
+        self.assertIn(False, results)
+        self.assertEqual((capture.captured, capture.dropped), (results.count(True), results.count(False)))
+    
+    def testReplay(self):
+        def fast(data):
+            return True
+        def slow(data):
+            time.sleep(0.01)
+            return data["ok"]
+        webhook = functionWebhookBlueprint(VALID_TOKEN, [fast, slow], name="valid")
+        @webhook.on("push")
+        def routed(data):
+            return True
+        deliveries = [capturedDelivery(i * 0.1, "push", {}, json.dumps({"ok": i != 3}).encode("utf-8")) for i in range(4)]
+        report = captureReplay(webhook, parallelism=4).run(deliveries)
+        self.assertEqual((report["deliveries"], report["failed"], report["ignored"]), (4, 1, 0))
+        self.assertEqual(report["events"]["push"]["count"], 4)
+        self.assertEqual({name: summary["count"] for name, summary in report["handlers"].items()}, {"fast": 4, "slow": 4, "routed": 4})
+        self.assertGreater(report["handlers"]["slow"]["p50"], report["handlers"]["fast"]["p50"])
+        self.assertIsNone(webhook.metrics)
+        webhook.metrics = webhookMetrics()
+        captureReplay(webhook).run(deliveries)
+        self.assertEqual(webhook.metrics.snapshot(), {"histograms": {}, "counters": {}}) # live metrics are left alone
+        report = captureReplay(webhook, realtime=True, speed=2).run(deliveries)
+        self.assertGreaterEqual(report["seconds"], 0.15)
+
+class TestTestSelection(unittest.TestCase):
+    def testChangedFiles(self):
+        data = {"commits": [{"added": ["a.py"], "modified": ["b.py"], "removed": []}, {"added": [], "modified": ["a.py"], "removed": ["c.py"]}]}
+        self.assertEqual(changedFiles(data), {"a.py", "b.py", "c.py"})
+        self.assertIsNone(changedFiles(dict(data, forced=True)))
+        self.assertIsNone(changedFiles(dict(data, total_commits_count=3)))
+        self.assertIsNone(changedFiles({"commits": [{"added": []}]}))
+        self.assertIsNone(changedFiles({}))
+    
+    def testSelect(self):
+        loader = unittest.TestLoader()
+        intake = loader.loadTestsFromTestCase(TestIntake)
+        everything = unittest.TestSuite([intake, loader.loadTestsFromTestCase(TestDeliveryCache)])
+        selector = testSelector({"docs/*": [], "gitWebhook/intake.py": intake, "gitWebhook/deliveryCache.py": [f"{__name__}.TestDeliveryCache.testEviction"]})
+        self.assertIs(selector.select(everything, None), everything)
+        self.assertIs(selector.select(everything, {"docs/index.md", "setup.py"}), everything)
+        self.assertEqual(selector.select(everything, {"docs/index.md"}).countTestCases(), 0)
+        self.assertEqual(selector.select(everything, {"gitWebhook/intake.py", "docs/index.md"}).countTestCases(), intake.countTestCases())
+        self.assertEqual(selector.select(everything, {"gitWebhook/deliveryCache.py", "gitWebhook/intake.py"}).countTestCases(), intake.countTestCases() + 1)
+    
+    def testProcesses(self):
+        result = runTestsInProcesses([f"{__name__}.TestIntake.testReadBody", f"{__name__}.TestIntake.testSizeLimit", "missingModule.TestMissing.testMissing"], 2)
+        self.assertEqual(result.testsRun, 3)
+        self.assertEqual(len(result.errors), 1)
+        self.assertIsInstance(result.errors[0][0], remoteTest)
+        self.assertFalse(result.wasSuccessful())
+
+class TestDeliveryJournal(unittest.TestCase):
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.journal = deliveryJournal(os.path.join(self.dir.name, "journal.db"))
+        self.received = []
+        return super().setUp()
+    
+    def tearDown(self) -> None:
+        self.journal.close()
+        self.dir.cleanup()
+        return super().tearDown()
+    
+    def makeApp(self):
+        def record(data):
+            self.received.append(data)
+            return True
+        webhook = functionWebhookBlueprint(VALID_TOKEN, [record], name="valid", journal=self.journal)
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        return webhook, app.test_client()
+    
+    def testJournaled(self):
+        webhook, client = self.makeApp()
+        headers, data = signedJson(VALID_TOKEN, {"ref": "refs/heads/main"})
+        headers["X-GitHub-Event"] = "push"
+        headers["X-GitHub-Delivery"] = "abc"
+        resp = client.post("/valid/", headers=headers, data=data)
+        self.assertEqual(resp.status_code, 202)
+        seq = resp.json["seq"]
+        webhook.journalExecutor.shutdown()
+        self.journal.flush()
+        self.assertEqual(self.received, [{"ref": "refs/heads/main"}])
+        self.assertEqual(self.journal.unfinished(), [])
+        self.assertEqual(self.journal.get(seq).event, "push")
+        self.assertEqual(self.journal.get(seq).deliveryId, "abc") # kept without a delivery cache
+        self.assertEqual(webhook.replay(event="push"), [(seq, 200, "{'record': True}")])
+        self.assertEqual(webhook.replay(event="ping"), [])
+        self.assertEqual(len(self.received), 2)
+    
+    def testReplayUnfinished(self):
+        previous = deliveryJournal(self.journal.path) # the journal of the process before a restart
+        seq = previous.append("id", "push", b'{"ref": "refs/heads/dev"}')
+        previous.close()
+        self.assertEqual([entry.seq for entry in self.journal.unfinished()], [seq])
+        webhook, _ = self.makeApp()
+        webhook.journalExecutor.shutdown()
+        self.journal.flush()
+        self.assertEqual(self.received, [{"ref": "refs/heads/dev"}])
+        self.assertEqual(self.journal.unfinished(), [])
+    
+    def testSharedJournal(self):
+        seq = self.journal.append("id", "push", b'{"ref": "refs/heads/dev"}') # in flight in another live worker
+        other = deliveryJournal(self.journal.path)
+        self.assertEqual(other.claimUnfinished(), [])
+        self.journal.close()
+        self.assertEqual([entry.seq for entry in other.claimUnfinished()], [seq])
+        self.assertEqual(other.claimUnfinished(), [])
+        self.assertEqual(os.listdir(self.dir.name).count(f"journal.db.{other.owner}.lock"), 1)
+        self.journal = other
+        crashed = f"from gitWebhook.deliveryJournal import deliveryJournal; import os; deliveryJournal({other.path!r}).append('id', 'push', b'{{}}'); os._exit(1)"
+        Popen([sys.executable, "-c", crashed], cwd=os.path.dirname(os.path.abspath(__file__))).wait()
+        self.assertEqual(len(other.claimUnfinished()), 1) # the lock of a crashed worker is released
+    
+    def testGroupCommit(self):
+        with ThreadPoolExecutor(16) as executor:
+            seqs = list(executor.map(lambda i: self.journal.append(str(i), "push", b"{}"), range(200)))
+        self.assertEqual(len(set(seqs)), 200)
+        self.assertEqual(len(self.journal.entries()), 200)
+
+class TestSecretProvider(unittest.TestCase):
+    def setUp(self) -> None:
+        self.secrets = secretProvider({"1": webhookSecret("first", ["one/*"]), "2": webhookSecret(["second", "old"], ["two/repo"])})
+        self.webhook = webhookBlueprint(self.secrets, name="valid")
+        self.app = Flask(__name__)
+        self.app.register_blueprint(self.webhook, url_prefix="/valid")
+        self.client = self.app.test_client()
+        return super().setUp()
+    
+    def post(self, hookId, secret, repository=None):
+        headers, data = signedJson(secret, {"repository": {"full_name": repository or ("one/repo" if hookId == "1" else "two/repo")}})
+        headers["X-GitHub-Hook-ID"] = hookId
+        return self.client.post("/valid/", headers=headers, data=data).status_code
+    
+    def testTenants(self):
+        self.assertEqual(self.post("1", "first"), 200)
+        self.assertEqual(self.post("2", "second"), 200)
+        self.assertEqual(self.post("2", "old"), 200)
+        self.assertEqual(self.post("1", "old"), 401)
+        self.assertEqual(self.post("3", "first"), 401)
+        resp = self.client.post("/valid/", headers={"Content-Type": "application/json", "X-Gitlab-Token": "first", "X-Gitlab-Webhook-UUID": "1"}, data=b'{"project": {"path_with_namespace": "one/other"}}')
+        self.assertEqual(resp.status_code, 200)
+    
+    def testRepositoryBinding(self):
+        self.assertEqual(self.post("1", "first", "two/repo"), 403)
+        self.assertEqual(self.post("2", "second", "one/repo"), 403)
+        self.assertEqual(self.post("2", "second", "two/other"), 403)
+        self.secrets.set("3", "unbound")
+        self.assertEqual(self.post("3", "unbound", "one/repo"), 403)
+        self.assertFalse(secretProvider(default="single").authorize(webhookSecret("other"), "one/repo"))
+        self.assertTrue(secretProvider(bindRepositories=False).authorize(webhookSecret("other"), "one/repo"))
+    
+    def testNonAsciiSignature(self):
+        headers, data = signedJson("first", {"test": "test"})
+        headers["X-GitHub-Hook-ID"] = "1"
+        headers["X-Hub-Signature-256"] = "sha256=\u00e9" + headers["X-Hub-Signature-256"][8:]
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 401)
+    
+    def testRotation(self):
+        self.secrets.rotate("1", "next")
+        self.assertEqual(self.post("1", "next"), 200)
+        self.assertEqual(self.post("1", "first"), 200)
+        self.secrets.retire("1", "first")
+        self.assertEqual(self.post("1", "first"), 401)
+        self.assertEqual(self.secrets.secrets["1"].secrets, ("next",))
+        self.assertRaises(ValueError, webhookSecret, [])
+    
+    def testResolver(self):
+        calls = []
+        def resolver(key):
+            calls.append(key)
+            return "resolved" if key == "9" else None
+        secrets = secretProvider(resolver=resolver, default="fallback")
+        self.assertTrue(secrets.resolve({"X-GitHub-Hook-ID": "9"}).verifyToken("resolved"))
+        self.assertTrue(secrets.resolve({"X-GitHub-Hook-ID": "9"}).verifyToken("resolved"))
+        self.assertTrue(secrets.resolve({"X-GitHub-Hook-ID": "8"}).verifyToken("fallback"))
+        self.assertTrue(secrets.resolve({}).verifyToken("fallback"))
+        self.assertEqual(calls, ["9", "8"])
+        secrets.invalidate("9")
+        secrets.resolve({"X-GitHub-Hook-ID": "9"})
+        self.assertEqual(calls, ["9", "8", "9"])
+    
+    def testResolverRate(self):
+        calls = []
+        secrets = secretProvider(resolver=lambda key: calls.append(key), resolverRate=2.0)
+        for key in range(10):
+            self.assertIsNone(secrets.resolve({"X-GitHub-Hook-ID": str(key)}))
+        self.assertEqual(calls, ["0", "1"])
+        self.assertEqual(secrets.throttled, 8)
+        self.assertRaises(ValueError, secretProvider, resolverRate=0)
+
+class TestAdmission(unittest.TestCase):
+    def makeClient(self, admission, metrics=None):
+        webhook = webhookBlueprint(VALID_TOKEN, name="valid", admission=admission, metrics=metrics)
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        return app.test_client()
+    
+    def testRateLimits(self):
+        admission = admissionController(ipRate=0.01, ipBurst=2, repositoryRate=0.01)
+        metrics = webhookMetrics()
+        client = self.makeClient(admission, metrics)
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 200)
+        self.assertEqual(client.post("/valid/", headers=dict(headers, **{"X-GitHub-Hook-ID": "1"}), data=data).status_code, 200)
+        resp = client.post("/valid/", headers=headers, data=data)
+        self.assertEqual(resp.status_code, 503)
+        self.assertGreater(int(resp.headers["Retry-After"]), 1)
+        self.assertEqual(admission.shed["ip"], 1)
+        self.assertEqual(admission.inFlight, 0)
+        self.assertEqual(admission.admitted, 2)
+        self.assertEqual(metrics.get("shed_total", reason="ip"), 1)
+        admission = admissionController(repositoryRate=0.01)
+        client = self.makeClient(admission)
+        self.assertEqual(client.post("/valid/", headers=dict(headers, **{"X-GitHub-Hook-ID": "1"}), data=data).status_code, 200)
+        self.assertEqual(client.post("/valid/", headers=dict(headers, **{"X-GitHub-Hook-ID": "2"}), data=data).status_code, 200)
+        self.assertEqual(client.post("/valid/", headers=dict(headers, **{"X-GitHub-Hook-ID": "1"}), data=data).status_code, 503)
+        self.assertEqual(admission.shed["repository"], 1)
+    
+    def testInFlight(self):
+        admission = admissionController(maxInFlight=1, retryAfter=5)
+        self.assertIsNone(admission.admit("192.0.2.1", None))
+        self.assertEqual(admission.admit("192.0.2.2", None), ("inFlight", 5))
+        admission.release()
+        self.assertIsNone(admission.admit("192.0.2.2", None))
+        admission.release()
+        client = self.makeClient(admission)
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        for _ in range(3):
+            self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 200)
+        self.assertEqual(admission.shed["inFlight"], 1)
+        self.assertEqual(admission.inFlight, 0)
+    
+    def testValidation(self):
+        self.assertRaises(ValueError, admissionController, ipRate=0)
+        self.assertRaises(ValueError, admissionController, repositoryRate=-1)
+        self.assertRaises(ValueError, admissionController, maxInFlight=0)
+    
+    def testSpoofedRepository(self):
+        admission = admissionController(repositoryRate=0.01)
+        client = self.makeClient(admission)
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        headers["X-GitHub-Hook-ID"] = "1"
+        for _ in range(3):
+            self.assertEqual(client.post("/valid/", headers=dict(headers, **{"X-Hub-Signature-256": "sha256=0"}), data=data).status_code, 401)
+        self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 200)
+        self.assertEqual(admission.shed["repository"], 0)
+    
+    def testJournaledInFlight(self):
+        started = threading.Event()
+        finish = threading.Event()
+        def slow(data):
+            started.set()
+            return finish.wait(5)
+        admission = admissionController(maxInFlight=1)
+        with tempfile.TemporaryDirectory() as directory:
+            journal = deliveryJournal(os.path.join(directory, "journal.db"))
+            webhook = functionWebhookBlueprint(VALID_TOKEN, [slow], name="valid", admission=admission, journal=journal)
+            app = Flask(__name__)
+            app.register_blueprint(webhook, url_prefix="/valid")
+            client = app.test_client()
+            headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+            self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 202)
+            started.wait(5)
+            self.assertEqual(client.post("/valid/", headers=headers, data=data).status_code, 503)
+            finish.set()
+            webhook.journalExecutor.shutdown()
+            self.assertEqual(admission.inFlight, 0)
+            journal.close()
+
+class listHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+    
+    def emit(self, record):
+        self.records.append(record)
+
+class TestStructuredLog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.log = logging.getLogger(self.id())
+        self.log.propagate = False
+        self.handler = listHandler()
+        self.log.addHandler(self.handler)
+        return super().setUp()
+    
+    def testLazyPayload(self):
+        rendered = []
+        class expensive:
+            def __str__(self):
+                rendered.append(True)
+                return "x" * 10000
+        webhook = functionWebhookBlueprint(VALID_TOKEN, [lambda data: True], log=self.log, name="valid")
+        self.log.setLevel(logging.INFO)
+        self.assertEqual(webhook.processWebhook({"value": expensive()})[0], 200)
+        self.assertEqual(rendered, [])
+        self.log.setLevel(logging.DEBUG)
+        webhook.processWebhook({"value": expensive()})
+        self.assertEqual(rendered, [])
+        self.assertTrue(self.handler.records[0].getMessage().endswith("... (truncated)"))
+        self.assertEqual(len(rendered), 1)
+        self.assertEqual(str(lazyPayload("short")), "short")
+        self.assertTrue(str(lazyPayload("x" * 100, 10)).endswith("... (90 more characters)"))
+        rendered.clear()
+        self.assertEqual(len(str(lazyPayload([expensive()] * 100, 20))), 20 + len("... (truncated)"))
+        self.assertEqual(len(rendered), 1) # encoding stopped at the limit
+    
+    def testQueuedRendering(self):
+        self.log.setLevel(logging.INFO)
+        listener = queueLogging(self.log)
+        payload = {"before": 1}
+        self.log.info("Payload %s", lazyPayload(payload))
+        payload["after"] = 2
+        try:
+            raise ValueError("failed")
+        except ValueError:
+            self.log.exception("Failure")
+        listener.stop()
+        self.assertEqual(self.handler.records[0].getMessage(), 'Payload {"before": 1}')
+        self.assertIsNone(self.handler.records[0].args)
+        self.assertIn("ValueError: failed", json.loads(jsonFormatter().format(self.handler.records[1]))["exception"])
+    
+    def testFields(self):
+        self.log.setLevel(logging.INFO)
+        listener = queueLogging(self.log)
+        self.assertNotIn(self.handler, self.log.handlers)
+        webhook = webhookBlueprint(VALID_TOKEN, log=self.log, name="valid")
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        headers, data = signedJson(VALID_TOKEN, {"repository": {"full_name": "org/repo"}})
+        headers["X-GitHub-Delivery"] = "abc"
+        headers["X-GitHub-Event"] = "push"
+        self.assertEqual(app.test_client().post("/valid/", headers=headers, data=data).status_code, 200)
+        listener.stop()
+        record = self.handler.records[-1]
+        self.assertEqual((record.deliveryId, record.provider, record.event, record.repository, record.status), ("abc", "github", "push", "org/repo", 200))
+        self.assertGreater(record.duration, 0)
+        entry = json.loads(jsonFormatter().format(record))
+        self.assertEqual(entry["message"], "Webhook processed with status code 200 and message: OK")
+        self.assertEqual(entry["repository"], "org/repo")
+
+class TestDeliveryCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.processed = 0
+        self.webhook = webhookBlueprint(VALID_TOKEN, name="valid", deliveryCache=deliveryCache())
+        self.webhook.processWebhook = self.process
+        self.app = Flask(__name__)
+        self.app.register_blueprint(self.webhook, url_prefix="/valid")
+        self.app.config.update({"TESTING": True})
+        self.client = self.app.test_client()
+        return super().setUp()
+    
+    def process(self, data):
+        self.processed += 1
+        return (500, "Error") if data.get("fail") else (200, "OK")
+    
+    def testDuplicate(self):
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        headers["X-GitHub-Delivery"] = "1"
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).data, b"OK")
+        resp = self.client.post("/valid/", headers=headers, data=data)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"Duplicate delivery")
+        self.assertEqual(self.processed, 1)
+    
+    def testRetryAfterError(self):
+        headers, data = signedJson(VALID_TOKEN, {"fail": True})
+        headers["X-GitHub-Delivery"] = "2"
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 500)
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 500)
+        self.assertEqual(self.processed, 2)
+    
+    def testRetryAfterInvalidJson(self):
+        headers, _ = signedJson(VALID_TOKEN, {})
+        headers["X-GitHub-Delivery"] = "3"
+        data = b"not json"
+        headers["X-Hub-Signature-256"] = "sha256=" + hmacNew(VALID_TOKEN.encode("utf-8"), msg=data, digestmod=sha256).hexdigest()
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 400)
+        fixed, data = signedJson(VALID_TOKEN, {"test": "test"})
+        headers.update(fixed)
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).data, b"OK")
+        self.assertEqual(self.processed, 1)
+    
+    def testRetryAfterHookError(self):
+        failing = [False, True]
+        @self.webhook.hook
+        def flaky():
+            if failing.pop():
+                raise RuntimeError("hook failed")
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        headers["X-GitHub-Delivery"] = "4"
+        with self.assertRaises(RuntimeError): # the test app propagates exceptions instead of responding with 500
+            self.client.post("/valid/", headers=headers, data=data)
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).data, b"OK")
+        self.assertEqual(self.processed, 1)
+    
+    def testEviction(self):
+        cache = deliveryCache(maxSize=2, ttl=0.05)
+        self.assertTrue(cache.add("a"))
+        self.assertFalse(cache.add("a"))
+        cache.add("b")
+        cache.add("c")
+        self.assertTrue(cache.add("a"))
+        time.sleep(0.06)
+        self.assertTrue(cache.add("c"))
+        self.assertEqual(len(cache), 1)
+    
+    def testSqliteShared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "deliveries.db")
+            first = sqliteDeliveryCache(path)
+            second = sqliteDeliveryCache(path)
+            self.assertTrue(first.add("a"))
+            self.assertFalse(second.add("a"))
+            second.discard("a")
+            self.assertTrue(first.add("a"))
+            first.close()
+            second.close()
+
+class TestRouting(unittest.TestCase):
+    def setUp(self) -> None:
+        self.webhook = functionWebhookBlueprint(VALID_TOKEN, name="valid", functions=[])
+        self.called = []
+        @self.webhook.on("push", ref="refs/heads/main", repo="org/*")
+        def mainPush(data):
+            self.called.append("mainPush")
+            return True
+        @self.webhook.on("push")
+        def anyPush(data):
+            self.called.append("anyPush")
+            return True
+        @self.webhook.on("pull_request", repo="org/repo")
+        def pullRequest(data):
+            self.called.append("pullRequest")
+            return True
+        self.app = Flask(__name__)
+        self.app.register_blueprint(self.webhook, url_prefix="/valid")
+        self.app.config.update({"TESTING": True})
+        self.client = self.app.test_client()
+        return super().setUp()
+    
+    def post(self, event:str, payload:dict, headerName:str="X-GitHub-Event"):
+        headers, data = signedJson(VALID_TOKEN, payload)
+        headers[headerName] = event
+        return self.client.post("/valid/", headers=headers, data=data)
+    
+    def testRouting(self):
+        resp = self.post("push", {"ref": "refs/heads/main", "repository": {"full_name": "org/repo"}})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(sorted(self.called), ["anyPush", "mainPush"])
+        self.called.clear()
+        self.post("Push Hook", {"ref": "refs/heads/dev", "project": {"path_with_namespace": "org/repo"}}, "X-Gitlab-Event")
+        self.assertEqual(self.called, ["anyPush"])
+        self.called.clear()
+        self.post("pull_request", {"repository": {"full_name": "other/repo"}})
+        self.assertEqual(self.called, [])
+    
+    def testOverriddenProcessWebhook(self):
+        class audited(functionWebhookBlueprint):
+            def processWebhook(inner, data):
+                self.called.append("audit")
+                return super().processWebhook(data)
+        webhook = audited(VALID_TOKEN, [], name="audited")
+        @webhook.on("push")
+        def push(data):
+            self.called.append("push")
+            return True
+        self.assertEqual(webhook.dispatchWebhook("push", {}), (200, str({"push": True})))
+        self.assertEqual(self.called, ["audit", "push"])
+    
+    def testPullerHandlers(self):
+        webhook = pullerWebhookBlueprint(VALID_TOKEN, name="puller")
+        webhook.pullAndTest = lambda data: (200, "Pulled")
+        @webhook.on("release")
+        def release(data):
+            self.called.append("release")
+        self.assertTrue(webhook.acceptsEvent("push"))
+        self.assertEqual(webhook.dispatchWebhook("push", {}), (200, "Pulled"))
+        self.assertEqual(webhook.dispatchWebhook("release", {}), (200, "Pulled"))
+        self.assertEqual(self.called, ["release"])
+    
+    def testUnmatchedIgnoredBeforeParsing(self):
+        headers, _ = signedJson(VALID_TOKEN, {})
+        data = b"not json"
+        headers["X-Hub-Signature-256"] = "sha256=" + hmacNew(VALID_TOKEN.encode("utf-8"), msg=data, digestmod=sha256).hexdigest()
+        headers["X-GitHub-Event"] = "status"
+        resp = self.client.post("/valid/", headers=headers, data=data)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data, b"Event ignored")
+    
+    def testGetEvent(self):
+        self.assertEqual(getEvent({"X-Gitlab-Event": "Merge Request Hook"}), "merge_request")
+        self.assertEqual(getEvent({"X-Gitea-Event": "push"}), "push")
+        self.assertIsNone(getEvent({}))
+
+class TestIntake(unittest.TestCase):
+    def setUp(self) -> None:
+        self.decoded = []
+        def decoder(body):
+            self.decoded.append(type(body))
+            return json.loads(body)
+        self.webhook = webhookBlueprint(VALID_TOKEN, name="valid", maxBodySize=1024, jsonDecoder=decoder)
+        self.app = Flask(__name__)
+        self.app.register_blueprint(self.webhook, url_prefix="/valid")
+        self.app.config.update({"TESTING": True})
+        self.client = self.app.test_client()
+        return super().setUp()
+    
+    def testSizeLimit(self):
+        headers, data = signedJson(VALID_TOKEN, {"data": "a" * 2048})
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 413)
+        headers, data = signedJson(VALID_TOKEN, {"data": "a" * 512})
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 200)
+        self.assertEqual(self.decoded, [bytearray])
+    
+    def testMalformedSignature(self):
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        headers["X-Hub-Signature-256"] = "sha1=1234"
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 401)
+        self.assertEqual(self.decoded, [])
+    
+    def testReadBody(self):
+        data = random.randbytes(200000)
+        digest = hmacNew(VALID_TOKEN.encode("utf-8"), digestmod=sha256)
+        self.assertEqual(readBody(io.BytesIO(data), len(data), None, digest), data)
+        self.assertEqual(digest.hexdigest(), hmacNew(VALID_TOKEN.encode("utf-8"), msg=data, digestmod=sha256).hexdigest())
+        self.assertEqual(readBody(io.BytesIO(data), None, None), data)
+        self.assertRaises(payloadTooLarge, readBody, io.BytesIO(data), None, 1000)
+        self.assertRaises(payloadTooLarge, readBody, io.BytesIO(data), len(data), 1000)
+
+class TestIpWhitelist(unittest.TestCase):
+    def testRangeIndex(self):
+        index = ipRangeIndex(["192.30.252.0/22", "185.199.108.0/22", "10.0.0.1", "2a0a:a440::/29", "192.30.254.0/24"])
+        self.assertIn("192.30.255.255", index)
+        self.assertIn("185.199.108.1", index)
+        self.assertIn("10.0.0.1", index)
+        self.assertIn("::ffff:10.0.0.1", index)
+        self.assertIn("2a0a:a440::1", index)
+        self.assertNotIn("10.0.0.2", index)
+        self.assertNotIn("192.30.251.255", index)
+        self.assertNotIn("2a0a:a450::1", index)
+        self.assertNotIn("not an address", index)
+        self.assertEqual(len(index), 4)
+    
+    def post(self, webhook:webhookBlueprint, remote:str, forwarded:str | None = None):
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/valid")
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        if forwarded is not None:
+            headers["X-Forwarded-For"] = forwarded
+        return app.test_client().post("/valid/", headers=headers, data=data, environ_base={"REMOTE_ADDR": remote}).status_code
+    
+    def testBlueprint(self):
+        webhook = webhookBlueprint(VALID_TOKEN, name="valid", ipWhitelist=["192.30.252.0/22"], trustedProxies=["10.0.0.0/8"])
+        self.assertEqual(self.post(webhook, "192.30.253.1"), 200)
+        self.assertEqual(self.post(webhook, "192.30.251.1"), 403)
+        self.assertEqual(self.post(webhook, "10.1.1.1", "192.30.253.1, 10.0.0.2"), 200)
+        self.assertEqual(self.post(webhook, "10.1.1.1", "192.30.253.1, 8.8.8.8"), 403)
+        self.assertEqual(self.post(webhook, "8.8.8.8", "192.30.253.1"), 403)
+    
+    def testProviderMeta(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "meta.json")
+            cache = os.path.join(directory, "cache.json")
+            with open(source, "w") as f:
+                json.dump({"hooks": ["192.30.252.0/22"], "web": ["140.82.112.0/20"]}, f)
+            whitelist = providerMetaWhitelist(source, refreshInterval=None, cachePath=cache)
+            self.assertIn("192.30.253.1", whitelist)
+            self.assertNotIn("140.82.112.1", whitelist)
+            self.assertTrue(os.path.exists(cache))
+            os.remove(source)
+            whitelist = providerMetaWhitelist(source, refreshInterval=None, cachePath=cache)
+            whitelist.thread.join()
+            self.assertIn("192.30.253.1", whitelist)
+
+async def asgiRequest(app, method:str, path:str, headers:dict[str, str], body:bytes, client:str = "127.0.0.1") -> tuple[int, bytes]:
+    scope = {"type": "http", "method": method, "path": path, "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()], "client": (client, 1234)}
+    chunks = [body[i:i + 10] for i in range(0, len(body), 10)] or [b""]
+    messages = [{"type": "http.request", "body": chunk, "more_body": i < len(chunks) - 1} for i, chunk in enumerate(chunks)]
+    async def receive():
+        return messages.pop(0)
+    sent = []
+    async def send(message):
+        sent.append(message)
+    await app(scope, receive, send)
+    return sent[0]["status"], sent[1]["body"]
+
+class TestAsyncWebhook(unittest.TestCase):
+    def request(self, app, payload:dict, token:str = VALID_TOKEN, **kwargs):
+        headers, data = signedJson(token, payload)
+        return asyncio.run(asgiRequest(app, "POST", "/", headers, data, **kwargs))
+    
+    def testVerification(self):
+        app = asyncWebhookBlueprint(VALID_TOKEN, ipWhitelist=["127.0.0.0/8"])
+        self.assertEqual(self.request(app, {"test": "test"}), (200, b"OK"))
+        self.assertEqual(self.request(app, {"test": "test"}, "123")[0], 401)
+        self.assertEqual(self.request(app, {"test": "test"}, client="8.8.8.8")[0], 403)
+        self.assertEqual(asyncio.run(asgiRequest(app, "POST", "/", {"X-Gitlab-Token": VALID_TOKEN, "Content-Type": "application/json"}, b"not json"))[0], 400)
+        self.assertEqual(asyncio.run(asgiRequest(app, "GET", "/", {}, b""))[0], 405)
+    
+    def testConcurrentFunctions(self):
+        async def slow(data):
+            await asyncio.sleep(0.1)
+            return True
+        def blocking(data):
+            time.sleep(0.1)
+            return "done"
+        app = asyncFunctionWebhookBlueprint(VALID_TOKEN, [slow, blocking])
+        async def many():
+            headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+            return await asyncio.gather(*(asgiRequest(app, "POST", "/", headers, data) for _ in range(20)))
+        start = time.monotonic()
+        results = asyncio.run(many())
+        self.assertLess(time.monotonic() - start, 1.0)
+        self.assertTrue(all(result == (200, str({"slow": True, "blocking": "done"}).encode("utf-8")) for result in results))
+    
+    def testOffLoop(self):
+        threads = []
+        class recordingCache(deliveryCache):
+            def add(inner, deliveryId):
+                threads.append(threading.current_thread())
+                return super().add(deliveryId)
+        def decoder(body):
+            threads.append(threading.current_thread())
+            return json.loads(body)
+        app = asyncWebhookBlueprint(VALID_TOKEN, deliveryCache=recordingCache(), jsonDecoder=decoder)
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        headers["X-GitHub-Delivery"] = "1"
+        self.assertEqual(asyncio.run(asgiRequest(app, "POST", "/", headers, data)), (200, b"OK"))
+        self.assertEqual(asyncio.run(asgiRequest(app, "POST", "/", headers, data)), (200, b"Duplicate delivery"))
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.main_thread(), threads)
+    
+    def testWrap(self):
+        async def other(scope, receive, send):
+            await send({"type": "http.response.start", "status": 204, "headers": []})
+            await send({"type": "http.response.body", "body": b""})
+        app = asyncWebhookBlueprint(VALID_TOKEN, path="/webhook").wrap(other)
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        self.assertEqual(asyncio.run(asgiRequest(app, "POST", "/webhook/", headers, data)), (200, b"OK"))
+        self.assertEqual(asyncio.run(asgiRequest(app, "GET", "/other", {}, b""))[0], 204)
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self) -> None:
+        self.metrics = webhookMetrics()
+        def check(data):
+            return True
+        self.webhook = functionWebhookBlueprint(VALID_TOKEN, [check], name="valid", metrics=self.metrics)
+        self.app = Flask(__name__)
+        self.app.register_blueprint(self.webhook, url_prefix="/valid")
+        self.app.config.update({"TESTING": True})
+        self.client = self.app.test_client()
+        return super().setUp()
+    
+    def testDeliveryMetrics(self):
+        headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+        headers["X-GitHub-Event"] = "push"
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 200)
+        headers["X-Hub-Signature-256"] = "sha256=0"
+        self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 401)
+        self.assertEqual(self.metrics.get("deliveries_total", provider="github", event="push", status=200), 1)
+        self.assertEqual(self.metrics.get("deliveries_total", provider="github", event="unverified", status=401), 1)
+        self.assertEqual(self.metrics.get("stage_seconds", stage="origin").count, 2)
+        for stage in ("verify", "hooks", "parse", "process"):
+            self.assertEqual(self.metrics.get("stage_seconds", stage=stage).count, 1)
+        self.assertEqual(self.metrics.get("function_seconds", function="check").count, 1)
+        self.assertEqual(self.metrics.get("request_seconds").count, 2)
+        text = self.client.get("/valid/metrics").data.decode("utf-8")
+        self.assertIn('gitwebhook_deliveries_total{provider="github",event="push",status="200"} 1', text)
+        self.assertIn('gitwebhook_stage_seconds_bucket{stage="verify",le="+Inf"} 1', text)
+        snapshot = self.metrics.snapshot()
+        self.assertEqual(len(snapshot["counters"]["deliveries_total"]), 2)
+    
+    def testEventLabels(self):
+        for event in ("made up", "other\"one"):
+            headers, data = signedJson(VALID_TOKEN, {"test": "test"})
+            headers["X-GitHub-Event"] = event
+            self.assertEqual(self.client.post("/valid/", headers=headers, data=data).status_code, 200)
+        self.assertEqual(self.metrics.get("deliveries_total", provider="github", event="other", status=200), 2)
+        self.metrics.increment("escaped_total", value='a\\b"c\nd')
+        self.assertIn('gitwebhook_escaped_total{value="a\\\\b\\"c\\nd"} 1', self.metrics.render())
+    
+    def testMetricsWhitelist(self):
+        webhook = webhookBlueprint(VALID_TOKEN, name="scraped", metrics=webhookMetrics(), metricsWhitelist=["10.0.0.0/8"])
+        app = Flask(__name__)
+        app.register_blueprint(webhook, url_prefix="/scraped")
+        client = app.test_client()
+        self.assertEqual(client.get("/scraped/metrics").status_code, 403)
+        self.assertEqual(client.get("/scraped/metrics", environ_base={"REMOTE_ADDR": "10.1.2.3"}).status_code, 200)
+    
+    def testQuantile(self):
+        hist = histogram((1.0, 2.0, 4.0))
+        self.assertIsNone(hist.quantile(0.5))
+        for value in (0.5, 1.5, 1.5, 3.0):
+            hist.observe(value)
+        self.assertEqual(hist.cumulative(), [1, 3, 4, 4])
+        self.assertAlmostEqual(hist.quantile(0.5), 1.5)
+        self.assertLessEqual(hist.quantile(0.99), 4.0)
+
+class TestBenchmark(unittest.TestCase):
+    def testScenarios(self):
+        for provider in ("github", "gitlab", "gitea"):
+            result = benchmark.scenario("function", provider, "small", "client", 1, 2)
+            self.assertEqual(result["name"], f"function/{provider}/small/client/c1")
+            self.assertGreater(result["throughput"], 0)
+            self.assertGreater(result["peakMemory"], 0)
+            self.assertIn("verify", result["stages"])
+            self.assertGreater(result["stages"]["parse"]["peakMemory"], 0)
+        result = benchmark.scenario("webhook", "github", "ping", "server", 2, 4)
+        self.assertLess(result["peakMemory"], 1024 * 1024) # the server threads aren't counted
+    
+    def testCompare(self):
+        base = {"name": "a", "p50": 1.0, "p99": 2.0, "peakMemory": 100, "throughput": 10.0}
+        self.assertEqual(benchmark.compare([dict(base, p50=1.1)], {"a": base}, 0.25), [])
+        regressions = benchmark.compare([dict(base, p99=3.0, throughput=5.0)], {"a": base}, 0.25)
+        self.assertEqual(len(regressions), 2)
+        self.assertEqual(benchmark.compare([dict(base, name="b", p99=3.0)], {"a": base}, 0.25), [])
+        staged = dict(base, stages={"parse": {"p50": 0.1, "p99": 0.2, "peakMemory": 100}})
+        self.assertEqual(benchmark.compare([dict(staged, stages={"parse": {"p50": 0.1, "p99": 0.2, "peakMemory": 200}})], {"a": staged}, 0.25), ["a: parse peakMemory 100 -> 200"])
 
 if __name__ == "__main__":
     unittest.main()